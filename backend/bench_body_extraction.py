@@ -0,0 +1,116 @@
+"""
+Microbenchmarks body extraction on large multipart fixtures.
+
+Compares the previous extractor (recursive walk, whole text/plain part decoded,
+HTML-only mail ignored) with mime_body.extract_body, and prints time per message,
+peak memory allocated during one extraction and the length of the preview kept.
+
+    python bench_body_extraction.py --size-mb 2 --repeat 20
+"""
+import argparse
+import base64
+import random
+import sys
+import time
+import tracemalloc
+from mime_body import extract_body, preview
+
+
+def legacy_decode_base64(data):
+    if not data:
+        return ""
+    return base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
+
+
+def legacy_extract(payload):
+    """The extractor this module replaced, kept here as the baseline."""
+    parts = payload.get("parts")
+    if parts:
+        for part in parts:
+            if part.get("mimeType", "") == "text/plain":
+                return legacy_decode_base64(part["body"].get("data", ""))
+            nested = legacy_extract(part)
+            if nested:
+                return nested
+    if payload.get("mimeType") == "text/plain":
+        return legacy_decode_base64(payload.get("body", {}).get("data", ""))
+    return None
+
+
+def encode(text):
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def text_part(mime_type, text):
+    return {"mimeType": mime_type, "headers": [{"name": "Content-Type", "value": f"{mime_type}; charset=UTF-8"}],
+            "body": {"size": len(text), "data": encode(text)}}
+
+
+def newsletter_html(size):
+    rng = random.Random(1)
+    style = "<style>" + ".c%d{color:#%06x;padding:4px}" * 400 % tuple(
+        value for i in range(400) for value in (i, rng.randrange(1 << 24))) + "</style>"
+    rows = []
+    while sum(map(len, rows)) < size:
+        rows.append(f"<tr><td class=\"c{len(rows) % 400}\"><a href=\"https://example.com/{len(rows)}\">"
+                    f"Story {len(rows)}: markets, product launches &amp; more</a></td></tr>")
+    return f"<html><head>{style}</head><body><p>This week's highlights</p><table>{''.join(rows)}</table></body></html>"
+
+
+def fixtures(size):
+    html = newsletter_html(size)
+    plain = "Newsletter\n" + "Story text paragraph with links and more words.\n" * (size // 48)
+    chain = "Sounds good, see you at 3pm on Thursday.\n\nOn Tue, 1 Apr 2025, Bob <bob@example.com> wrote:\n"
+    chain += "> Earlier message in the thread, quoted again and again.\n" * (size // 56)
+    deep = text_part("text/plain", "Deeply nested body.")
+    for _ in range(2000):
+        deep = {"mimeType": "multipart/mixed", "parts": [deep]}
+    attachment = base64.urlsafe_b64encode(random.Random(2).randbytes(size)).decode("ascii")
+    return {
+        "newsletter (plain + html)": {"mimeType": "multipart/alternative",
+                                      "parts": [text_part("text/plain", plain), text_part("text/html", html)]},
+        "html-only newsletter": {"mimeType": "multipart/alternative", "parts": [text_part("text/html", html)]},
+        "reply chain": text_part("text/plain", chain),
+        "2000-level nesting": deep,
+        "attachments + short text": {"mimeType": "multipart/mixed", "parts": [
+            {"mimeType": "application/pdf", "filename": f"report{i}.pdf", "body": {"data": attachment}}
+            for i in range(3)
+        ] + [text_part("text/plain", "Please see the attached reports.")]},
+    }
+
+
+def measure(extract, payload, repeat):
+    try:
+        tracemalloc.start()
+        result = extract(payload)
+        _, peak = tracemalloc.get_traced_memory()
+    except RecursionError:
+        return {"error": "RecursionError"}
+    finally:
+        tracemalloc.stop()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        extract(payload)
+    elapsed = (time.perf_counter() - started) / repeat
+    return {"ms": elapsed * 1000, "peak_kb": peak / 1024, "kept": len(preview(result) or "")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=2.0, help="size of each large part")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    sys.setrecursionlimit(1000)
+
+    print(f"{'fixture':28} {'extractor':10} {'ms/msg':>9} {'peak KB':>10} {'kept chars':>11}")
+    for name, payload in fixtures(int(args.size_mb * 1024 * 1024)).items():
+        for label, extract in (("legacy", legacy_extract), ("mime_body", extract_body)):
+            result = measure(extract, payload, args.repeat)
+            if "error" in result:
+                print(f"{name:28} {label:10} {result['error']:>32}")
+            else:
+                print(f"{name:28} {label:10} {result['ms']:9.2f} {result['peak_kb']:10.0f} {result['kept']:11d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Classifies a synthetic inbox against the local LLM stub and prints how many calls
+the token-budgeted batcher made, wall time, and per-batch tokens and latency.
+With --corrupt, the stub answers the first N requests with invalid JSON to show
+failed batches being bisected and retried instead of dropped. With --outage, every
+request fails (without gateway retries); the run must give up after one call per
+batch instead of bisecting, or the script exits non-zero.
+
+    python bench_classifier.py --emails 100 --llm-latency 0.5 --corrupt 1
+    python bench_classifier.py --emails 100 --outage
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import openai
+from stubs import FakeOpenAIServer, fake_llm_reply, make_fake_message
+from message_parser import parse_message
+import classifier
+import llm_cache
+import llm_gateway
+
+
+class OutageBackend:
+    """A gateway backend whose every request fails like an unavailable API."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def create(self, timeout=None, **request):
+        self.calls += 1
+        raise openai.error.ServiceUnavailableError("stub outage")
+
+
+def outage(emails):
+    llm_cache.set_backend(llm_cache.MemoryCache())
+    llm_gateway.LLM_MAX_RETRIES = 0
+    backend = OutageBackend()
+    llm_gateway.set_backend(backend)
+    batches = len(classifier.plan_classify_batches(emails))
+    try:
+        classifier.classify_emails(emails)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    print(json.dumps({"emails": len(emails), "batches": batches, "llm_calls": backend.calls, "error": error}))
+    ok = error is not None and backend.calls <= batches
+    print(f"{'ok  ' if ok else 'FAIL'} outage raised after one call per batch")
+    sys.exit(0 if ok else 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=100)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--token-budget", type=int, default=None)
+    parser.add_argument("--corrupt", type=int, default=0, help="answer this many requests with invalid JSON")
+    parser.add_argument("--outage", action="store_true", help="fail every request")
+    args = parser.parse_args()
+
+    emails = [parse_message(make_fake_message(i)) for i in range(args.emails)]
+    if args.outage:
+        outage(emails)
+    corrupt = {"left": args.corrupt}
+    lock = threading.Lock()
+
+    def reply(messages):
+        with lock:
+            if corrupt["left"] > 0:
+                corrupt["left"] -= 1
+                return "Sure! Here are the important emails: msg00001, msg00002"
+        return fake_llm_reply(messages)
+
+    with FakeOpenAIServer(reply=reply, latency=args.llm_latency) as llm:
+        openai.api_base = llm.api_base
+        openai.api_key = "sk-stub"
+        llm_cache.set_backend(llm_cache.MemoryCache())
+        started = time.perf_counter()
+        important = json.loads(classifier.classify_emails(emails, token_budget=args.token_budget))
+        elapsed = time.perf_counter() - started
+        stats = classifier.classify_batch_stats()
+        print(json.dumps({
+            "emails": len(emails),
+            "important": len(important),
+            "llm_calls": llm.completions,
+            "seconds": round(elapsed, 3),
+            "failed_batches": stats["failed_batches"],
+            "bisections": stats["bisections"],
+        }))
+        for batch in stats["recent"]:
+            print("batch", json.dumps({key: batch[key] for key in ("emails", "prompt_tokens", "completion_tokens", "latency_s", "ok")}))
+
+
+if __name__ == "__main__":
+    main()
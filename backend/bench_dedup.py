@@ -0,0 +1,158 @@
+"""
+Measures what thread-aware and near-duplicate collapsing saves in the pipeline.
+
+Builds an inbox of reply chains (2-12 messages per thread), bursts of near-identical
+notifications (build results, with numbers and links that differ) and one-off
+emails, then runs pipeline.process_messages over it against the local Gmail and LLM
+stubs with dedup off and on, from a cold LLM cache each time. Prints the LLM
+requests, classified and summarized emails and tokens for both, and exits non-zero
+unless dedup kept every one-off important email, left exactly one entry per
+important thread and at least one per important burst, and saved LLM requests. A
+last run lists the messages oldest first, so older messages of a thread arrive
+before newer ones, and every thread's entry must still be its newest message.
+
+    python bench_dedup.py --threads 20 --bursts 5 --singles 60
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import openai
+from stubs import FakeGmailServer, FakeOpenAIServer, make_fake_message
+import gmail_batch
+import llm_cache
+import pipeline
+from classifier import classify_batch_stats
+from dedup import dedup_stats
+from llm_gateway import gateway_stats
+
+
+def fake(index, thread, sender, subject, text):
+    message = make_fake_message(index, body=text)
+    message["threadId"] = thread
+    message["payload"]["headers"] = [{"name": "Subject", "value": subject}, {"name": "From", "value": sender}]
+    return message
+
+
+def dedup_inbox(threads, bursts, singles, seed=0):
+    """Returns (messages newest first, {message id: ("thread"|"burst"|"single", group key)})."""
+    rng = random.Random(seed)
+    groups = []
+    for t in range(threads):
+        people = [f"Person {t}-{p} <person{t}.{p}@example.com>" for p in range(3)]
+        groups.append([("thread", f"t{t}", f"thread-chain{t:03d}", people[n % 3], f"Re: Project {t} plan",
+                        f"Reply {n} on project {t}: {rng.choice(['Can we move the deadline?', 'Sounds good to me.', 'I pushed the changes, could you review?'])}")
+                       for n in range(rng.randint(2, 12))])
+    for b in range(bursts):
+        outcome = "failed, can you take a look?" if b % 2 == 0 else "passed"
+        groups.append([("burst", f"b{b}", f"thread-burst{b}-{n}", f"CI <ci{b}@builds.example.com>", f"Build #{4100 + n} {outcome.split(',')[0]}",
+                        f"Build #{4100 + n} of pipeline {b} on main {outcome} Details at https://ci.example.com/runs/{4100 + n}")
+                       for n in range(rng.randint(5, 15))])
+    for s in range(singles):
+        question = "Are you free on Thursday?" if s % 3 == 0 else "Here is the weekly report."
+        groups.append([("single", f"s{s}", f"thread-single{s}", f"Sender {s} <sender{s}@example.com>", f"Note {s}",
+                        f"Message {s} about topic {s * 7}. {question}")])
+
+    # Interleave the groups, newest message of each group first
+    queue = [list(group) for group in groups]
+    rng.shuffle(queue)
+    ordered = []
+    while queue:
+        group = queue.pop(rng.randrange(len(queue)))
+        ordered.append(group.pop(0))
+        if group:
+            queue.append(group)
+    now_ms = int(time.time() * 1000)
+    messages, kinds = [], {}
+    for i, (kind, key, thread, sender, subject, text) in enumerate(ordered):
+        message = fake(i, thread, sender, subject, text)
+        message["internalDate"] = str(now_ms - i * 60000)
+        messages.append(message)
+        kinds[message["id"]] = (kind, key)
+    return messages, kinds
+
+
+def run(service, llm, message_ids, dedup):
+    llm_cache.set_backend(llm_cache.MemoryCache())
+    before = (llm.round_trips, classify_batch_stats()["emails"], gateway_stats(), dedup_stats())
+    started = time.perf_counter()
+    emails = asyncio.run(pipeline.process_messages(service, message_ids, dedup=dedup))
+    tokens = gateway_stats()
+    stats = dedup_stats()
+    return emails, {
+        "seconds": round(time.perf_counter() - started, 3),
+        "llm_requests": llm.round_trips - before[0],
+        "classified_emails": classify_batch_stats()["emails"] - before[1],
+        "important_entries": len(emails),
+        "prompt_tokens": tokens["prompt_tokens"] - before[2]["prompt_tokens"],
+        "completion_tokens": tokens["completion_tokens"] - before[2]["completion_tokens"],
+        "thread_collapsed": stats["thread_collapsed"] - before[3]["thread_collapsed"],
+        "near_duplicate_collapsed": stats["near_duplicate_collapsed"] - before[3]["near_duplicate_collapsed"],
+        "classify_calls_avoided": stats["classify_calls_avoided"] - before[3]["classify_calls_avoided"],
+        "collapsed_into_summaries": stats["collapsed_into_summaries"] - before[3]["collapsed_into_summaries"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=20)
+    parser.add_argument("--bursts", type=int, default=6)
+    parser.add_argument("--singles", type=int, default=60)
+    parser.add_argument("--gmail-latency", type=float, default=0.02)
+    parser.add_argument("--llm-latency", type=float, default=0.1)
+    args = parser.parse_args()
+
+    inbox, kinds = dedup_inbox(args.threads, args.bursts, args.singles)
+    message_ids = [message["id"] for message in inbox]
+    with FakeGmailServer(inbox, latency=args.gmail_latency) as gmail, \
+            FakeOpenAIServer(latency=args.llm_latency) as llm:
+        openai.api_base = llm.api_base
+        openai.api_key = "sk-stub"
+        gmail_batch.GMAIL_BATCH_URI = gmail.batch_uri
+        service = gmail.build_service()
+        baseline_emails, baseline = run(service, llm, message_ids, dedup=False)
+        dedup_emails, deduped = run(service, llm, message_ids, dedup=True)
+        reversed_emails, _ = run(service, llm, message_ids[::-1], dedup=True)
+
+    print(f"messages {len(inbox)}")
+    print("dedup off", json.dumps(baseline))
+    print("dedup on ", json.dumps(deduped))
+    saved = baseline["llm_requests"] - deduped["llm_requests"]
+    print(f"LLM requests saved: {saved} of {baseline['llm_requests']} "
+          f"({100 * saved / max(1, baseline['llm_requests']):.0f}%), prompt tokens saved: "
+          f"{baseline['prompt_tokens'] - deduped['prompt_tokens']}")
+
+    def by_group(emails, kind):
+        groups = {}
+        for email in emails:
+            group_kind, key = kinds[email["id"]]
+            if group_kind == kind:
+                groups[key] = groups.get(key, 0) + 1
+        return groups
+
+    newest = {}
+    for message_id in message_ids:
+        newest.setdefault(kinds[message_id], message_id)
+
+    def newest_of_threads(emails):
+        return all(email["id"] == newest[kinds[email["id"]]] for email in emails if kinds[email["id"]][0] == "thread")
+
+    checks = {
+        "every one-off important email kept": by_group(baseline_emails, "single") == by_group(dedup_emails, "single"),
+        "one entry per important thread":
+            by_group(dedup_emails, "thread") == {key: 1 for key in by_group(baseline_emails, "thread")},
+        "important bursts still reported": set(by_group(dedup_emails, "burst")) == set(by_group(baseline_emails, "burst")),
+        "fewer LLM requests": saved > 0,
+        "thread entries are the newest message": newest_of_threads(dedup_emails),
+        "same, with messages listed oldest first": newest_of_threads(reversed_emails)
+            and by_group(reversed_emails, "thread") == by_group(dedup_emails, "thread"),
+    }
+    for name, ok in checks.items():
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
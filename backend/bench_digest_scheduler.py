@@ -0,0 +1,120 @@
+"""
+Simulates the morning spike against the local Gmail, OpenAI and Supabase stubs:
+every user's summary_time is a few minutes away, the digest scheduler precomputes
+their grouped summaries, and then all users request /emails/grouped_summary at
+once. Prints precompute time and request latency percentiles for stored digests
+versus live computation (refresh=true). Exits non-zero unless the stored digests
+were served without touching Gmail, and a user's stored digest is dropped once new
+important mail of theirs has been processed.
+
+    python bench_digest_scheduler.py --users 20 --emails 100 --workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import requests
+from stubs import FakeGmailServer, FakeOpenAIServer, FakeSupabaseServer, make_fake_message, percentile, serve_app, stub_env
+
+
+async def precompute(scheduler, users):
+    """Plans the upcoming slot and waits until every queued digest has been built."""
+    started = time.perf_counter()
+    scheduler.start()
+    await scheduler.plan_once()
+    while scheduler.counters["succeeded"] + scheduler.counters["failed"] < users:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    await scheduler.stop()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--emails", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    now_ms = int(time.time() * 1000)
+    inbox = [make_fake_message(i, important=(i % 5 == 0)) for i in range(args.emails)]
+    for i, message in enumerate(inbox):
+        message["internalDate"] = str(now_ms - i * 60000)
+    summary_time = (datetime.now() + timedelta(minutes=5)).strftime("%H:%M")
+    users = [f"user{n}@example.com" for n in range(args.users)]
+
+    with FakeGmailServer(inbox, latency=0.05) as gmail, \
+            FakeOpenAIServer(latency=args.llm_latency) as llm, \
+            FakeSupabaseServer({"users": [
+                {"email": user, "access_token": "stub", "refresh_token": "stub", "summary_time": summary_time}
+                for user in users
+            ]}) as supabase:
+        # Every live run must do its own refresh rather than reuse the previous one
+        os.environ.update(stub_env(gmail, llm, supabase, IMPORTANT_EMAILS_MEMO_SECONDS=0))
+        # Backend modules read their configuration at import time
+        import llm_cache
+        import main as app_module
+        from digest_scheduler import DigestScheduler, MemoryJobQueue
+
+        scheduler = DigestScheduler(MemoryJobQueue(), workers=args.workers, poll_seconds=1)
+        precompute_s = asyncio.run(precompute(scheduler, len(users)))
+        print("precompute", json.dumps({"seconds": round(precompute_s, 3), **scheduler.stats()}))
+
+        server, port = serve_app(app_module.app)
+        url = f"http://127.0.0.1:{port}/emails/grouped_summary"
+
+        def request(user, refresh):
+            started = time.perf_counter()
+            response = requests.get(url, params={"user_email": user, "refresh": refresh}, timeout=600)
+            response.raise_for_status()
+            return time.perf_counter() - started
+
+        gmail_requests = {}
+        for name, refresh in (("stored", False), ("live", True)):
+            before = gmail.round_trips
+            # Live requests start from an empty mailbox store and LLM cache so they redo the full refresh
+            if refresh:
+                llm_cache.set_backend(llm_cache.MemoryCache())
+                supabase.tables["processed_emails"] = []
+                for row in supabase.tables["users"]:
+                    row.pop("history_id", None)
+                for user in users:
+                    app_module.evict_user(user)
+            with ThreadPoolExecutor(max_workers=len(users)) as pool:
+                samples = list(pool.map(lambda user: request(user, refresh), users))
+            gmail_requests[name] = gmail.round_trips - before
+            print(name, json.dumps({
+                "p50_ms": round(percentile(samples, 50) * 1000, 1),
+                "p95_ms": round(percentile(samples, 95) * 1000, 1),
+                "p99_ms": round(percentile(samples, 99) * 1000, 1),
+            }))
+
+        # New important mail must not be left out of a digest served from the store
+        def has_digest(user):
+            return any(row["user_email"] == user for row in supabase.tables["digests"])
+
+        stored_before = has_digest(users[0])
+        message = make_fake_message(args.emails, important=True)
+        message["internalDate"] = str(int(time.time() * 1000))
+        gmail.add_message(message)
+        requests.get(f"http://127.0.0.1:{port}/emails/important_full", params={"user_email": users[0]},
+                     timeout=600).raise_for_status()
+        dropped = stored_before and not has_digest(users[0])
+        server.should_exit = True
+
+    checks = {
+        "stored digests served without Gmail traffic": gmail_requests["stored"] == 0,
+        "stored digest dropped after new important mail": dropped,
+    }
+    for name, ok in checks.items():
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+End-to-end benchmark suite. Serves main.py against the local Gmail, OpenAI and
+Supabase stubs with synthetic inboxes of several sizes and measures each scenario:
+
+    important_full    GET /emails/important_full, cold mailbox
+    grouped_summary   GET /emails/grouped_summary?refresh=true, cold mailbox
+    classify          classifier.classify_emails over the whole inbox
+    vector_index      retrieval.index_emails over the whole inbox
+
+Every (scenario, inbox size) pair runs in a fresh Python process, so peak RSS and
+caches are per case. Each run uses its own user, so every run starts cold. Results
+are written as JSON (latency p50/p95/p99, throughput, upstream calls, LLM tokens,
+peak RSS) and can be compared with an earlier file:
+
+    python bench_e2e.py --sizes 10,100,1000,10000 --runs 3 --output bench_results.json
+    python bench_e2e.py --output after.json --compare bench_results.json
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime
+from stubs import FakeGmailServer, FakeOpenAIServer, FakeSupabaseServer, make_fake_message, percentile, serve_app, stub_env
+
+SCENARIOS = ["important_full", "grouped_summary", "classify", "vector_index"]
+WHOLE_INBOX = {"classify", "vector_index"}
+COMPARED_METRICS = ["p50_ms", "p95_ms", "llm_requests", "gmail_requests", "prompt_tokens", "peak_rss_mb"]
+
+
+def bench_user(run):
+    return f"bench{run}@example.com"
+
+
+def synthetic_inbox(size):
+    """A deterministic inbox: 1 in 5 Gmail-important, 2 in 3 asking a question, all from the last day."""
+    now_ms = int(time.time() * 1000)
+    inbox = []
+    for i in range(size):
+        body = None if i % 3 else f"Weekly update number {i}. Nothing to do, no reply needed."
+        message = make_fake_message(i, important=(i % 5 == 0), body=body)
+        message["internalDate"] = str(now_ms - i * 5000)
+        inbox.append(message)
+    return inbox
+
+
+def run_case(scenario, size, runs):
+    """Runs one scenario `runs` times in this process; the stubs are reached through the environment."""
+    import requests
+    import llm_cache
+    import main as app_module
+    from classifier import classify_emails
+    from llm_gateway import gateway_stats
+    from message_parser import parse_message
+    from retrieval import index_emails
+
+    records = [parse_message(message) for message in synthetic_inbox(size)] if scenario in WHOLE_INBOX else []
+    server = None
+    if scenario in ("important_full", "grouped_summary"):
+        server, port = serve_app(app_module.app)
+
+    def run_once(run):
+        user = bench_user(run)
+        if scenario == "important_full":
+            response = requests.get(f"http://127.0.0.1:{port}/emails/important_full",
+                                    params={"user_email": user}, timeout=3600)
+            response.raise_for_status()
+        elif scenario == "grouped_summary":
+            response = requests.get(f"http://127.0.0.1:{port}/emails/grouped_summary",
+                                    params={"user_email": user, "refresh": True}, timeout=3600)
+            response.raise_for_status()
+        elif scenario == "classify":
+            classify_emails([dict(record) for record in records])
+        elif scenario == "vector_index":
+            index_emails(user, records)
+
+    tokens_before = gateway_stats()
+    samples = []
+    errors = []
+    for run in range(runs):
+        llm_cache.set_backend(llm_cache.MemoryCache())
+        started = time.perf_counter()
+        try:
+            run_once(run)
+            samples.append(time.perf_counter() - started)
+        except Exception as e:
+            errors.append(str(e)[:200])
+    tokens_after = gateway_stats()
+    if server is not None:
+        server.should_exit = True
+    return {
+        "samples": samples,
+        "errors": errors,
+        "prompt_tokens": tokens_after["prompt_tokens"] - tokens_before["prompt_tokens"],
+        "completion_tokens": tokens_after["completion_tokens"] - tokens_before["completion_tokens"],
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def summarize_case(scenario, size, runs, case, calls):
+    samples = case["samples"]
+    total = sum(samples)
+    return {
+        "scenario": scenario,
+        "size": size,
+        "runs": runs,
+        "ok": len(samples),
+        "errors": len(case["errors"]),
+        "first_error": case["errors"][0] if case["errors"] else None,
+        "p50_ms": round(percentile(samples, 50) * 1000, 1),
+        "p95_ms": round(percentile(samples, 95) * 1000, 1),
+        "p99_ms": round(percentile(samples, 99) * 1000, 1),
+        "requests_per_s": round(len(samples) / total, 3) if total else 0.0,
+        # The HTTP scenarios only process the part of the inbox the endpoint looks at
+        "messages_per_s": round(size * len(samples) / total, 1) if total and scenario in WHOLE_INBOX else None,
+        **calls,
+        "prompt_tokens": case["prompt_tokens"],
+        "completion_tokens": case["completion_tokens"],
+        "peak_rss_mb": case["peak_rss_mb"],
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(results, baseline_path):
+    """Prints each metric as baseline -> current for the cases both files have."""
+    with open(baseline_path) as f:
+        baseline = {(r["scenario"], r["size"]): r for r in json.load(f)["results"]}
+    for result in results:
+        before = baseline.get((result["scenario"], result["size"]))
+        if before is None:
+            continue
+        changes = []
+        for metric in COMPARED_METRICS:
+            old, new = before.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            ratio = f" ({new / old:.2f}x)" if old else ""
+            changes.append(f"{metric} {old} -> {new}{ratio}")
+        print(f"{result['scenario']:16} {result['size']:>6}  " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000,10000")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--gmail-latency", type=float, default=0.05)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--supabase-latency", type=float, default=0.005)
+    parser.add_argument("--gmail-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="an earlier --output file to compare against")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        scenario, size = args.case.split(":")
+        print(json.dumps(run_case(scenario, int(size), args.runs)))
+        return
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    scenarios = args.scenarios.split(",")
+    results = []
+    with FakeGmailServer([], latency=args.gmail_latency, error_rate=args.gmail_error_rate, error_status=503) as gmail, \
+            FakeOpenAIServer(latency=args.llm_latency, error_rate=args.llm_error_rate, error_status=503) as llm, \
+            FakeSupabaseServer({"users": []}, latency=args.supabase_latency) as supabase:
+        env = dict(os.environ, **stub_env(gmail, llm, supabase))
+        for size in sizes:
+            gmail.messages = {message["id"]: message for message in synthetic_inbox(size)}
+            for scenario in scenarios:
+                supabase.tables.update({"processed_emails": [], "digests": [], "users": [
+                    {"email": bench_user(run), "access_token": "stub", "refresh_token": "stub"}
+                    for run in range(args.runs)
+                ]})
+                before = {"gmail": gmail.round_trips, "gets": gmail.message_gets, "llm": llm.round_trips,
+                          "supabase": supabase.round_trips}
+                child = subprocess.run(
+                    [sys.executable, __file__, "--case", f"{scenario}:{size}", "--runs", str(args.runs)],
+                    env=env, capture_output=True, text=True
+                )
+                if child.returncode != 0:
+                    print(f"{scenario} {size} crashed:\n{child.stderr[-2000:]}", file=sys.stderr)
+                    continue
+                calls = {
+                    "gmail_requests": gmail.round_trips - before["gmail"],
+                    "gmail_message_gets": gmail.message_gets - before["gets"],
+                    "llm_requests": llm.round_trips - before["llm"],
+                    "supabase_requests": supabase.round_trips - before["supabase"],
+                }
+                case = json.loads(child.stdout.strip().splitlines()[-1])
+                result = summarize_case(scenario, size, args.runs, case, calls)
+                results.append(result)
+                print(json.dumps(result))
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("case", "output", "compare")},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
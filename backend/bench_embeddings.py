@@ -0,0 +1,181 @@
+"""
+Embedding backend benchmark: full-precision PyTorch (SentenceTransformer) against
+the int8-quantized ONNX Runtime export (export_onnx_embedder.py), plus the in-process
+fake backend, which needs neither and exercises only the batching around the model.
+
+Each backend runs in a fresh Python process, so load time and peak RSS are its own.
+In it, the texts of a synthetic inbox are encoded
+  - sequentially, one text per call (how encode_email and search queries call it),
+  - from --threads concurrent callers, one text per call, without the MicroBatcher
+    (window 0) and with it (EMBEDDING_BATCH_WINDOW_MS),
+  - in one bulk call (how the vector index and pre-classifier call it).
+With both real backends available, the parent compares their vectors: the cosine of
+each text's ONNX vector to its PyTorch vector, and how many of the top 5 neighbours
+of each text agree. Backends whose packages or model files are missing are skipped.
+
+Exits non-zero if batching did not raise concurrent throughput on the fake backend,
+or if the ONNX vectors drifted below --min-cosine.
+
+    python export_onnx_embedder.py   # once, needs torch and sentence-transformers
+    python bench_embeddings.py --texts 500 --threads 8
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BACKENDS = ["fake", "torch", "onnx"]
+
+
+def bench_texts(count):
+    from bench_e2e import synthetic_inbox
+    from embeddings import email_text
+    from message_parser import parse_message
+    return [email_text(parse_message(message)) for message in synthetic_inbox(count)]
+
+
+def concurrent_encode(texts, threads):
+    """Encodes every text with its own encode_texts call from `threads` threads. Returns texts per second."""
+    from embeddings import encode_texts
+    pending = list(texts)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                text = pending.pop()
+            encode_texts([text])
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return len(texts) / (time.perf_counter() - started)
+
+
+def run_case(backend, count, threads, vectors_path):
+    """Measures one backend in this process and saves its bulk vectors to `vectors_path`."""
+    import numpy as np
+    import embeddings
+    texts = bench_texts(count)
+
+    started = time.perf_counter()
+    if backend == "fake":
+        # Roughly MiniLM's cost on one CPU core: a fixed per-call overhead plus per-text work
+        embedder = embeddings.FakeEmbedder(call_seconds=0.004, text_seconds=0.0005)
+    else:
+        embedder = embeddings.BACKENDS[backend]()
+    embeddings.set_embedder(embedder)
+    load_seconds = time.perf_counter() - started
+    embedder.encode(texts[:8])
+
+    result = {"backend": backend, "texts": count, "load_s": round(load_seconds, 3)}
+    embeddings.set_batcher(embeddings.MicroBatcher(window=0))
+    started = time.perf_counter()
+    for text in texts:
+        embeddings.encode_texts([text])
+    result["sequential_texts_per_s"] = round(count / (time.perf_counter() - started), 1)
+    result["concurrent_unbatched_texts_per_s"] = round(concurrent_encode(texts, threads), 1)
+
+    batcher = embeddings.MicroBatcher()
+    embeddings.set_batcher(batcher)
+    result["concurrent_batched_texts_per_s"] = round(concurrent_encode(texts, threads), 1)
+    result["texts_per_model_call"] = embeddings.embedding_stats()["texts_per_model_call"]
+
+    started = time.perf_counter()
+    vectors = embeddings.encode_texts(texts)
+    result["bulk_texts_per_s"] = round(count / (time.perf_counter() - started), 1)
+    np.save(vectors_path, vectors)
+    # ru_maxrss is in kilobytes on Linux
+    result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return result
+
+
+def drift(reference, candidate, k=5):
+    """Per-text cosine between the two backends' vectors, and mean top-k neighbour overlap."""
+    import numpy as np
+    cosines = np.sum(reference * candidate, axis=1)
+    k = min(k, len(reference) - 1)
+    overlap = 0.0
+    if k > 0:
+        def neighbours(vectors):
+            scores = vectors @ vectors.T
+            np.fill_diagonal(scores, -np.inf)
+            return np.argsort(-scores, axis=1)[:, :k]
+        overlap = float(np.mean([len(set(a) & set(b)) / k for a, b in zip(neighbours(reference), neighbours(candidate))]))
+    return {
+        "mean_cosine": round(float(cosines.mean()), 5),
+        "min_cosine": round(float(cosines.min()), 5),
+        f"top{k}_overlap": round(overlap, 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--texts", type=int, default=300)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--min-cosine", type=float, default=0.98)
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--vectors", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        try:
+            result = run_case(args.case, args.texts, args.threads, args.vectors)
+        except Exception as e:
+            result = {"backend": args.case, "error": f"{type(e).__name__}: {e}"}
+        print(json.dumps(result))
+        return
+
+    import numpy as np
+    results = {}
+    vectors = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in args.backends.split(","):
+            path = os.path.join(directory, f"{backend}.npy")
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--case", backend, "--texts", str(args.texts),
+                 "--threads", str(args.threads), "--vectors", path],
+                capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+            )
+            lines = [line for line in output.stdout.splitlines() if line.startswith("{")]
+            result = json.loads(lines[-1]) if lines else {"backend": backend, "error": output.stderr.strip()[-300:]}
+            results[backend] = result
+            if "error" in result:
+                print(f"{backend:6} skipped: {result['error']}")
+                continue
+            vectors[backend] = np.load(path)
+            print(f"{backend:6} {json.dumps(result)}")
+
+    checks = {}
+    if "fake" in results and "error" not in results["fake"]:
+        fake = results["fake"]
+        checks["batching raises concurrent throughput"] = \
+            fake["concurrent_batched_texts_per_s"] > fake["concurrent_unbatched_texts_per_s"]
+    if "torch" in vectors and "onnx" in vectors:
+        onnx_drift = drift(vectors["torch"], vectors["onnx"])
+        print(f"drift  {json.dumps(onnx_drift)}")
+        torch_result, onnx_result = results["torch"], results["onnx"]
+        print(f"onnx/torch bulk throughput x{onnx_result['bulk_texts_per_s'] / torch_result['bulk_texts_per_s']:.2f}, "
+              f"sequential x{onnx_result['sequential_texts_per_s'] / torch_result['sequential_texts_per_s']:.2f}, "
+              f"peak RSS {onnx_result['peak_rss_mb'] - torch_result['peak_rss_mb']:+.1f} MB")
+        checks[f"ONNX vectors within cosine {args.min_cosine} of PyTorch"] = onnx_drift["min_cosine"] >= args.min_cosine
+    else:
+        print("drift  skipped: needs both the torch and onnx backends")
+    for name, ok in checks.items():
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Measures fan-out digest throughput (users/min) against the local Gmail, OpenAI and
+Supabase stubs, for several process / per-process concurrency settings, then
+interrupts a run halfway and resumes it from its checkpoint, and kills a worker
+process mid-run and checks that the run fails instead of hanging and resumes.
+
+    python bench_fanout.py --users 40 --emails 50 --llm-latency 0.2
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+from stubs import FakeGmailServer, FakeOpenAIServer, FakeSupabaseServer, make_fake_message, stub_env
+
+CONFIGS = [(1, 1), (1, 8), (2, 8), (4, 8)]
+
+
+class Interrupted(Exception):
+    pass
+
+
+def reset_mailboxes(supabase):
+    """Forgets every user's sync state so the next run does the full pipeline again."""
+    supabase.tables["processed_emails"] = []
+    supabase.tables["digests"] = []
+    for row in supabase.tables["users"]:
+        row.pop("history_id", None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--emails", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--gmail-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    now_ms = int(time.time() * 1000)
+    inbox = [make_fake_message(i, important=(i % 5 == 0)) for i in range(args.emails)]
+    for i, message in enumerate(inbox):
+        message["internalDate"] = str(now_ms - i * 60000)
+    users = [f"user{n}@example.com" for n in range(args.users)]
+
+    with FakeGmailServer(inbox, latency=args.gmail_latency, personalize=True) as gmail, \
+            FakeOpenAIServer(latency=args.llm_latency) as llm, \
+            FakeSupabaseServer({"users": [
+                {"email": user, "access_token": f"token{n}", "refresh_token": "stub", "summary_time": "08:00"}
+                for n, user in enumerate(users)
+            ]}) as supabase, tempfile.TemporaryDirectory() as tmp:
+        # Worker processes are spawned and read their configuration from the environment
+        os.environ.update(stub_env(gmail, llm, supabase))
+        from fanout import run_fanout
+
+        for processes, users_per_process in CONFIGS:
+            reset_mailboxes(supabase)
+            llm_calls = llm.round_trips
+            summary = run_fanout(
+                run_id=f"bench-{processes}x{users_per_process}", processes=processes,
+                users_per_process=users_per_process, checkpoint_path=os.path.join(tmp, "checkpoint.sqlite3")
+            )
+            print(f"{processes} processes x {users_per_process} users", json.dumps(
+                {**summary, "llm_calls": llm.round_trips - llm_calls}
+            ))
+
+        reset_mailboxes(supabase)
+        checkpoint_path = os.path.join(tmp, "resume.sqlite3")
+        finished = []
+
+        def stop_halfway(result):
+            finished.append(result)
+            if len(finished) == len(users) // 2:
+                raise Interrupted()
+
+        try:
+            run_fanout(run_id="resume", processes=2, checkpoint_path=checkpoint_path, on_result=stop_halfway)
+        except Interrupted:
+            pass
+        summary = run_fanout(run_id="resume", processes=2, checkpoint_path=checkpoint_path)
+        print("resumed after interrupt", json.dumps(summary))
+
+        reset_mailboxes(supabase)
+        checkpoint_path = os.path.join(tmp, "killed.sqlite3")
+        killed = []
+
+        def kill_worker(result):
+            if not killed:
+                killed.append(result["pid"])
+                os.kill(result["pid"], signal.SIGKILL)
+
+        error = None
+        try:
+            run_fanout(run_id="killed", processes=2, checkpoint_path=checkpoint_path, on_result=kill_worker)
+        except RuntimeError as e:
+            error = str(e)
+        summary = run_fanout(run_id="killed", processes=2, checkpoint_path=checkpoint_path)
+        print("resumed after a worker died", json.dumps({"error": error, **summary}))
+        finished = summary["skipped"] + summary["succeeded"] == len(users)
+        print(f"{'ok  ' if finished else 'FAIL'} every user finished after a worker died")
+        sys.exit(0 if finished else 1)
+
+
+if __name__ == "__main__":
+    main()
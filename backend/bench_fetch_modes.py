@@ -0,0 +1,58 @@
+"""
+Compares Gmail bandwidth and latency of the two fetch modes in pipeline.py against
+the local stubs: "full" (every message fetched in full) and "two_tier" (metadata for
+classification, full bodies only for important emails). A share of the inbox
+carries inline attachments, as real mail does.
+
+    python bench_fetch_modes.py --emails 200 --attachment-rate 0.3 --attachment-kb 200
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import openai
+from stubs import FakeGmailServer, FakeOpenAIServer, make_fake_message
+import gmail_batch
+import llm_cache
+import pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=200)
+    parser.add_argument("--attachment-rate", type=float, default=0.3)
+    parser.add_argument("--attachment-kb", type=int, default=200)
+    parser.add_argument("--gmail-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    inbox = []
+    for i in range(args.emails):
+        attachment = args.attachment_kb * 1024 if rng.random() < args.attachment_rate else 0
+        body = None if i % 5 == 0 else f"Weekly update number {i}. Nothing to do."
+        inbox.append(make_fake_message(i, important=(i % 7 == 0), body=body, attachment_bytes=attachment))
+    message_ids = [m["id"] for m in inbox]
+
+    with FakeGmailServer(inbox, latency=args.gmail_latency) as gmail, FakeOpenAIServer() as llm:
+        openai.api_base = llm.api_base
+        openai.api_key = "sk-stub"
+        gmail_batch.GMAIL_BATCH_URI = gmail.batch_uri
+        service = gmail.build_service()
+        for mode in ("full", "two_tier"):
+            pipeline.GMAIL_FETCH_MODE = mode
+            llm_cache.set_backend(llm_cache.MemoryCache())
+            fetch_stats = pipeline.new_fetch_stats()
+            started = time.perf_counter()
+            emails = asyncio.run(pipeline.process_messages(service, message_ids, fetch_stats=fetch_stats))
+            elapsed = time.perf_counter() - started
+            print(mode, json.dumps({
+                "important_emails": len(emails),
+                "seconds": round(elapsed, 3),
+                "total_mb": round(sum(tier["bytes"] for tier in fetch_stats.values()) / 2 ** 20, 2),
+                **fetch_stats,
+            }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Compares time-to-first-byte of /emails/grouped_summary with its streaming variant,
+/emails/grouped_summary/stream, by serving main.py with uvicorn against the local
+Gmail, OpenAI and Supabase stubs. Every run starts from a cold mailbox and LLM cache.
+
+The streamed response is also checked for the documented event order: "email"
+events, then "token" events, then a single "done".
+
+    python bench_grouped_stream.py --emails 200 --runs 3 --llm-latency 0.5
+"""
+import argparse
+import json
+import os
+import time
+import requests
+from stubs import FakeGmailServer, FakeOpenAIServer, FakeSupabaseServer, make_fake_message, percentile, serve_app, stub_env
+
+USER = "bench@example.com"
+
+
+def timed_get(url, params, stream):
+    """Returns (seconds to first body byte, total seconds, body lines)."""
+    started = time.perf_counter()
+    first_byte = None
+    lines = []
+    with requests.get(url, params=params, stream=stream, timeout=600) as response:
+        if not response.ok:
+            raise RuntimeError(f"{response.status_code}: {response.text}")
+        for line in response.iter_lines(decode_unicode=True):
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            lines.append(line)
+    return first_byte, time.perf_counter() - started, lines
+
+
+def check_event_order(lines):
+    events = [line[len("event: "):] for line in lines if line.startswith("event: ")]
+    if "error" in events:
+        raise AssertionError(f"stream reported an error: {lines}")
+    first_token = events.index("token") if "token" in events else len(events) - 1
+    if any(event != "email" for event in events[:first_token]):
+        raise AssertionError(f"email events must come first: {events}")
+    if events[-1] != "done" or events.count("done") != 1:
+        raise AssertionError(f"stream must end with one done event: {events}")
+    if any(event != "token" for event in events[first_token:-1]):
+        raise AssertionError(f"token events must be contiguous: {events}")
+    return events.count("email"), events.count("token")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--gmail-latency", type=float, default=0.05)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    inbox = [make_fake_message(i, important=(i % 5 == 0)) for i in range(args.emails)]
+    # Only mail from the last day is part of the digest
+    now_ms = int(time.time() * 1000)
+    for i, message in enumerate(inbox):
+        message["internalDate"] = str(now_ms - i * 60000)
+    with FakeGmailServer(inbox, latency=args.gmail_latency) as gmail, \
+            FakeOpenAIServer(latency=args.llm_latency, token_latency=args.token_latency) as llm, \
+            FakeSupabaseServer() as supabase:
+        # Every live run must do its own refresh rather than reuse the previous one
+        os.environ.update(stub_env(gmail, llm, supabase, IMPORTANT_EMAILS_MEMO_SECONDS=0))
+        # Backend modules read their configuration at import time
+        import llm_cache
+        import main as app_module
+
+        server, port = serve_app(app_module.app)
+        base = f"http://127.0.0.1:{port}"
+
+        for name, path in (("grouped_summary", "/emails/grouped_summary"),
+                           ("grouped_summary_stream", "/emails/grouped_summary/stream")):
+            ttfb, totals = [], []
+            for _ in range(args.runs):
+                # Cold start: no stored historyId, no processed rows, empty LLM cache
+                supabase.tables["users"] = [{"email": USER, "access_token": "stub", "refresh_token": "stub"}]
+                supabase.tables["processed_emails"] = []
+                app_module.evict_user(USER)
+                llm_cache.set_backend(llm_cache.MemoryCache())
+                first_byte, total, lines = timed_get(base + path, {"user_email": USER}, stream=True)
+                ttfb.append(first_byte)
+                totals.append(total)
+            result = {
+                "ttfb_p50_s": round(percentile(ttfb, 50), 3),
+                "ttfb_p95_s": round(percentile(ttfb, 95), 3),
+                "total_p50_s": round(percentile(totals, 50), 3),
+            }
+            if path.endswith("/stream"):
+                result["email_events"], result["token_events"] = check_event_order(lines)
+            print(name, json.dumps(result))
+        server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
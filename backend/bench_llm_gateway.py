@@ -0,0 +1,110 @@
+"""
+Load-tests the LLM gateway against the local OpenAI stub with injected 429s and a
+slow tail: N threads each issue completions, first straight through
+openai.ChatCompletion.create (the old call path), then through
+llm_gateway.chat_completion with retries (backoff shortened for the benchmark),
+hedging after 0.5s and a requests-per-minute cap.
+Prints success rate, latency percentiles and the gateway's counters. Exits non-zero
+unless every completion the stub answered, the losing hedge legs and streamed
+completions included, was charged to the usage ledger and the token counters.
+
+    python bench_llm_gateway.py --calls 200 --threads 16 --error-rate 0.2 --slow-rate 0.05
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import openai
+from stubs import FakeOpenAIServer, fake_llm_reply, percentile
+import llm_gateway
+from usage_ledger import UsageLedger, set_ledger, usage_scope
+
+
+def run(call, calls, threads):
+    def timed(_):
+        started = time.perf_counter()
+        try:
+            call()
+            return True, time.perf_counter() - started
+        except Exception:
+            return False, time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(timed, range(calls)))
+    latencies = [latency for ok, latency in results if ok]
+    return {
+        "succeeded": len(latencies),
+        "failed": len(results) - len(latencies),
+        "p50_s": round(percentile(latencies, 50), 3),
+        "p99_s": round(percentile(latencies, 99), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--error-rate", type=float, default=0.2, help="fraction of requests answered with 429")
+    parser.add_argument("--slow-rate", type=float, default=0.05, help="fraction of requests that take --slow-seconds")
+    parser.add_argument("--slow-seconds", type=float, default=2.0)
+    parser.add_argument("--rpm", type=int, default=6000)
+    args = parser.parse_args()
+
+    slow = random.Random(1)
+
+    def reply(messages):
+        time.sleep(args.slow_seconds if slow.random() < args.slow_rate else 0.05)
+        return fake_llm_reply(messages)
+
+    messages = [{"role": "user", "content": "Subject: Quarterly planning\nBody: Can we meet on Monday?"}]
+    with FakeOpenAIServer(reply=reply, error_rate=args.error_rate, error_status=429) as llm:
+        openai.api_base = llm.api_base
+        openai.api_key = "sk-stub"
+        direct = run(lambda: openai.ChatCompletion.create(model="gpt-3.5-turbo", messages=messages),
+                     args.calls, args.threads)
+        print("direct", json.dumps(direct))
+
+        llm_gateway.backoff_delay = lambda attempt, error=None: random.uniform(0, min(1.0, 0.05 * 2 ** attempt))
+        llm_gateway.LLM_HEDGE_AFTER = "0.5"
+        llm_gateway.set_rate_limits(rpm=args.rpm)
+        ledger = UsageLedger(":memory:")
+        set_ledger(ledger)
+        answered_before = llm.completions
+
+        def gateway_call():
+            with usage_scope("bench@example.com", "bench"):
+                llm_gateway.chat_completion(messages)
+
+        gateway = run(gateway_call, args.calls, args.threads)
+        print("gateway", json.dumps(gateway))
+        # Losing hedge legs are still running after their call returned
+        time.sleep(args.slow_seconds + 0.5)
+        print("gateway_stats", json.dumps(llm_gateway.gateway_stats()))
+        hedged_charged = sum(row["calls"] for row in ledger.usage()) == llm.completions - answered_before
+
+        llm.error_rate = 0
+        tokens_before = llm_gateway.gateway_stats()["completion_tokens"]
+        with usage_scope("bench@example.com", "stream"):
+            streamed = "".join(chunk.choices[0].delta.get("content") or ""
+                               for chunk in llm_gateway.chat_completion(messages, stream=True))
+            # A reader that stops after the first chunk is charged for what it received
+            partial = llm_gateway.chat_completion(messages, stream=True)
+            next(partial)
+            partial.close()
+        stream_rows = [row for row in ledger.usage() if row["endpoint"] == "stream"]
+        stream_charged = (bool(streamed) and sum(row["calls"] for row in stream_rows) == 2
+                          and llm_gateway.gateway_stats()["completion_tokens"] > tokens_before)
+
+    checks = {
+        "every answered completion charged, hedges included": hedged_charged,
+        "streamed completions metered": stream_charged,
+    }
+    for name, ok in checks.items():
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
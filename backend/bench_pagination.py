@@ -0,0 +1,138 @@
+"""
+Benchmarks /emails/important paging over mailboxes of several sizes.
+
+Serves main.py against the local Gmail, OpenAI and Supabase stubs with inboxes
+spread evenly over the last week. For each size it times the first page of a 7d
+window (cold mailbox) and the walk through every remaining page, counting the
+Gmail messages fetched for each, then checks the pages against a single
+/emails/important_full?window=7d refresh for another user with the same mailbox:
+every important email exactly once, newest first. Also checks that forged, edited
+or another user's cursors are rejected with a 400. Exits non-zero if a check fails.
+
+    python bench_pagination.py --sizes 200,1000,3000 --page-size 20
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import requests
+from stubs import FakeGmailServer, FakeOpenAIServer, FakeSupabaseServer, make_fake_message, serve_app, stub_env
+
+WEEK_MS = 7 * 24 * 3600 * 1000
+
+
+def week_inbox(size):
+    """`size` messages, newest first, spread over the last 7 days; 1 in 5 Gmail-important, 1 in 3 asking a question."""
+    now_ms = int(time.time() * 1000)
+    inbox = [make_fake_message(i, important=(i % 5 == 0), body=None if i % 3 == 0 else f"Weekly update number {i}.")
+             for i in range(size)]
+    for i, message in enumerate(inbox):
+        message["internalDate"] = str(now_ms - 60000 - i * (WEEK_MS - 120000) // size)
+    return inbox
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="200,1000,3000")
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--gmail-latency", type=float, default=0.02)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    users = [f"{kind}{size}@example.com" for size in sizes for kind in ("pages", "full")]
+    results = []
+    with FakeGmailServer([], latency=args.gmail_latency) as gmail, \
+            FakeOpenAIServer(latency=args.llm_latency) as llm, \
+            FakeSupabaseServer({"users": [
+                {"email": user, "access_token": "stub", "refresh_token": "stub"} for user in users
+            ]}) as supabase:
+        os.environ.update(stub_env(gmail, llm, supabase, IMPORTANT_EMAILS_MEMO_SECONDS=0,
+                                   SYNC_MAX_EMAILS=max(sizes)))
+        # Backend modules read their configuration at import time
+        import main as app_module
+
+        server, port = serve_app(app_module.app)
+
+        def get(path, **params):
+            response = requests.get(f"http://127.0.0.1:{port}/emails/{path}", params=params, timeout=3600)
+            response.raise_for_status()
+            return response.json()
+
+        issued_cursor = None
+        for size in sizes:
+            gmail.messages = {message["id"]: message for message in week_inbox(size)}
+            user = f"pages{size}@example.com"
+
+            gets_before = gmail.message_gets
+            started = time.perf_counter()
+            page = get("important", user_email=user, window="7d", page_size=args.page_size)
+            first_page_s = time.perf_counter() - started
+            first_page_gets = gmail.message_gets - gets_before
+
+            emails = list(page["important_emails"])
+            issued_cursor = page["next_cursor"] or issued_cursor
+            pages = 1
+            while page["next_cursor"]:
+                page = get("important", user_email=user, cursor=page["next_cursor"], page_size=args.page_size)
+                emails.extend(page["important_emails"])
+                pages += 1
+            walk_s = time.perf_counter() - started
+
+            started = time.perf_counter()
+            full = get("important_full", user_email=f"full{size}@example.com", window="7d")["important_emails"]
+            full_s = time.perf_counter() - started
+
+            ids = [email["id"] for email in emails]
+            times = [email["time"] for email in emails]
+            results.append({
+                "size": size,
+                "first_page_ms": round(first_page_s * 1000, 1),
+                "first_page_message_gets": first_page_gets,
+                "pages": pages,
+                "walk_ms": round(walk_s * 1000, 1),
+                "important_full_ms": round(full_s * 1000, 1),
+                "paged_emails": len(ids),
+                "full_emails": len(full),
+                "complete": sorted(ids) == sorted(email["id"] for email in full),
+                "no_duplicates": len(set(ids)) == len(ids),
+                "newest_first": times == sorted(times, reverse=True),
+            })
+            print(json.dumps(results[-1]))
+
+        def status(user, cursor):
+            return requests.get(f"http://127.0.0.1:{port}/emails/important",
+                                params={"user_email": user, "cursor": cursor}, timeout=600).status_code
+
+        forged = base64.urlsafe_b64encode(json.dumps({
+            "window_start": "1970-01-02 00:00:00", "before": None, "page_token": None, "frontier": None
+        }).encode("utf-8")).decode("ascii")
+        payload, _, signature = issued_cursor.partition(".")
+        state = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        edited = base64.urlsafe_b64encode(json.dumps(dict(state, window_start="1970-01-02 00:00:00"))
+                                          .encode("utf-8")).decode("ascii").rstrip("=") + "." + signature
+        rejected = {
+            "forged": status(f"pages{sizes[-1]}@example.com", forged),
+            "edited": status(f"pages{sizes[-1]}@example.com", edited),
+            "other user": status(f"full{sizes[-1]}@example.com", issued_cursor),
+        }
+        print("bad cursors", json.dumps(rejected))
+        server.should_exit = True
+
+    checks = {
+        "pages hold every important email of the window": all(r["complete"] for r in results),
+        "no email on two pages": all(r["no_duplicates"] for r in results),
+        "pages are newest first": all(r["newest_first"] for r in results),
+        "first page fetches no more mail for a bigger inbox":
+            max(r["first_page_message_gets"] for r in results) <= 2 * min(r["first_page_message_gets"] for r in results),
+        "forged, edited and other users' cursors are rejected": all(code == 400 for code in rejected.values()),
+    }
+    for name, ok in checks.items():
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmarks the /emails/important_full pipeline against local Gmail and LLM stubs.
+
+Compares the old serial flow (batched fetch, then every classifier batch, then every
+summary, one call at a time) with pipeline.process_messages, and prints latency
+percentiles for each.
+
+    python bench_pipeline.py --emails 100 --runs 5 --gmail-latency 0.05 --llm-latency 0.2
+"""
+import argparse
+import asyncio
+import json
+import time
+import openai
+from stubs import FakeGmailServer, FakeOpenAIServer, make_fake_message, percentile
+import gmail_batch
+from gmail_batch import fetch_messages_batched
+from classifier import classify_emails
+from message_parser import parse_message
+import pipeline
+import llm_cache
+
+
+def run_serial(service, message_ids, batch_uri):
+    fetched = fetch_messages_batched(service, message_ids, batch_uri=batch_uri)
+    store = {mid: parse_message(msg) for mid, msg in fetched["messages"].items()}
+    important = {mid for mid, msg in fetched["messages"].items() if "IMPORTANT" in msg.get("labelIds", [])}
+    important |= set(json.loads(classify_emails([dict(record) for record in store.values()])))
+    return [pipeline.summarize_email(store[mid]) for mid in message_ids if mid in important and mid in store]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=100)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--gmail-latency", type=float, default=0.05)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    inbox = [make_fake_message(i, important=(i % 7 == 0)) if i % 3 else
+             make_fake_message(i, body=f"Weekly update number {i}. Nothing to do.") for i in range(args.emails)]
+    message_ids = [m["id"] for m in inbox]
+
+    with FakeGmailServer(inbox, latency=args.gmail_latency) as gmail, \
+            FakeOpenAIServer(latency=args.llm_latency) as llm:
+        openai.api_base = llm.api_base
+        openai.api_key = "sk-stub"
+        gmail_batch.GMAIL_BATCH_URI = gmail.batch_uri
+        service = gmail.build_service()
+
+        results = {}
+        for name in ("serial", "pipeline"):
+            samples = []
+            for _ in range(args.runs):
+                gmail.round_trips = llm.completions = 0
+                # Start every run with a cold LLM cache
+                llm_cache.set_backend(llm_cache.MemoryCache())
+                started = time.perf_counter()
+                if name == "serial":
+                    emails = run_serial(service, message_ids, gmail.batch_uri)
+                else:
+                    emails = asyncio.run(pipeline.process_messages(service, message_ids))
+                samples.append(time.perf_counter() - started)
+            results[name] = {
+                "important_emails": len(emails),
+                "gmail_round_trips": gmail.round_trips,
+                "llm_calls": llm.completions,
+                "p50_s": round(percentile(samples, 50), 3),
+                "p95_s": round(percentile(samples, 95), 3),
+                "p99_s": round(percentile(samples, 99), 3),
+            }
+            print(name, json.dumps(results[name]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Prompt token benchmark for the compact prompt encodings, plus a per-digest cost run
+through the usage ledger.
+
+For synthetic inboxes of several sizes it builds every classification, batched
+summary, single summary and grouping prompt the pipeline would send, once in the
+previous encodings (indented or repeated-key JSON, instructions in the user message)
+and once in the current ones (tabular rows, row numbers instead of message IDs,
+shared system prompts), and compares their prompt and expected completion tokens.
+Token counts are exact with tiktoken installed and ~4 characters per token otherwise.
+
+It then builds one digest per size (classify, summarize, group) against the
+in-process stub model under a usage scope, and prints the ledger's calls and tokens
+per call site alongside the digest's latency.
+
+    python bench_prompt_tokens.py --sizes 20,100,500
+"""
+import argparse
+import json
+import os
+import time
+from bench_e2e import synthetic_inbox
+
+# The encodings used before prompt_encoding, kept here to measure against
+LEGACY_CLASSIFY_PROMPT = (
+    "You are a no-nonsense email filter assistant. You are provided with a JSON array of emails, "
+    "where each email includes the fields 'id', 'subject', 'sender', and 'snippet'. "
+    "Your task is to return only the IDs of emails that are genuinely important – that is, "
+    "those that represent personal or work-related communications requiring direct attention or action. "
+    "Exclude any emails that are automated, promotional, or marketing in nature. This includes emails that are job alerts, "
+    "subscription newsletters, daily digests, or any messages containing keywords like 'sale', 'offer', 'discount', "
+    "'promotion', 'newsletter', or 'digest'. "
+    "Return only a valid JSON array of email IDs with no extra commentary."
+)
+LEGACY_BATCH_SUMMARY_PROMPT = (
+    "You are given a JSON array of emails, each with the keys 'id', 'subject', 'sender' and 'body'. "
+    "For every email, generate a concise summary in less than 120 words, and a suggested reply only if the email "
+    "clearly demands a reply (for example, if it asks a question or requests a response); otherwise use an empty string. "
+    "Return only a valid JSON array with one object per email, each with exactly three keys: "
+    "'id', 'summary' and 'suggested_reply'. Do not add any commentary."
+)
+LEGACY_GROUPING_PROMPT = (
+    "You are an intelligent email-organizing assistant. "
+    "You are given a JSON array of emails, where each email has the keys 'subject', 'sender', 'summary', 'time', and 'suggested_reply'. "
+    "Your task is to group these emails by similarity of topic or relevance and output a final result in Markdown format. "
+    "For each group, provide a heading that includes an appropriate emoji and a descriptive category name (for example, '📦 Job Applications & Opportunities'). "
+    "Then list the emails in numbered order using the following format:\n\n"
+    "1. **Subject:** [subject]  \n"
+    "   **Sender:** [sender]  \n"
+    "   **Time:** [time]  \n"
+    "   **Summary:** [summary]  \n"
+    "   **Suggested Reply:** 💬 [suggested_reply]  \n\n"
+    "Ensure there is an extra blank line between each email for readability. "
+    "Return only the final grouped summary text in plain Markdown with no introductory commentary or extra text."
+)
+
+
+def legacy_classify(emails):
+    payload = [{field: email.get(field) for field in ("id", "subject", "sender", "snippet")} for email in emails]
+    return [{"role": "system", "content": LEGACY_CLASSIFY_PROMPT},
+            {"role": "user", "content": f"Here are the emails: {json.dumps(payload)}"}]
+
+
+def legacy_batch_summary(emails):
+    return [{"role": "system", "content": LEGACY_BATCH_SUMMARY_PROMPT},
+            {"role": "user", "content": json.dumps(emails, separators=(",", ":"))}]
+
+
+def legacy_single_summary(email):
+    prompt = (
+        f"Subject: {email['subject']}\n"
+        f"Sender: {email['sender']}\n"
+        f"Body: {email['body']}\n\n"
+        "Generate a concise summary of the email in less than 120 words. "
+        "Return your result as a valid JSON object with exactly two keys: 'summary' and 'suggested_reply'."
+    )
+    return [{"role": "user", "content": prompt}]
+
+
+def legacy_grouping(emails):
+    user_message = f"Here are the important emails in JSON:\n{json.dumps(emails, indent=2)}\n\nGroup them as instructed."
+    return [{"role": "system", "content": LEGACY_GROUPING_PROMPT}, {"role": "user", "content": user_message}]
+
+
+def prompt_tokens(messages):
+    from tokens import count_tokens
+    return sum(count_tokens(message["content"]) for message in messages)
+
+
+def completion_tokens(content):
+    from tokens import count_tokens
+    return count_tokens(content)
+
+
+def compare_prompts(size):
+    """Prompt and completion tokens per call site, previous vs current encoding, for one inbox."""
+    import llm_cache
+    from classifier import CLASSIFY_PROMPT, prepare_classify_inputs, plan_classify_batches, batch_payload
+    from summarizer import BATCH_SUMMARY_PROMPT, SUMMARY_PROMPT, SUMMARY_FIELDS, plan_summary_batches
+    from group_emails import grouping_messages
+    from message_parser import parse_message
+    from mime_body import preview
+    from prompt_encoding import table
+    from stubs import fake_llm_reply
+
+    llm_cache.set_backend(llm_cache.MemoryCache())
+    records = [parse_message(message) for message in synthetic_inbox(size)]
+    _, pending = prepare_classify_inputs(records)
+    sites = {}
+
+    def add(site, before_prompt, after_prompt, before_completion=0, after_completion=0):
+        totals = sites.setdefault(site, {"calls": 0, "before": 0, "after": 0})
+        totals["calls"] += 1
+        totals["before"] += before_prompt + before_completion
+        totals["after"] += after_prompt + after_completion
+
+    important = []
+    for batch in plan_classify_batches(pending):
+        current = [{"role": "system", "content": CLASSIFY_PROMPT}, {"role": "user", "content": batch_payload(batch)}]
+        numbers = json.loads(fake_llm_reply(current))
+        ids = [batch[n - 1]["id"] for n in numbers]
+        important.extend(email for email in batch if email["id"] in ids)
+        add("classify", prompt_tokens(legacy_classify(batch)), prompt_tokens(current),
+            completion_tokens(json.dumps(ids)), completion_tokens(json.dumps(numbers)))
+
+    summary_inputs = [{"id": email["id"], "subject": email["subject"], "sender": email["sender"],
+                       "body": preview(email.get("body") or "")} for email in important]
+    for batch in plan_summary_batches(summary_inputs):
+        rows = table([dict(email, n=n + 1) for n, email in enumerate(batch)], SUMMARY_FIELDS)
+        current = [{"role": "system", "content": BATCH_SUMMARY_PROMPT}, {"role": "user", "content": rows}]
+        reply_rows = json.loads(fake_llm_reply(current))
+        legacy_reply = [{"id": email["id"], "summary": row[1], "suggested_reply": row[2]}
+                        for email, row in zip(batch, reply_rows)]
+        add("summarize_batch", prompt_tokens(legacy_batch_summary(batch)), prompt_tokens(current),
+            completion_tokens(json.dumps(legacy_reply)), completion_tokens(json.dumps(reply_rows)))
+    for email in summary_inputs:
+        current = [{"role": "system", "content": SUMMARY_PROMPT},
+                   {"role": "user", "content": f"Subject: {email['subject']}\nSender: {email['sender']}\nBody: {email['body']}"}]
+        add("summarize_single", prompt_tokens(legacy_single_summary(email)), prompt_tokens(current))
+
+    grouping_items = [{"subject": email["subject"], "sender": email["sender"], "summary": f"Summary of {email['subject']}.",
+                       "time": email["time"], "suggested_reply": "Sounds good, see you then."} for email in important]
+    if grouping_items:
+        add("group", prompt_tokens(legacy_grouping(grouping_items)), prompt_tokens(grouping_messages(grouping_items)))
+
+    for totals in sites.values():
+        totals["saved_pct"] = round(100 * (1 - totals["after"] / totals["before"]), 1) if totals["before"] else 0.0
+    return sites
+
+
+def digest_cost(size, user_email):
+    """Builds one digest for the inbox on the stub model and returns its latency and ledger rows."""
+    import llm_cache
+    from classifier import classify_emails
+    from summarizer import summarize_emails_batch
+    from group_emails import group_emails_by_llm
+    from message_parser import parse_message
+    from usage_ledger import usage_scope, get_ledger
+
+    llm_cache.set_backend(llm_cache.MemoryCache())
+    records = [parse_message(message) for message in synthetic_inbox(size)]
+    started = time.perf_counter()
+    with usage_scope(user_email, "digest"):
+        important_ids = set(json.loads(classify_emails(records)))
+        important = [record for record in records if record["id"] in important_ids]
+        summaries = summarize_emails_batch([{"id": email["id"], "subject": email["subject"], "sender": email["sender"],
+                                             "body": email.get("body") or ""} for email in important])
+        group_emails_by_llm([{"subject": email["subject"], "sender": email["sender"],
+                              "summary": json.loads(summaries[email["id"]])["summary"], "time": email["time"],
+                              "suggested_reply": json.loads(summaries[email["id"]])["suggested_reply"]}
+                             for email in important])
+    latency = time.perf_counter() - started
+    rows = get_ledger().usage(user_email)
+    return {
+        "latency_ms": round(latency * 1000, 1),
+        "calls": sum(row["calls"] for row in rows),
+        "prompt_tokens": sum(row["prompt_tokens"] for row in rows),
+        "completion_tokens": sum(row["completion_tokens"] for row in rows),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="20,100,500")
+    parser.add_argument("--llm-latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+    import llm_gateway
+    from usage_ledger import UsageLedger, set_ledger
+    llm_gateway.set_backend(llm_gateway.FakeBackend(latency=args.llm_latency))
+    set_ledger(UsageLedger(":memory:"))
+
+    for size in [int(size) for size in args.sizes.split(",")]:
+        sites = compare_prompts(size)
+        before = sum(site["before"] for site in sites.values() if site is not sites.get("summarize_single"))
+        after = sum(site["after"] for site in sites.values() if site is not sites.get("summarize_single"))
+        print(json.dumps({"size": size, "sites": sites,
+                          "digest_tokens_before": before, "digest_tokens_after": after,
+                          "digest_saved_pct": round(100 * (1 - after / before), 1) if before else 0.0}))
+        print(json.dumps({"size": size, "digest_run": digest_cost(size, f"bench{size}@example.com")}))
+
+
+if __name__ == "__main__":
+    main()
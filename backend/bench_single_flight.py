@@ -0,0 +1,150 @@
+"""
+Checks that concurrent requests for one user share a single mailbox refresh.
+
+Serves main.py against the local Gmail, OpenAI and Supabase stubs and sends one
+request for a baseline user, then N concurrent requests for a second user with the
+same mailbox, half to /emails/important_full and half to /emails/grouped_summary,
+then one more request while the result is still memoized. Exits non-zero unless the
+N requests caused exactly one refresh and no more Gmail traffic than the single
+baseline request, and the late request caused no Gmail traffic at all.
+
+The inbox also holds mail from two to six days ago. One more user asks for 1d and
+7d at the same time, and another for 1d and then 7d once the first has synced; both
+must get the same 7d mail as a user asking for 7d alone, with no message fetched twice.
+Finally a user opens /emails/grouped_summary/stream while /emails/important_full runs:
+one refresh must serve both, and the stream must send every important email.
+
+    python bench_single_flight.py --concurrency 10
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from stubs import FakeGmailServer, FakeOpenAIServer, FakeSupabaseServer, make_fake_message, serve_app, stub_env
+
+USERS = ["baseline@example.com", "crowd@example.com", "week@example.com", "mixed@example.com",
+         "widening@example.com", "streaming@example.com"]
+OLD_EMAILS = 20
+
+
+def important_ids_of(inbox, now_ms, days):
+    """Messages the stub classifier keeps (Gmail-important or asking a question) received in the last `days`."""
+    return [message["id"] for message in inbox if int(message["internalDate"]) >= now_ms - days * 86400000
+            and ("IMPORTANT" in message.get("labelIds", []) or "?" in message.get("snippet", ""))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--emails", type=int, default=60)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    now_ms = int(time.time() * 1000)
+    inbox = [make_fake_message(i, important=(i % 5 == 0)) for i in range(args.emails)]
+    for i, message in enumerate(inbox):
+        message["internalDate"] = str(now_ms - i * 60000)
+    for i in range(OLD_EMAILS):
+        message = make_fake_message(args.emails + i, important=(i % 5 == 0))
+        message["internalDate"] = str(now_ms - (2 * 24 + i * 6) * 3600 * 1000)
+        inbox.append(message)
+
+    with FakeGmailServer(inbox, latency=0.05) as gmail, \
+            FakeOpenAIServer(latency=args.llm_latency) as llm, \
+            FakeSupabaseServer({"users": [
+                {"email": user, "access_token": "stub", "refresh_token": "stub"} for user in USERS
+            ]}) as supabase:
+        os.environ.update(stub_env(gmail, llm, supabase, IMPORTANT_EMAILS_MEMO_SECONDS=60))
+        # Backend modules read their configuration at import time
+        import llm_cache
+        import main as app_module
+        from mailbox_sync import shared_refresh_stats
+
+        server, port = serve_app(app_module.app)
+
+        def request(user, n):
+            path, params = ("important_full", {}) if n % 2 == 0 else ("grouped_summary", {"refresh": True})
+            response = requests.get(f"http://127.0.0.1:{port}/emails/{path}",
+                                    params={"user_email": user, **params}, timeout=600)
+            response.raise_for_status()
+
+        def important_ids(user, window):
+            response = requests.get(f"http://127.0.0.1:{port}/emails/important_full",
+                                    params={"user_email": user, "window": window}, timeout=600)
+            response.raise_for_status()
+            return sorted(email["id"] for email in response.json()["important_emails"])
+
+        def streamed_ids(user):
+            response = requests.get(f"http://127.0.0.1:{port}/emails/grouped_summary/stream",
+                                    params={"user_email": user, "format": "ndjson"}, timeout=600)
+            response.raise_for_status()
+            events = [json.loads(line) for line in response.text.splitlines() if line]
+            return sorted(event["data"]["id"] for event in events if event["event"] == "email")
+
+        def measure(user, requests_count, call=None):
+            llm_cache.set_backend(llm_cache.MemoryCache())
+            before = (gmail.round_trips, gmail.message_gets, llm.round_trips, shared_refresh_stats())
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=requests_count) as pool:
+                results = list(pool.map(call or (lambda n: request(user, n)), range(requests_count)))
+            stats = shared_refresh_stats()
+            return {
+                "results": results,
+                "requests": requests_count,
+                "seconds": round(time.perf_counter() - started, 3),
+                "refreshes": stats["runs"] - before[3]["runs"],
+                "joined": stats["joined"] - before[3]["joined"],
+                "memo_hits": stats["memo_hits"] - before[3]["memo_hits"],
+                "gmail_requests": gmail.round_trips - before[0],
+                "gmail_message_gets": gmail.message_gets - before[1],
+                "llm_requests": llm.round_trips - before[2],
+            }
+
+        baseline = measure(USERS[0], 1)
+        crowd = measure(USERS[1], args.concurrency)
+        late = measure(USERS[1], 1)
+        week = measure(USERS[2], 1, lambda n: important_ids(USERS[2], "7d"))
+        mixed = measure(USERS[3], 2, lambda n: important_ids(USERS[3], ["1d", "7d"][n]))
+        narrow = measure(USERS[4], 1, lambda n: important_ids(USERS[4], "1d"))
+        widened = measure(USERS[4], 1, lambda n: important_ids(USERS[4], "7d"))
+        streamed = measure(USERS[5], 2, lambda n: important_ids(USERS[5], "1d") if n == 0 else streamed_ids(USERS[5]))
+        server.should_exit = True
+
+    week_ids = week.pop("results")[0]
+    mixed_ids = mixed.pop("results")[1]
+    narrow.pop("results")
+    widened_ids = widened.pop("results")[0]
+    full_ids, stream_ids = streamed.pop("results")
+    for result in (baseline, crowd, late):
+        result.pop("results")
+
+    print("baseline", json.dumps(baseline))
+    print("concurrent", json.dumps(crowd))
+    print("memoized", json.dumps(late))
+    print("7d", json.dumps(week))
+    print("1d+7d concurrent", json.dumps(mixed))
+    print("1d then 7d", json.dumps(narrow), json.dumps(widened))
+    print("stream + important_full", json.dumps(streamed))
+    checks = {
+        "one refresh for all concurrent requests": crowd["refreshes"] == 1,
+        "no more Gmail traffic than one request": crowd["gmail_message_gets"] == baseline["gmail_message_gets"],
+        "late request served from the memo": late["memo_hits"] == 1 and late["gmail_requests"] == 0,
+        "7d mail includes mail older than a day": len(week_ids) > len(important_ids_of(inbox, now_ms, days=1)),
+        "concurrent 1d and 7d: same 7d mail, fetched once":
+            mixed_ids == week_ids and mixed["gmail_message_gets"] == week["gmail_message_gets"],
+        "7d after 1d: same 7d mail, fetched once":
+            widened_ids == week_ids and narrow["gmail_message_gets"] + widened["gmail_message_gets"]
+            == week["gmail_message_gets"],
+        "stream shares the refresh and sends every important email":
+            streamed["refreshes"] == 1 and stream_ids == full_ids and len(full_ids) > 0,
+    }
+    for name, ok in checks.items():
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
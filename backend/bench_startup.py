@@ -0,0 +1,70 @@
+"""
+Measures cold-start cost of the backend: time to import main.py and the process's
+peak RSS, first with lazy components (what a worker pays before serving "/"), then
+after loading every registered component (what eager startup used to pay).
+
+Each scenario runs in a fresh interpreter; results are medians over --runs.
+
+    python bench_startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SCENARIO = r"""
+import json, resource, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter() - started
+loaded = []
+if sys.argv[1] == "eager":
+    import components
+    for name in components.component_status():
+        try:
+            components.get_component(name)
+            loaded.append(name)
+        except Exception as e:
+            print(f"{name} failed to load: {e}", file=sys.stderr)
+total = time.perf_counter() - started
+heavy = [m for m in ("numpy", "faiss", "torch", "sentence_transformers", "supabase", "google_auth_oauthlib") if m in sys.modules]
+print(json.dumps({
+    "import_s": round(imported, 3),
+    "ready_s": round(total, 3),
+    "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    "components_loaded": loaded,
+    "heavy_modules": heavy,
+}))
+"""
+
+
+def run(mode):
+    env = dict(os.environ, WARMUP_COMPONENTS="")
+    output = subprocess.run(
+        [sys.executable, "-c", SCENARIO, mode],
+        capture_output=True, text=True, check=True, env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    for mode in ("lazy", "eager"):
+        samples = [run(mode) for _ in range(args.runs)]
+        print(mode, json.dumps({
+            "import_s_p50": statistics.median(s["import_s"] for s in samples),
+            "ready_s_p50": statistics.median(s["ready_s"] for s in samples),
+            "peak_rss_mb_p50": statistics.median(s["peak_rss_mb"] for s in samples),
+            "components_loaded": samples[-1]["components_loaded"],
+            "heavy_modules": samples[-1]["heavy_modules"],
+        }))
+
+
+if __name__ == "__main__":
+    main()
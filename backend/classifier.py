@@ -1,88 +1,211 @@
 import os
-import openai
 from dotenv import load_dotenv
 import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from llm_cache import make_key, get_cached, set_cached
+from llm_gateway import chat_completion
+from tokens import count_tokens
+from metrics import span, propagate_trace
+from prompt_encoding import compact_json, table, row_numbers
+from usage_ledger import TokenBudgetExceeded
 
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
-def classify_emails(emails_json, batch_size=10):
+CLASSIFIER_MODEL = "gpt-3.5-turbo"  # Change model as needed
+# Bump when the prompt below changes so cached decisions are not reused
+CLASSIFIER_PROMPT_VERSION = "classify-v4"
+
+def classification_cache_key(email):
+    content = {field: email.get(field) for field in ("subject", "sender", "snippet", "body", "thread")}
+    return make_key("classify", CLASSIFIER_PROMPT_VERSION, CLASSIFIER_MODEL, content)
+
+CLASSIFY_PROMPT = (
+    "You are a no-nonsense email filter assistant. You are given emails as a JSON array of rows: "
+    "the first row names the columns 'n', 'subject', 'sender', 'snippet' and 'thread' (earlier messages of the email's "
+    "thread, or null), and every following row is one email. Judge each email together with its thread. "
+    "Your task is to return only the numbers (n) of emails that are genuinely important – that is, "
+    "those that represent personal or work-related communications requiring direct attention or action. "
+    "Exclude any emails that are automated, promotional, or marketing in nature. This includes emails that are job alerts, "
+    "subscription newsletters, daily digests, or any messages containing keywords like 'sale', 'offer', 'discount', "
+    "'promotion', 'newsletter', or 'digest'. "
+    "Return only a valid JSON array of those numbers with no extra commentary."
+)
+AD_KEYWORDS = ["sale", "offer", "discount", "promotion", "newsletter", "digest"]
+
+# Emails are packed into one request until the prompt reaches the token budget;
+# batches run concurrently, at most CLASSIFY_CONCURRENCY at a time.
+CLASSIFY_TOKEN_BUDGET = int(os.getenv("CLASSIFY_TOKEN_BUDGET", "3000"))
+CLASSIFY_MAX_EMAILS = int(os.getenv("CLASSIFY_MAX_EMAILS", "60"))
+CLASSIFY_CONCURRENCY = int(os.getenv("CLASSIFY_CONCURRENCY", "4"))
+# Completion allowance per email (one row number in the returned array)
+CLASSIFY_OUTPUT_TOKENS_PER_EMAIL = 3
+CLASSIFY_FIELDS = ("n", "subject", "sender", "snippet", "thread")
+
+_batch_log = deque(maxlen=200)
+_batch_totals = {"batches": 0, "emails": 0, "failed_batches": 0, "bisections": 0, "prompt_tokens": 0, "completion_tokens": 0}
+_stats_lock = threading.Lock()
+
+def truncate(text, limit):
+    return text[:limit] + "..." if len(text) > limit else text
+
+def classify_item(email):
+    """A copy of the email with the fields the classifier sees truncated to reduce token usage."""
+    return dict(email, subject=truncate(email.get("subject") or "", 50), sender=truncate(email.get("sender") or "", 50),
+                snippet=truncate(email.get("snippet") or "", 100))
+
+def prepare_classify_inputs(emails):
+    """
+    Drops emails with advertisement keywords, truncates fields to reduce token usage
+    and resolves cached decisions. Works on copies, so the caller's records are left
+    untouched. Returns ([cached important IDs], [emails still to classify]).
+    """
+    cached_ids = []
+    pending = []
+    for email in emails:
+        subject = email.get("subject") or ""
+        snippet = email.get("snippet") or ""
+        # Optional pre-filter: discard emails whose subject or snippet contain common advertisement keywords
+        if any(keyword in subject.lower() or keyword in snippet.lower() for keyword in AD_KEYWORDS):
+            continue
+        item = classify_item(email)
+        decision = get_cached("classify", classification_cache_key(item))
+        if decision is None:
+            pending.append(item)
+        elif json.loads(decision):
+            cached_ids.append(item.get("id"))
+    return cached_ids, pending
+
+def batch_payload(emails):
+    """The batch as a table numbered from 1; the model answers with row numbers rather than message IDs."""
+    return table([dict(email, n=n + 1) for n, email in enumerate(emails)], CLASSIFY_FIELDS)
+
+def row_tokens(email):
+    return count_tokens(compact_json([0] + [email.get(field) for field in CLASSIFY_FIELDS[1:]]), CLASSIFIER_MODEL)
+
+def plan_classify_batches(emails, token_budget=None, max_emails=None):
+    """
+    Splits emails into batches whose prompt plus expected completion stays within
+    `token_budget` tokens (counted with tiktoken when it is installed). An email
+    larger than the budget on its own still gets a batch of one.
+    """
+    token_budget = token_budget or CLASSIFY_TOKEN_BUDGET
+    max_emails = max_emails or CLASSIFY_MAX_EMAILS
+    budget = token_budget - count_tokens(CLASSIFY_PROMPT + batch_payload([]), CLASSIFIER_MODEL)
+    batches = []
+    current = []
+    current_tokens = 0
+    for email in emails:
+        cost = row_tokens(email) + CLASSIFY_OUTPUT_TOKENS_PER_EMAIL
+        if current and (current_tokens + cost > budget or len(current) >= max_emails):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(email)
+        current_tokens += cost
+    if current:
+        batches.append(current)
+    return batches
+
+def record_batch(emails, started, usage=None, error=None):
+    entry = {
+        "emails": len(emails),
+        "prompt_tokens": (usage or {}).get("prompt_tokens"),
+        "completion_tokens": (usage or {}).get("completion_tokens"),
+        "latency_s": round(time.perf_counter() - started, 3),
+        "ok": error is None,
+        "error": error
+    }
+    with _stats_lock:
+        _batch_log.append(entry)
+        _batch_totals["batches"] += 1
+        _batch_totals["emails"] += len(emails)
+        _batch_totals["failed_batches"] += error is not None
+        _batch_totals["prompt_tokens"] += entry["prompt_tokens"] or 0
+        _batch_totals["completion_tokens"] += entry["completion_tokens"] or 0
+    return entry
+
+def classify_batch(emails):
     """
-    Processes the list of emails in batches to avoid exceeding the model's context length.
-    For each batch, it sends a JSON array of emails to OpenAI with a strict prompt.
-    
+    Classifies one planned batch with a single chat completion and returns the
+    important IDs. If the answer cannot be parsed, the batch is split in half and
+    each half retried, down to single emails; an email whose answer still cannot be
+    parsed is kept as important rather than silently dropped.
+
+    Errors from the call itself (already retried by the gateway) are raised: a
+    smaller batch would not get through an outage either, and marking the emails
+    important would store a wrong decision for each of them.
+    """
+    started = time.perf_counter()
+    try:
+        with span("llm.classify"):
+            response = chat_completion(
+                model=CLASSIFIER_MODEL,
+                messages=[
+                    {"role": "system", "content": CLASSIFY_PROMPT},
+                    {"role": "user", "content": batch_payload(emails)}
+                ],
+                temperature=0.4
+            )
+    except TokenBudgetExceeded:
+        raise
+    except Exception as e:
+        record_batch(emails, started, error=str(e))
+        raise
+    try:
+        content = response['choices'][0]['message']['content'].strip()
+        # Remove markdown code fences if present
+        if content.startswith("```"):
+            content = content.strip("`").strip("json").strip()
+        numbers = json.loads(content) if content else []
+        if not isinstance(numbers, list):
+            raise ValueError(f"expected a JSON array, got {type(numbers).__name__}")
+    except (KeyError, IndexError, TypeError, AttributeError, ValueError) as e:
+        record_batch(emails, started, usage=response.get("usage"), error=str(e))
+        if len(emails) == 1:
+            print(f"Could not classify email {emails[0].get('id')}, keeping it as important: {e}")
+            return [emails[0].get("id")]
+        with _stats_lock:
+            _batch_totals["bisections"] += 1
+        middle = len(emails) // 2
+        return classify_batch(emails[:middle]) + classify_batch(emails[middle:])
+
+    record_batch(emails, started, usage=response.get("usage"))
+    batch_ids = [emails[index].get("id") for index in row_numbers(numbers, len(emails))]
+    for email in emails:
+        set_cached("classify", classification_cache_key(email), json.dumps(email.get("id") in batch_ids))
+    return batch_ids
+
+def classify_emails(emails_json, token_budget=None, concurrency=None):
+    """
+    Classifies a list of emails and returns the important email IDs as a JSON array string.
+
     The prompt instructs the LLM to:
       - Exclude any emails that are automated, promotional, or marketing in nature.
       - Exclude emails that appear to be job alerts, subscription newsletters, daily digests,
         or that contain keywords such as "sale", "offer", "discount", "promotion", "newsletter", or "digest".
       - Return only the IDs of emails that are genuine personal or work-related communications 
         requiring direct attention or action.
-    
-    Aggregates and returns all important email IDs as a JSON array string.
+
+    Emails are packed into token-budgeted batches (plan_classify_batches) that run
+    concurrently, and batches whose answer cannot be parsed are bisected and retried
+    (classify_batch).
+    Each email's decision is cached by (prompt version, model, email content); emails
+    with a cached decision are left out of the LLM batches.
     """
-    important_ids = []
-    
-    # Process emails in batches
-    for i in range(0, len(emails_json), batch_size):
-        batch = emails_json[i:i+batch_size]
-        
-        # Optional pre-filter: discard emails whose subject or snippet contain common advertisement keywords
-        prefiltered = []
-        ad_keywords = ["sale", "offer", "discount", "promotion", "newsletter", "digest"]
-        for email in batch:
-            subject = email.get("subject", "").lower()
-            snippet = email.get("snippet", "").lower()
-            if any(keyword in subject or keyword in snippet for keyword in ad_keywords):
-                continue
-            prefiltered.append(email)
-        batch = prefiltered
-
-        # Truncate fields to reduce token usage
-        for email in batch:
-            if 'subject' in email and email['subject']:
-                email['subject'] = email['subject'][:50] + "..." if len(email['subject']) > 50 else email['subject']
-            if 'sender' in email and email['sender']:
-                email['sender'] = email['sender'][:50] + "..." if len(email['sender']) > 50 else email['sender']
-            if 'snippet' in email and email['snippet']:
-                email['snippet'] = email['snippet'][:100] + "..." if len(email['snippet']) > 100 else email['snippet']
-        
-        batch_json_str = json.dumps(batch)
-        
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",  # Change model as needed
-                messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "You are a no-nonsense email filter assistant. You are provided with a JSON array of emails, "
-                            "where each email includes the fields 'id', 'subject', 'sender', and 'snippet'. "
-                            "Your task is to return only the IDs of emails that are genuinely important – that is, "
-                            "those that represent personal or work-related communications requiring direct attention or action. "
-                            "Exclude any emails that are automated, promotional, or marketing in nature. This includes emails that are job alerts, "
-                            "subscription newsletters, daily digests, or any messages containing keywords like 'sale', 'offer', 'discount', "
-                            "'promotion', 'newsletter', or 'digest'. "
-                            "Return only a valid JSON array of email IDs with no extra commentary."
-                        )
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Here are the emails: {batch_json_str}"
-                    }
-                ],
-                temperature=0.4
-            )
-            content = response['choices'][0]['message']['content']
-            if not content.strip():
-                continue
-            # Remove markdown code fences if present
-            if content.strip().startswith("```"):
-                content = content.strip().strip("`").strip("json").strip()
-            batch_ids = json.loads(content)
-            if isinstance(batch_ids, list):
+    important_ids, pending = prepare_classify_inputs(emails_json)
+    batches = plan_classify_batches(pending, token_budget)
+    if len(batches) == 1:
+        important_ids.extend(classify_batch(batches[0]))
+    elif batches:
+        with ThreadPoolExecutor(max_workers=min(len(batches), concurrency or CLASSIFY_CONCURRENCY)) as executor:
+            for batch_ids in executor.map(propagate_trace(classify_batch), batches):
                 important_ids.extend(batch_ids)
-        except Exception as e:
-            print(f"Batch starting at index {i} error: {e}")
-            continue
+    return json.dumps(important_ids, indent=4)
 
-    return json.dumps(important_ids, indent=4)
\ No newline at end of file
+def classify_batch_stats():
+    """Totals plus the most recent batches, each with its email count, tokens and latency."""
+    with _stats_lock:
+        return {**_batch_totals, "recent": list(_batch_log)[-20:]}
@@ -0,0 +1,64 @@
+import asyncio
+import threading
+import time
+
+# name -> factory; components are built on first use (or by warm_up) and then cached
+_factories = {}
+_instances = {}
+_load_times = {}
+_errors = {}
+_locks = {}
+
+
+def register(name, factory):
+    """Registers a lazily-built component. Nothing is constructed until it is first needed."""
+    _factories[name] = factory
+    _locks[name] = threading.Lock()
+
+
+def get_component(name):
+    """Returns the named component, building it on first use. Concurrent callers wait for one build."""
+    if name in _instances:
+        return _instances[name]
+    with _locks[name]:
+        if name not in _instances:
+            started = time.perf_counter()
+            try:
+                _instances[name] = _factories[name]()
+            except Exception as e:
+                _errors[name] = str(e)
+                raise
+            _errors.pop(name, None)
+            _load_times[name] = round(time.perf_counter() - started, 3)
+    return _instances[name]
+
+
+def is_loaded(name):
+    return name in _instances
+
+
+def component_status():
+    return {
+        name: {
+            "loaded": name in _instances,
+            "load_seconds": _load_times.get(name),
+            "error": _errors.get(name)
+        }
+        for name in _factories
+    }
+
+
+async def warm_up(names):
+    """
+    Builds the given components in worker threads, one after another, so a cold
+    worker can start serving requests while heavy models load in the background.
+    Failures are recorded in component_status() and retried on first use.
+    """
+    for name in names:
+        if name not in _factories:
+            print(f"Unknown component in warm-up: {name}")
+            continue
+        try:
+            await asyncio.to_thread(get_component, name)
+        except Exception as e:
+            print(f"Warm-up of {name} failed: {e}")
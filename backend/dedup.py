@@ -0,0 +1,197 @@
+import hashlib
+import os
+import re
+import threading
+
+# Collapse a run's messages by Gmail thread and by near-duplicate content before classification
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+# Most differing SimHash bits (of 64) for two messages from one sender to count as
+# near-duplicates; -1 collapses threads only
+DEDUP_SIMHASH_DISTANCE = int(os.getenv("DEDUP_SIMHASH_DISTANCE", "3"))
+# Texts with fewer words than this are too short to fingerprint reliably and are never collapsed
+DEDUP_MIN_WORDS = 6
+# Characters of earlier thread messages passed to the summarizer with the latest one
+THREAD_CONTEXT_CHARS = int(os.getenv("THREAD_CONTEXT_CHARS", "600"))
+
+SIMHASH_BITS = 64
+# A SimHash is split into DEDUP_SIMHASH_DISTANCE + 1 bands: two hashes within that
+# distance agree exactly on at least one band, so candidates are found by band lookup.
+_URL = re.compile(r"https?://\S+")
+_DIGITS = re.compile(r"\d+")
+_NON_WORD = re.compile(r"[^\w]+")
+_ADDRESS = re.compile(r"<([^>]+)>")
+
+_totals = {"runs": 0, "messages": 0, "groups": 0, "thread_collapsed": 0, "near_duplicate_collapsed": 0,
+           "classify_calls_avoided": 0, "collapsed_into_summaries": 0}
+_totals_lock = threading.Lock()
+
+
+def normalize_words(text):
+    """Lowercased words with URLs dropped and numbers masked, so "Build #4121 passed" matches "Build #4122 passed"."""
+    text = _DIGITS.sub("0", _URL.sub(" ", (text or "").lower()))
+    return [word for word in _NON_WORD.sub(" ", text).split() if word]
+
+
+def simhash(words, shingle=3):
+    """64-bit SimHash of the word shingles."""
+    features = [" ".join(words[i:i + shingle]) for i in range(max(1, len(words) - shingle + 1))]
+    weights = [0] * SIMHASH_BITS
+    for feature in features:
+        value = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def sender_address(sender):
+    match = _ADDRESS.search(sender or "")
+    return (match.group(1) if match else sender or "").strip().lower()
+
+
+class Deduplicator:
+    """
+    Groups the messages of one pipeline run before they are classified: messages of
+    the same Gmail thread, and near-duplicates from the same sender (SimHash of the
+    subject and snippet within DEDUP_SIMHASH_DISTANCE bits), e.g. bursts of
+    notifications. Only the representative of each group is classified and
+    summarized; the others are attached to it as members.
+
+    The representative is the group's newest message by internalDate. Fetch chunks
+    finish in any order, so a newer message of the representative's thread that
+    arrives later takes its place (see add).
+    """
+
+    def __init__(self, max_distance=None):
+        self.max_distance = DEDUP_SIMHASH_DISTANCE if max_distance is None else max_distance
+        self.bands = self.max_distance + 1
+        # message id -> group id (the id of the group's first message, which never changes)
+        self._group = {}
+        # group id -> representative id, and group id -> [(record, kind)] of every message
+        # with kind "thread" or "near_duplicate" (None for the first message)
+        self._representative = {}
+        self._members = {}
+        self._threads = {}
+        self._band_index = {}
+        # classify_calls_avoided is counted by the pipeline, which plans the requests
+        self.stats = {"messages": 0, "groups": 0, "thread_collapsed": 0, "near_duplicate_collapsed": 0,
+                      "classify_calls_avoided": 0}
+
+    def _band_keys(self, sender, fingerprint):
+        width = SIMHASH_BITS // self.bands
+        return [(sender, band, fingerprint >> (band * width) & ((1 << width) - 1)) for band in range(self.bands)]
+
+    def _near_duplicate_of(self, record):
+        words = normalize_words(f"{record.get('subject', '')} {record.get('snippet', '')}")
+        if len(words) < DEDUP_MIN_WORDS:
+            return None, []
+        fingerprint = simhash(words)
+        keys = self._band_keys(sender_address(record.get("sender")), fingerprint)
+        for key in keys:
+            for other, group_id in self._band_index.get(key, ()):
+                if bin(fingerprint ^ other).count("1") <= self.max_distance:
+                    return group_id, []
+        return None, [(key, fingerprint) for key in keys]
+
+    def _record(self, message_id):
+        return next(record for record, _ in self._members[self._group[message_id]] if record["id"] == message_id)
+
+    def add(self, records):
+        """
+        Assigns each record to a group. Returns (representatives, extended, replaced):
+          - the records that are now a group's representative and were not before:
+            the first message of a new group, or a newer message of the
+            representative's thread that took its place,
+          - ids of earlier representatives whose thread gained older messages, so
+            the caller can judge those threads again with the extra context,
+          - {new representative id: the representative id it replaced}.
+        """
+        representatives = {}
+        extended = []
+        replaced = {}
+        for record in records:
+            message_id = record["id"]
+            if message_id in self._group:
+                continue
+            self.stats["messages"] += 1
+            thread_id = record.get("thread_id")
+            group_id = self._threads.get(thread_id) if thread_id else None
+            kind = "thread"
+            band_entries = []
+            if group_id is None and self.max_distance >= 0:
+                group_id, band_entries = self._near_duplicate_of(record)
+                kind = "near_duplicate"
+            if group_id is None:
+                self._group[message_id] = message_id
+                self._representative[message_id] = message_id
+                self._members[message_id] = [(record, None)]
+                self.stats["groups"] += 1
+                if thread_id:
+                    self._threads[thread_id] = message_id
+                for key, fingerprint in band_entries:
+                    self._band_index.setdefault(key, []).append((fingerprint, message_id))
+                representatives[message_id] = record
+                continue
+
+            self._group[message_id] = group_id
+            self._members[group_id].append((record, kind))
+            self.stats[f"{kind}_collapsed"] += 1
+            if thread_id:
+                self._threads.setdefault(thread_id, group_id)
+            current_id = self._representative[group_id]
+            current = self._record(current_id)
+            if kind == "thread" and thread_id == current.get("thread_id") and \
+                    record.get("internal_date", 0) > current.get("internal_date", 0):
+                self._representative[group_id] = message_id
+                representatives.pop(current_id, None)
+                replaced[message_id] = replaced.pop(current_id, current_id)
+                representatives[message_id] = record
+            elif kind == "thread" and current_id not in representatives and current_id not in extended:
+                extended.append(current_id)
+        extended = [email_id for email_id in extended if self.representative_of(email_id) == email_id]
+        replaced = {new_id: old_id for new_id, old_id in replaced.items() if new_id != old_id}
+        return list(representatives.values()), extended, replaced
+
+    def representative_of(self, message_id):
+        group_id = self._group.get(message_id)
+        return self._representative[group_id] if group_id is not None else message_id
+
+    def collapsed_ids(self, representative_id):
+        group_id = self._group.get(representative_id)
+        if group_id is None:
+            return []
+        return [record["id"] for record, _ in self._members[group_id] if record["id"] != representative_id]
+
+    def thread_context(self, representative_id):
+        """
+        The other messages of the representative's thread as "time sender: snippet"
+        lines, newest first, up to THREAD_CONTEXT_CHARS.
+        """
+        group_id = self._group.get(representative_id)
+        if group_id is None:
+            return None
+        thread_id = self._record(representative_id).get("thread_id")
+        members = sorted((record for record, _ in self._members[group_id]
+                          if record["id"] != representative_id and thread_id and record.get("thread_id") == thread_id),
+                         key=lambda record: record.get("internal_date", 0), reverse=True)
+        lines = [f"{record.get('time', '')} {record.get('sender', '')}: {record.get('snippet', '')}" for record in members]
+        return "\n".join(lines)[:THREAD_CONTEXT_CHARS] or None
+
+
+def record_run(deduplicator, summarized_ids):
+    """
+    Adds a finished run to the process totals. Classification requests avoided are
+    counted where the pipeline plans them, as requests are packed by token budget; for
+    summaries only the emails folded into a summarized group are known, since whether
+    they would have been judged important on their own is not.
+    """
+    collapsed = sum(len(deduplicator.collapsed_ids(message_id)) for message_id in summarized_ids)
+    with _totals_lock:
+        _totals["runs"] += 1
+        for key, value in deduplicator.stats.items():
+            _totals[key] += value
+        _totals["collapsed_into_summaries"] += collapsed
+
+
+def dedup_stats():
+    with _totals_lock:
+        return dict(_totals)
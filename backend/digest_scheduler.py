@@ -0,0 +1,345 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from gmail_batch import backoff_delay
+from gmail_pool import acquire_gmail_client
+from group_emails import group_emails, grouping_input
+from mailbox_sync import shared_refresh_important_emails
+from pipeline import run_blocking
+from supabase_client import get_digest_schedule, get_digest, save_digest
+from usage_ledger import usage_scope
+
+DIGEST_SCHEDULER_ENABLED = os.getenv("DIGEST_SCHEDULER_ENABLED", "1") == "1"
+# "sqlite" (shared by every worker process on the host, so each digest is built once)
+# or "memory" (only for a single worker process)
+DIGEST_QUEUE_BACKEND = os.getenv("DIGEST_QUEUE_BACKEND", "sqlite")
+DIGEST_QUEUE_PATH = os.getenv("DIGEST_QUEUE_PATH", "digest_jobs.sqlite3")
+# Digests are built this many minutes before the user's summary_time
+DIGEST_LEAD_MINUTES = int(os.getenv("DIGEST_LEAD_MINUTES", "15"))
+DIGEST_POLL_SECONDS = int(os.getenv("DIGEST_POLL_SECONDS", "60"))
+DIGEST_WORKERS = int(os.getenv("DIGEST_WORKERS", "4"))
+DIGEST_MAX_ATTEMPTS = int(os.getenv("DIGEST_MAX_ATTEMPTS", "5"))
+# A running job not finished within this many seconds is assumed lost and re-queued
+DIGEST_JOB_TIMEOUT = int(os.getenv("DIGEST_JOB_TIMEOUT", "900"))
+# Stored digests built for the user's current slot are served as-is by
+# /emails/grouped_summary while younger than this
+DIGEST_MAX_AGE_MINUTES = int(os.getenv("DIGEST_MAX_AGE_MINUTES", "180"))
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class MemoryJobQueue:
+    """
+    In-process job queue with at most one job per user. Enqueueing a user who already
+    has a queued or running job is a no-op; a failed job is replaced by a new slot.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, user_email, slot, run_at=None):
+        with self._lock:
+            job = self._jobs.get(user_email)
+            if job and (job["status"] != "failed" or job["slot"] == slot):
+                return False
+            self._jobs[user_email] = {
+                "user_email": user_email, "slot": slot, "run_at": run_at or time.time(),
+                "attempts": 0, "status": "queued", "claimed_at": None, "last_error": None
+            }
+            return True
+
+    def claim(self):
+        now = time.time()
+        with self._lock:
+            ready = [
+                job for job in self._jobs.values()
+                if (job["status"] == "queued" and job["run_at"] <= now)
+                or (job["status"] == "running" and job["claimed_at"] < now - DIGEST_JOB_TIMEOUT)
+            ]
+            if not ready:
+                return None
+            job = min(ready, key=lambda job: job["run_at"])
+            job.update(status="running", claimed_at=now, attempts=job["attempts"] + 1)
+            return {"user_email": job["user_email"], "slot": job["slot"], "attempts": job["attempts"]}
+
+    def complete(self, user_email):
+        with self._lock:
+            self._jobs.pop(user_email, None)
+
+    def retry(self, user_email, run_at, error):
+        with self._lock:
+            self._jobs[user_email].update(status="queued", run_at=run_at, last_error=error)
+
+    def fail(self, user_email, error):
+        with self._lock:
+            self._jobs[user_email].update(status="failed", last_error=error)
+
+    def stats(self):
+        with self._lock:
+            counts = {"queued": 0, "running": 0, "failed": 0}
+            for job in self._jobs.values():
+                counts[job["status"]] += 1
+            return counts
+
+
+class SQLiteJobQueue:
+    """
+    The same queue in a SQLite table, so several worker processes on one host share
+    it: the user_email primary key deduplicates jobs and claims run in an IMMEDIATE
+    transaction, so each job is handed to exactly one worker.
+    """
+
+    def __init__(self, path=DIGEST_QUEUE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS digest_jobs ("
+            "user_email TEXT PRIMARY KEY, slot TEXT, run_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "status TEXT NOT NULL, claimed_at REAL, last_error TEXT)"
+        )
+
+    def enqueue(self, user_email, slot, run_at=None):
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO digest_jobs (user_email, slot, run_at, status) VALUES (?, ?, ?, 'queued') "
+                "ON CONFLICT (user_email) DO UPDATE SET slot = excluded.slot, run_at = excluded.run_at, "
+                "attempts = 0, status = 'queued', claimed_at = NULL, last_error = NULL "
+                "WHERE digest_jobs.status = 'failed' AND digest_jobs.slot IS NOT excluded.slot",
+                (user_email, slot, run_at or time.time())
+            )
+            return cursor.rowcount > 0
+
+    def claim(self):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT user_email, slot, attempts FROM digest_jobs "
+                    "WHERE (status = 'queued' AND run_at <= ?) OR (status = 'running' AND claimed_at < ?) "
+                    "ORDER BY run_at LIMIT 1",
+                    (now, now - DIGEST_JOB_TIMEOUT)
+                ).fetchone()
+                if row:
+                    self._conn.execute(
+                        "UPDATE digest_jobs SET status = 'running', claimed_at = ?, attempts = attempts + 1 "
+                        "WHERE user_email = ?",
+                        (now, row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        return {"user_email": row[0], "slot": row[1], "attempts": row[2] + 1}
+
+    def complete(self, user_email):
+        with self._lock:
+            self._conn.execute("DELETE FROM digest_jobs WHERE user_email = ?", (user_email,))
+
+    def retry(self, user_email, run_at, error):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE digest_jobs SET status = 'queued', run_at = ?, last_error = ? WHERE user_email = ?",
+                (run_at, error, user_email)
+            )
+
+    def fail(self, user_email, error):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE digest_jobs SET status = 'failed', last_error = ? WHERE user_email = ?", (error, user_email)
+            )
+
+    def stats(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM digest_jobs GROUP BY status").fetchall()
+        counts = {"queued": 0, "running": 0, "failed": 0}
+        counts.update(dict(rows))
+        return counts
+
+
+def new_job_queue():
+    if DIGEST_QUEUE_BACKEND == "sqlite":
+        return SQLiteJobQueue()
+    return MemoryJobQueue()
+
+
+def due_slot(summary_time, now, lead=None):
+    """
+    Returns the summary_time slot ("%Y-%m-%d %H:%M") whose precompute window
+    [slot - lead, slot + lead) contains `now`, or None. Times are server-local.
+    """
+    lead = timedelta(minutes=DIGEST_LEAD_MINUTES if lead is None else lead)
+    try:
+        hour, minute = (int(part) for part in (summary_time or "").split(":")[:2])
+    except ValueError:
+        return None
+    for day in (now.date(), now.date() + timedelta(days=1)):
+        slot = datetime(day.year, day.month, day.day, hour, minute)
+        if slot - lead <= now < slot + lead:
+            return slot.strftime("%Y-%m-%d %H:%M")
+    return None
+
+
+def current_slot(summary_time, now, lead=None):
+    """The latest summary_time slot whose precompute window has opened by `now`, or None."""
+    lead = timedelta(minutes=DIGEST_LEAD_MINUTES if lead is None else lead)
+    try:
+        hour, minute = (int(part) for part in (summary_time or "").split(":")[:2])
+    except ValueError:
+        return None
+    for offset in (1, 0, -1):
+        day = now.date() + timedelta(days=offset)
+        slot = datetime(day.year, day.month, day.day, hour, minute)
+        if slot - lead <= now:
+            return slot.strftime("%Y-%m-%d %H:%M")
+    return None
+
+
+def built_for_slot(stored, slot, lead=None):
+    """
+    Whether a stored digest was computed inside the slot's precompute window, e.g. by
+    a live /emails/grouped_summary request, which saves its digest without a slot.
+    """
+    lead = timedelta(minutes=DIGEST_LEAD_MINUTES if lead is None else lead)
+    try:
+        computed_at = datetime.strptime(stored.get("computed_at") or "", TIME_FORMAT)
+    except ValueError:
+        return False
+    return computed_at >= datetime.strptime(slot, "%Y-%m-%d %H:%M") - lead
+
+
+async def build_digest(user_email, slot=None, gmail_semaphore=None, llm_semaphore=None):
+    """
+    Refreshes the user's important emails, groups them and stores the digest.
+    Returns the stored digest row. The semaphores are passed on to process_messages.
+    """
+    client = await run_blocking(acquire_gmail_client, user_email)
+    if not client or not client["service"]:
+        raise ValueError(f"No Gmail credentials for {user_email}")
+    with usage_scope(user_email, "digest"):
+        important_emails = await shared_refresh_important_emails(
+            client["service"], user_email, client["user_data"].get("history_id"),
+            gmail_semaphore=gmail_semaphore, llm_semaphore=llm_semaphore, synced_from=client["user_data"].get("synced_from"),
+            pending_ids=client["user_data"].get("pending_message_ids")
+        )
+        digest = await run_blocking(group_emails, [grouping_input(email) for email in important_emails])
+    computed_at = datetime.now().strftime(TIME_FORMAT)
+    await run_blocking(save_digest, user_email, digest, len(important_emails), computed_at, slot)
+    return {"user_email": user_email, "digest": digest, "important_count": len(important_emails),
+            "computed_at": computed_at, "slot": slot}
+
+
+def get_fresh_digest(user_email, summary_time, now=None, max_age_minutes=None):
+    """
+    Returns the user's stored digest row if it was built for their current
+    summary_time slot and recently enough, else None. Digests are dropped when new
+    important mail is processed (see mailbox_sync.process_and_store), so a row that
+    is still stored lists everything up to now.
+    """
+    now = now or datetime.now()
+    max_age = timedelta(minutes=DIGEST_MAX_AGE_MINUTES if max_age_minutes is None else max_age_minutes)
+    slot = current_slot(summary_time, now)
+    if slot is None:
+        return None
+    row = get_digest(user_email)
+    if not row or not row.get("computed_at"):
+        return None
+    if row.get("slot") != slot and not built_for_slot(row, slot):
+        return None
+    if datetime.strptime(row["computed_at"], TIME_FORMAT) < now - max_age:
+        return None
+    return row
+
+
+class DigestScheduler:
+    """
+    Precomputes grouped summaries shortly before each user's summary_time.
+
+    A planner polls the users table every DIGEST_POLL_SECONDS and enqueues users whose
+    slot is coming up and who have no digest for it yet; DIGEST_WORKERS workers drain
+    the queue. Failed jobs are retried with jittered exponential backoff up to
+    DIGEST_MAX_ATTEMPTS times.
+    """
+
+    def __init__(self, queue=None, workers=None, poll_seconds=None):
+        self.queue = queue or new_job_queue()
+        self.workers = workers or DIGEST_WORKERS
+        self.poll_seconds = poll_seconds or DIGEST_POLL_SECONDS
+        self._tasks = []
+        self._wake = None
+        self.counters = {"planned": 0, "succeeded": 0, "retried": 0, "failed": 0}
+
+    async def plan_once(self, now=None):
+        """Enqueues every user whose digest is due. Returns how many jobs were added."""
+        now = now or datetime.now()
+        added = 0
+        for user in await run_blocking(get_digest_schedule):
+            slot = due_slot(user.get("summary_time"), now)
+            if slot is None:
+                continue
+            stored = await run_blocking(get_digest, user["email"])
+            if stored and (stored.get("slot") == slot or built_for_slot(stored, slot)):
+                continue
+            if self.queue.enqueue(user["email"], slot):
+                added += 1
+        self.counters["planned"] += added
+        if added and self._wake:
+            self._wake.set()
+        return added
+
+    async def run_job(self, job):
+        try:
+            await build_digest(job["user_email"], job["slot"])
+        except Exception as e:
+            if job["attempts"] >= DIGEST_MAX_ATTEMPTS:
+                self.queue.fail(job["user_email"], str(e))
+                self.counters["failed"] += 1
+                print(f"Digest for {job['user_email']} failed after {job['attempts']} attempts: {e}")
+            else:
+                delay = backoff_delay(job["attempts"] - 1, base=30.0, cap=900.0)
+                self.queue.retry(job["user_email"], time.time() + delay, str(e))
+                self.counters["retried"] += 1
+            return False
+        self.queue.complete(job["user_email"])
+        self.counters["succeeded"] += 1
+        return True
+
+    async def _planner(self):
+        while True:
+            try:
+                await self.plan_once()
+            except Exception as e:
+                print(f"Digest planning failed: {e}")
+            await asyncio.sleep(self.poll_seconds)
+
+    async def _worker(self):
+        while True:
+            job = await run_blocking(self.queue.claim)
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.run_job(job)
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._planner())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        return {"running": bool(self._tasks), "workers": self.workers, "queue": self.queue.stats(), **self.counters}
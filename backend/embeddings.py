@@ -0,0 +1,286 @@
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from components import register, get_component, is_loaded
+from metrics import traced
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+# "torch" (SentenceTransformer, full precision), "onnx" (int8-quantized ONNX Runtime
+# export, see export_onnx_embedder.py) or "fake" (hashed bag of words, for benchmarks)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# Directory holding the quantized model.onnx and tokenizer.json of the onnx backend
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", "models/all-MiniLM-L6-v2-int8")
+# Intra-op threads for ONNX Runtime; 0 lets it use every core
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+# all-MiniLM-L6-v2 truncates at 256 word pieces; the onnx backend does the same
+EMBEDDING_MAX_TOKENS = 256
+EMBEDDING_DIM = 384
+# Concurrent encode calls arriving within this many milliseconds of each other are
+# merged into one model call, up to EMBEDDING_MAX_BATCH texts; 0 disables merging
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_MAX_BATCH = int(os.getenv("EMBEDDING_MAX_BATCH", "64"))
+
+
+def normalize_rows(matrix):
+    import numpy as np
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.ascontiguousarray(matrix / np.maximum(norms, 1e-12), dtype=np.float32)
+
+
+class TorchEmbedder:
+    """The SentenceTransformer model in full-precision PyTorch."""
+
+    name = "torch"
+
+    def __init__(self, model_name=EMBEDDING_MODEL):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, texts, batch_size=64):
+        import numpy as np
+        embeddings = self.model.encode(
+            list(texts),
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+class OnnxEmbedder:
+    """
+    The same model exported to ONNX with int8 weights (dynamic quantization), run on
+    ONNX Runtime's CPU provider with the model's fast tokenizer. Mean pooling over the
+    attention mask and L2 normalization reproduce the SentenceTransformer pipeline, so
+    its vectors can stand in for TorchEmbedder's (see bench_embeddings.py for the drift).
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_dir=EMBEDDING_ONNX_DIR, threads=EMBEDDING_THREADS):
+        import onnxruntime
+        from tokenizers import Tokenizer
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, "model.onnx"), options,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_names = {item.name for item in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=EMBEDDING_MAX_TOKENS)
+        self.tokenizer.enable_padding()
+
+    def encode(self, texts, batch_size=64):
+        import numpy as np
+        texts = list(texts)
+        chunks = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + batch_size])
+            mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+            inputs = {
+                "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+                "attention_mask": mask,
+                "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+            }
+            hidden = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+            weights = mask[:, :, None].astype(np.float32)
+            chunks.append((hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9))
+        if not chunks:
+            return np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        return normalize_rows(np.vstack(chunks))
+
+
+class FakeEmbedder:
+    """
+    Hashed bag-of-words vectors, deterministic and dependency-free, that cost
+    `call_seconds` per model call plus `text_seconds` per text, like a real model's
+    fixed per-call overhead. Calls run one at a time, as concurrent calls would
+    contend for the CPU. For benchmarks of the batching around the model.
+    """
+
+    name = "fake"
+
+    def __init__(self, call_seconds=0.0, text_seconds=0.0, dimension=EMBEDDING_DIM):
+        self.call_seconds = call_seconds
+        self.text_seconds = text_seconds
+        self.dimension = dimension
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def encode(self, texts, batch_size=64):
+        import numpy as np
+        texts = list(texts)
+        with self._lock:
+            self.calls += 1
+            if self.call_seconds or self.text_seconds:
+                time.sleep(self.call_seconds + self.text_seconds * len(texts))
+        matrix = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                value = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "big")
+                matrix[row, value % self.dimension] += 1.0 if value >> 63 else -1.0
+        return normalize_rows(matrix)
+
+
+BACKENDS = {"torch": TorchEmbedder, "onnx": OnnxEmbedder, "fake": FakeEmbedder}
+
+
+def load_embedder():
+    if EMBEDDING_BACKEND == "onnx":
+        try:
+            return OnnxEmbedder()
+        except Exception as e:
+            print(f"ONNX embedder unavailable, falling back to PyTorch: {e}")
+        return TorchEmbedder()
+    return BACKENDS[EMBEDDING_BACKEND]()
+
+
+# The model is loaded on first use or by the startup warm-up; see components.py
+register("embedder", load_embedder)
+_embedder_override = None
+
+
+def set_embedder(embedder):
+    """Replaces the embedder (e.g. with a FakeEmbedder); pass None to go back to EMBEDDING_BACKEND."""
+    global _embedder_override
+    _embedder_override = embedder
+
+
+def get_embedder():
+    """Returns the process-wide embedding backend, loading it on first use."""
+    return _embedder_override or get_component("embedder")
+
+
+class _Request:
+    def __init__(self, texts):
+        self.texts = texts
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Merges encode calls made concurrently from different threads into one model call.
+    A caller's texts wait at most `window` seconds for others to join them; the batch
+    is sent early once it holds `max_batch` texts. Calls of `max_batch` texts or more
+    are already a full batch and go straight to the model.
+
+    One worker thread makes the model calls, so requests that arrive while a batch is
+    being encoded are merged into the next one.
+    """
+
+    def __init__(self, window=None, max_batch=None):
+        self.window = EMBEDDING_BATCH_WINDOW_MS / 1000 if window is None else window
+        self.max_batch = max_batch or EMBEDDING_MAX_BATCH
+        self._queue = deque()
+        self._queued_texts = 0
+        self._condition = threading.Condition()
+        self._worker = None
+        self.stats = {"requests": 0, "texts": 0, "model_calls": 0, "merged_requests": 0}
+
+    def _count(self, requests, texts, model_calls):
+        with self._condition:
+            self.stats["requests"] += requests
+            self.stats["texts"] += texts
+            self.stats["model_calls"] += model_calls
+            self.stats["merged_requests"] += max(0, requests - model_calls)
+
+    def snapshot(self):
+        with self._condition:
+            return dict(self.stats)
+
+    def encode(self, texts):
+        import numpy as np
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        if len(texts) >= self.max_batch or not self.window:
+            self._count(1, len(texts), 1)
+            return get_embedder().encode(texts, batch_size=self.max_batch)
+        request = _Request(texts)
+        with self._condition:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+            self._queue.append((time.monotonic(), request))
+            self._queued_texts += len(texts)
+            self._condition.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+            deadline = self._queue[0][0] + self.window
+            while self._queued_texts < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = []
+            size = 0
+            while self._queue and (not batch or size + len(self._queue[0][1].texts) <= self.max_batch):
+                _, request = self._queue.popleft()
+                batch.append(request)
+                size += len(request.texts)
+            self._queued_texts -= size
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            texts = [text for request in batch for text in request.texts]
+            try:
+                embeddings = get_embedder().encode(texts, batch_size=self.max_batch)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+            self._count(len(batch), len(texts), 1)
+            start = 0
+            for request in batch:
+                request.result = embeddings[start:start + len(request.texts)]
+                start += len(request.texts)
+                request.done.set()
+
+
+_batcher = MicroBatcher()
+
+
+def set_batcher(batcher):
+    global _batcher
+    _batcher = batcher
+
+
+def embedding_stats():
+    """Encode requests, texts and model calls so far, and the backend in use (or configured, until loaded)."""
+    stats = _batcher.snapshot()
+    embedder = _embedder_override or (get_component("embedder") if is_loaded("embedder") else None)
+    stats["backend"] = embedder.name if embedder is not None else EMBEDDING_BACKEND
+    stats["texts_per_model_call"] = round(stats["texts"] / stats["model_calls"], 2) if stats["model_calls"] else 0.0
+    return stats
+
+
+def email_text(email):
+    # Emails that were only fetched as metadata have no body; their snippet stands in
+    body = email.get("body") or email.get("snippet", "")
+    return f"Subject: {email.get('subject', '')}\nSender: {email.get('sender', '')}\nBody: {body}"
+
+
+@traced("embeddings.encode")
+def encode_texts(texts):
+    """
+    Encodes all texts and returns an (n, dim) float32 matrix of L2-normalized rows, so
+    inner products are cosine similarities. Small calls from concurrent requests (a
+    search query, a handful of new emails) share model calls through the MicroBatcher.
+    """
+    return _batcher.encode(texts)
@@ -0,0 +1,69 @@
+"""
+Offline evaluation of the embedding pre-classifier.
+
+Takes a JSON file of labelled emails ([{"subject", "sender", "snippet", "label"}], with
+label "important" or "junk"), runs k-fold cross-validation of the nearest-centroid
+model (seed examples + training folds) and prints, for each threshold, how many
+emails are decided locally, how accurate those local decisions are, and how many
+classifier LLM calls they avoid.
+
+    python eval_preclassifier.py labelled_emails.json --thresholds 0.05 0.1 0.15 0.2
+"""
+import argparse
+import json
+import random
+import numpy as np
+from preclassifier import SEED_EXAMPLES, fit_centroids, score_emails
+from classifier import plan_classify_batches
+
+
+def evaluate(examples, thresholds, folds=5, seed=0):
+    examples = list(examples)
+    random.Random(seed).shuffle(examples)
+    scores = np.zeros(len(examples), dtype=np.float32)
+    for fold in range(folds):
+        test_idx = [i for i in range(len(examples)) if i % folds == fold]
+        train = SEED_EXAMPLES + [examples[i] for i in range(len(examples)) if i % folds != fold]
+        centroids = fit_centroids(train)
+        scores[test_idx] = score_emails([examples[i] for i in test_idx], centroids)
+
+    labels = np.array([example["label"] == "important" for example in examples])
+    report = []
+    for threshold in thresholds:
+        important = scores >= threshold
+        junk = scores <= -threshold
+        decided = important | junk
+        correct = (important & labels) | (junk & ~labels)
+        uncertain = int((~decided).sum())
+        # Classifier requests are packed by token budget (classifier.plan_classify_batches)
+        llm_calls = len(plan_classify_batches([example for example, done in zip(examples, decided) if not done]))
+        report.append({
+            "threshold": threshold,
+            "emails": len(examples),
+            "decided_locally": int(decided.sum()),
+            "coverage": round(float(decided.mean()), 4),
+            "local_accuracy": round(float(correct.sum() / decided.sum()), 4) if decided.any() else None,
+            # Important mail wrongly dropped as junk is the costly mistake
+            "important_marked_junk": int((junk & labels).sum()),
+            "uncertain": uncertain,
+            "llm_calls": llm_calls,
+            "llm_calls_avoided": len(plan_classify_batches(examples)) - llm_calls,
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data", help="JSON file of labelled emails")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.05, 0.1, 0.15, 0.2])
+    parser.add_argument("--folds", type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.data) as f:
+        examples = json.load(f)
+    for row in evaluate(examples, args.thresholds, folds=args.folds):
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()
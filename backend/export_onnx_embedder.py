@@ -0,0 +1,50 @@
+"""
+Exports the SentenceTransformer embedding model to ONNX and quantizes its weights
+to int8, for EMBEDDING_BACKEND=onnx (see embeddings.OnnxEmbedder). Needs
+sentence-transformers, onnx and onnxruntime; the API workers then need only
+onnxruntime and tokenizers.
+
+Writes model.onnx (int8), model-fp32.onnx and tokenizer.json to the output directory.
+
+    python export_onnx_embedder.py --output models/all-MiniLM-L6-v2-int8
+"""
+import argparse
+import os
+from embeddings import EMBEDDING_MODEL, EMBEDDING_ONNX_DIR, EMBEDDING_MAX_TOKENS
+
+
+def export(model_name, output_dir, opset=14):
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    os.makedirs(output_dir, exist_ok=True)
+    transformer = SentenceTransformer(model_name, device="cpu")[0]
+    transformer.tokenizer.save_pretrained(output_dir)
+    model = transformer.auto_model.eval()
+
+    sample = transformer.tokenizer(["An example email"], padding=True, truncation=True,
+                                   max_length=EMBEDDING_MAX_TOKENS, return_tensors="pt")
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    axes = {name: {0: "batch", 1: "tokens"} for name in names}
+    fp32_path = os.path.join(output_dir, "model-fp32.onnx")
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(sample[name] for name in names), fp32_path, input_names=names,
+                          output_names=["last_hidden_state"],
+                          dynamic_axes=dict(axes, last_hidden_state={0: "batch", 1: "tokens"}),
+                          opset_version=opset)
+    # Dynamic quantization: int8 weights, activations quantized per call, no calibration data needed
+    quantize_dynamic(fp32_path, os.path.join(output_dir, "model.onnx"), weight_type=QuantType.QInt8)
+    return output_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--output", default=EMBEDDING_ONNX_DIR)
+    args = parser.parse_args()
+    print(f"Exported {args.model} to {export(args.model, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
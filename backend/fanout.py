@@ -0,0 +1,316 @@
+"""
+Builds grouped-summary digests for many users in one run, without one HTTP call per
+user: users are spread over a pool of worker processes, each processing several
+users at once through the usual fetch -> classify -> summarize -> group pipeline.
+
+    python fanout.py                          # every user in the Supabase users table
+    python fanout.py --user a@x.com --user b@y.com --processes 2
+    python fanout.py --run-id 20250401-0600   # resume an interrupted run
+
+Progress is checkpointed per user in SQLite; running again with the same --run-id
+skips the users that already finished.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import sqlite3
+import time
+from datetime import datetime
+from supabase_client import get_digest_schedule
+
+FANOUT_PROCESSES = int(os.getenv("FANOUT_PROCESSES", str(os.cpu_count() or 2)))
+# Users each worker process works on at the same time
+FANOUT_USERS_PER_PROCESS = int(os.getenv("FANOUT_USERS_PER_PROCESS", "8"))
+# Gmail batch requests and LLM calls in flight per worker process, shared fairly by its users
+FANOUT_GMAIL_SLOTS = int(os.getenv("FANOUT_GMAIL_SLOTS", "4"))
+FANOUT_LLM_SLOTS = int(os.getenv("FANOUT_LLM_SLOTS", "8"))
+FANOUT_MAX_ATTEMPTS = int(os.getenv("FANOUT_MAX_ATTEMPTS", "3"))
+FANOUT_CHECKPOINT_PATH = os.getenv("FANOUT_CHECKPOINT_PATH", "fanout_checkpoint.sqlite3")
+# Quotas for the whole run (0 = unlimited), split evenly between the worker processes
+FANOUT_LLM_RPM = int(os.getenv("FANOUT_LLM_RPM", "0"))
+FANOUT_LLM_TPM = int(os.getenv("FANOUT_LLM_TPM", "0"))
+FANOUT_GMAIL_UNITS_PER_MINUTE = int(os.getenv("FANOUT_GMAIL_UNITS_PER_MINUTE", "0"))
+
+
+class FairSlots:
+    """
+    A fixed number of slots shared by the users a worker processes at once. A freed
+    slot goes to the waiting user who holds the fewest slots (the longest waiting
+    among equals), so one large mailbox cannot starve the others the way it would
+    with a FIFO semaphore.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.used = 0
+        self.in_use = {}
+        self._waiters = []
+        self._order = itertools.count()
+
+    def for_user(self, user):
+        """An async context manager that holds one slot on behalf of `user`."""
+        return _UserSlot(self, user)
+
+    def _take(self, user):
+        self.used += 1
+        self.in_use[user] = self.in_use.get(user, 0) + 1
+
+    def _grant(self):
+        while self.used < self.capacity and self._waiters:
+            waiter = min(self._waiters, key=lambda w: (self.in_use.get(w[0], 0), w[1]))
+            self._waiters.remove(waiter)
+            user, _, future = waiter
+            if not future.done():
+                self._take(user)
+                future.set_result(None)
+
+    async def acquire(self, user):
+        if self.used < self.capacity and not self._waiters:
+            self._take(user)
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiter = (user, next(self._order), future)
+        self._waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            else:
+                # The slot was granted just as the caller was cancelled
+                self.release(user)
+            raise
+
+    def release(self, user):
+        self.used -= 1
+        self.in_use[user] -= 1
+        if not self.in_use[user]:
+            del self.in_use[user]
+        self._grant()
+
+
+class _UserSlot:
+    def __init__(self, slots, user):
+        self.slots = slots
+        self.user = user
+
+    async def __aenter__(self):
+        await self.slots.acquire(self.user)
+
+    async def __aexit__(self, *exc):
+        self.slots.release(self.user)
+
+
+class Checkpoint:
+    """Per-user outcome of each fan-out run, in SQLite, so an interrupted run can resume."""
+
+    def __init__(self, path, run_id):
+        self.run_id = run_id
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fanout_users ("
+            "run_id TEXT NOT NULL, user_email TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL, "
+            "important_count INTEGER, seconds REAL, error TEXT, finished_at TEXT, PRIMARY KEY (run_id, user_email))"
+        )
+        self._conn.commit()
+
+    def finished(self):
+        """Users this run already built a digest for."""
+        rows = self._conn.execute(
+            "SELECT user_email FROM fanout_users WHERE run_id = ? AND status = 'done'", (self.run_id,)
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def record(self, result):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO fanout_users VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.run_id, result["user_email"], "done" if result["ok"] else "failed", result["attempt"],
+             result.get("important_count"), result["seconds"], result.get("error"),
+             datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        )
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def list_users():
+    """Every user's email from the Supabase users table."""
+    return [user["email"] for user in get_digest_schedule() if user.get("email")]
+
+
+def worker_main(tasks, results, config):
+    """Entry point of a worker process: builds digests for users taken from `tasks`."""
+    # The pipeline sizes its thread pool from these when it is first imported
+    os.environ["GMAIL_CONCURRENCY"] = str(config["gmail_slots"])
+    os.environ["LLM_CONCURRENCY"] = str(config["llm_slots"])
+    asyncio.run(_run_worker(tasks, results, config))
+
+
+async def _run_worker(tasks, results, config):
+    from digest_scheduler import build_digest
+    from gmail_batch import set_gmail_quota
+    from llm_gateway import set_rate_limits
+
+    set_rate_limits(config["llm_rpm"], config["llm_tpm"])
+    set_gmail_quota(config["gmail_units_per_minute"])
+    gmail_slots = FairSlots(config["gmail_slots"])
+    llm_slots = FairSlots(config["llm_slots"])
+    loop = asyncio.get_running_loop()
+
+    async def run_users():
+        while True:
+            job = await loop.run_in_executor(None, tasks.get)
+            if job is None:
+                return
+            user_email = job["user_email"]
+            result = {"user_email": user_email, "attempt": job["attempt"], "ok": True, "pid": os.getpid()}
+            started = time.perf_counter()
+            try:
+                digest = await build_digest(
+                    user_email, gmail_semaphore=gmail_slots.for_user(user_email),
+                    llm_semaphore=llm_slots.for_user(user_email)
+                )
+                result["important_count"] = digest["important_count"]
+            except Exception as e:
+                result.update(ok=False, error=str(e))
+            result["seconds"] = round(time.perf_counter() - started, 3)
+            results.put(result)
+
+    await asyncio.gather(*(run_users() for _ in range(config["users_per_process"])))
+
+
+def run_fanout(users=None, run_id=None, processes=None, users_per_process=None, checkpoint_path=None,
+               llm_rpm=None, llm_tpm=None, gmail_units_per_minute=None, max_attempts=None, on_result=None):
+    """
+    Builds and stores the digest of every user in `users` (default: all users in
+    Supabase) across `processes` worker processes, each working on `users_per_process`
+    users at once with Gmail and LLM slots shared fairly between them. The run-wide
+    LLM and Gmail quotas are split evenly between the processes.
+
+    Users that fail are put back at the end of the queue, up to `max_attempts` tries.
+    Each user's outcome is checkpointed under `run_id` as soon as it is known, and
+    users already done under that run_id are skipped, so an interrupted run resumes
+    by calling this again with the same run_id. If a worker process dies, the
+    outcomes already reported are recorded and RuntimeError is raised, since the
+    users it was building would otherwise never finish. `on_result`, if given, is called with
+    each user's outcome dict.
+
+    Returns a summary: run_id, users, skipped, succeeded, failed, retried, seconds
+    and users_per_minute.
+    """
+    users = list(dict.fromkeys(list_users() if users is None else users))
+    run_id = run_id or datetime.now().strftime("%Y%m%d-%H%M%S")
+    max_attempts = max_attempts or FANOUT_MAX_ATTEMPTS
+    users_per_process = users_per_process or FANOUT_USERS_PER_PROCESS
+    checkpoint = Checkpoint(checkpoint_path or FANOUT_CHECKPOINT_PATH, run_id)
+    done = checkpoint.finished()
+    pending = [user for user in users if user not in done]
+    processes = max(1, min(processes or FANOUT_PROCESSES, len(pending)))
+
+    def per_process(quota):
+        # A share of 0 would mean unlimited, so a quota smaller than the process count still allows 1
+        return max(1, quota // processes) if quota > 0 else 0
+
+    config = {
+        "users_per_process": users_per_process,
+        "gmail_slots": FANOUT_GMAIL_SLOTS,
+        "llm_slots": FANOUT_LLM_SLOTS,
+        "llm_rpm": per_process(FANOUT_LLM_RPM if llm_rpm is None else llm_rpm),
+        "llm_tpm": per_process(FANOUT_LLM_TPM if llm_tpm is None else llm_tpm),
+        "gmail_units_per_minute": per_process(
+            FANOUT_GMAIL_UNITS_PER_MINUTE if gmail_units_per_minute is None else gmail_units_per_minute
+        ),
+    }
+    summary = {"run_id": run_id, "users": len(users), "skipped": len(users) - len(pending),
+               "succeeded": 0, "failed": 0, "retried": 0}
+    started = time.perf_counter()
+
+    # Worker processes are spawned rather than forked: the parent may already hold
+    # threads and open connections that must not be copied into a child.
+    context = multiprocessing.get_context("spawn")
+    tasks, results = context.Queue(), context.Queue()
+    workers = []
+    if pending:
+        workers = [context.Process(target=worker_main, args=(tasks, results, config), daemon=True)
+                   for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for user in pending:
+        tasks.put({"user_email": user, "attempt": 1})
+
+    outstanding = len(pending)
+    dead = None
+    try:
+        while outstanding:
+            try:
+                result = results.get(timeout=0.2 if dead else 1)
+            except queue.Empty:
+                if dead:
+                    # Whatever the dead worker was building will never be reported; the
+                    # outcomes that did arrive are checkpointed, so the run can resume
+                    raise RuntimeError(f"Fan-out worker {dead.pid} exited with code {dead.exitcode} during run "
+                                       f"{run_id}; run again with the same run_id to finish the remaining users")
+                dead = next((worker for worker in workers if worker.exitcode is not None), None)
+                continue
+            if not result["ok"] and result["attempt"] < max_attempts:
+                tasks.put({"user_email": result["user_email"], "attempt": result["attempt"] + 1})
+                summary["retried"] += 1
+                continue
+            checkpoint.record(result)
+            outstanding -= 1
+            summary["succeeded" if result["ok"] else "failed"] += 1
+            if on_result is not None:
+                on_result(result)
+    except BaseException:
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        checkpoint.close()
+
+    for _ in range(len(workers) * users_per_process):
+        tasks.put(None)
+    for worker in workers:
+        worker.join(timeout=30)
+        if worker.is_alive():
+            worker.terminate()
+
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    processed = summary["succeeded"] + summary["failed"]
+    summary["users_per_minute"] = round(processed * 60 / summary["seconds"], 1) if summary["seconds"] else 0.0
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user", action="append", dest="users", help="user email (repeatable; default: all users)")
+    parser.add_argument("--run-id", help="checkpoint name; reuse it to resume an interrupted run")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--users-per-process", type=int)
+    parser.add_argument("--checkpoint", help=f"SQLite checkpoint file (default {FANOUT_CHECKPOINT_PATH})")
+    parser.add_argument("--llm-rpm", type=int)
+    parser.add_argument("--llm-tpm", type=int)
+    parser.add_argument("--gmail-units-per-minute", type=int)
+    parser.add_argument("--max-attempts", type=int)
+    args = parser.parse_args()
+
+    def on_result(result):
+        print(json.dumps(result))
+
+    summary = run_fanout(
+        users=args.users, run_id=args.run_id, processes=args.processes, users_per_process=args.users_per_process,
+        checkpoint_path=args.checkpoint, llm_rpm=args.llm_rpm, llm_tpm=args.llm_tpm,
+        gmail_units_per_minute=args.gmail_units_per_minute, max_attempts=args.max_attempts, on_result=on_result
+    )
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import os
+import random
+import time
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+from llm_gateway import TokenBucket
+from metrics import traced, count
+
+GMAIL_BATCH_URI = os.getenv("GMAIL_BATCH_URI", "https://gmail.googleapis.com/batch/gmail/v1")
+# Gmail accepts up to 100 calls per batch but starts rate limiting well before that;
+# 50 is the size Google recommends.
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+GMAIL_BATCH_MAX_RETRIES = int(os.getenv("GMAIL_BATCH_MAX_RETRIES", "4"))
+# Gmail API quota units per minute this process may spend on messages().get; 0 disables
+# the limit. Each get costs MESSAGE_GET_UNITS, inside a batch or not.
+GMAIL_QUOTA_UNITS_PER_MINUTE = int(os.getenv("GMAIL_QUOTA_UNITS_PER_MINUTE", "0"))
+MESSAGE_GET_UNITS = 5
+
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded", "concurrentLimitExceeded"}
+
+_quota = TokenBucket(GMAIL_QUOTA_UNITS_PER_MINUTE)
+
+
+def set_gmail_quota(units_per_minute=0):
+    global _quota
+    _quota = TokenBucket(units_per_minute)
+
+
+def is_retryable_error(exception):
+    """
+    Returns True for errors worth retrying: 429s, 5xx responses and the 403 variants
+    Gmail uses to signal per-user rate limiting.
+    """
+    if not isinstance(exception, HttpError):
+        return False
+    status = exception.resp.status
+    if status == 429 or status >= 500:
+        return True
+    if status == 403:
+        reasons = {detail.get("reason") for detail in (exception.error_details or []) if isinstance(detail, dict)}
+        return bool(reasons & RATE_LIMIT_REASONS) or "rateLimitExceeded" in str(exception)
+    return False
+
+
+def backoff_delay(attempt, base=0.5, cap=16.0):
+    """Full-jitter exponential backoff delay in seconds for the given retry attempt."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class CountingHttp:
+    """Wraps an httplib2-style transport and counts the response bytes it receives."""
+
+    def __init__(self, http):
+        self.http = http
+        self.bytes = 0
+
+    def request(self, *args, **kwargs):
+        response, content = self.http.request(*args, **kwargs)
+        self.bytes += len(content or b"")
+        return response, content
+
+    def __getattr__(self, name):
+        # credentials etc. are looked up on the wrapped transport by googleapiclient
+        return getattr(self.http, name)
+
+
+@traced("gmail.messages.get")
+def fetch_messages_batched(service, message_ids, format="full", batch_size=None,
+                           max_retries=None, batch_uri=None, http=None, **get_kwargs):
+    """
+    Fetches Gmail messages through the batch endpoint, packing up to `batch_size`
+    messages().get calls into a single HTTP round-trip.
+
+    Items that fail with a rate-limit or server error are re-queued and retried with
+    jittered exponential backoff; a failure of the whole batch request is retried the
+    same way. Items that fail permanently (e.g. 404) are reported in 'errors' instead
+    of being silently dropped. Pass `http` to send the batches over a transport other
+    than the service's own, e.g. one per thread. Every batch first takes its quota
+    units from the process-wide GMAIL_QUOTA_UNITS_PER_MINUTE bucket.
+
+    Returns a dict with:
+      - 'messages': {message_id: message resource}
+      - 'errors': {message_id: error description}
+      - 'retry_later': the ids in 'errors' that failed for transient reasons (given up
+        after retries, or the whole batch request failed) rather than for the message
+        itself (e.g. 404), and are worth fetching again later
+      - 'round_trips': number of batch HTTP requests sent
+      - 'bytes': response bytes received (after transfer decoding)
+      - 'seconds': wall time spent, including retries
+    """
+    batch_size = batch_size or GMAIL_BATCH_SIZE
+    max_retries = GMAIL_BATCH_MAX_RETRIES if max_retries is None else max_retries
+    batch_uri = batch_uri or GMAIL_BATCH_URI
+    http = CountingHttp(http or service._http)
+    started = time.perf_counter()
+
+    messages = {}
+    errors = {}
+    retry_later = set()
+    round_trips = 0
+    pending = list(dict.fromkeys(message_ids))
+    attempt = 0
+
+    while pending:
+        retry = []
+        for i in range(0, len(pending), batch_size):
+            chunk = pending[i:i + batch_size]
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    messages[request_id] = response
+                elif is_retryable_error(exception):
+                    retry.append(request_id)
+                else:
+                    errors[request_id] = str(exception)
+
+            batch = BatchHttpRequest(callback=callback, batch_uri=batch_uri)
+            for message_id in chunk:
+                batch.add(
+                    service.users().messages().get(userId="me", id=message_id, format=format, **get_kwargs),
+                    request_id=message_id
+                )
+            _quota.acquire(len(chunk) * MESSAGE_GET_UNITS)
+            round_trips += 1
+            count("upstream_calls_total", upstream="gmail", operation="gmail.batch")
+            try:
+                batch.execute(http=http)
+            except Exception as e:
+                count("upstream_errors_total", upstream="gmail", operation="gmail.batch")
+                # The batch request itself failed; every item in it is still outstanding.
+                if is_retryable_error(e) or not isinstance(e, HttpError):
+                    retry.extend(mid for mid in chunk if mid not in messages and mid not in errors and mid not in retry)
+                else:
+                    for mid in chunk:
+                        if mid not in messages and mid not in errors:
+                            errors[mid] = str(e)
+                            retry_later.add(mid)
+
+        if not retry:
+            break
+        count("upstream_retries_total", len(retry), upstream="gmail")
+        if attempt >= max_retries:
+            for mid in retry:
+                errors[mid] = "Gave up after rate limiting or repeated server errors"
+                retry_later.add(mid)
+            break
+        time.sleep(backoff_delay(attempt))
+        attempt += 1
+        pending = retry
+
+    if errors:
+        count("upstream_errors_total", len(errors), upstream="gmail", operation="gmail.messages.get")
+    count("upstream_bytes_total", http.bytes, upstream="gmail")
+    return {
+        "messages": messages,
+        "errors": errors,
+        "retry_later": sorted(retry_later),
+        "round_trips": round_trips,
+        "bytes": http.bytes,
+        "seconds": round(time.perf_counter() - started, 3)
+    }
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import httplib2
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp, Request as HttplibRequest
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import HttpRequest
+from supabase_client import get_user_credentials, update_user_tokens
+
+# Pooled clients are rebuilt after this many seconds so credential changes made
+# elsewhere (re-login, revocation) are picked up; idle users fall out via LRU.
+GMAIL_POOL_TTL = int(os.getenv("GMAIL_POOL_TTL", "900"))
+GMAIL_POOL_MAX_USERS = int(os.getenv("GMAIL_POOL_MAX_USERS", "1000"))
+GMAIL_HTTP_TIMEOUT = int(os.getenv("GMAIL_HTTP_TIMEOUT", "60"))
+# Overrides https://gmail.googleapis.com/, e.g. to run against stubs.FakeGmailServer
+GMAIL_API_ENDPOINT = os.getenv("GMAIL_API_ENDPOINT")
+TOKEN_URI = "https://oauth2.googleapis.com/token"
+
+_pool = OrderedDict()
+_pool_lock = threading.Lock()
+_thread_local = threading.local()
+_discovery_doc = None
+
+
+def shared_http():
+    """
+    One keep-alive httplib2 connection pool per thread, shared by every user's
+    requests on that thread. httplib2 objects are not thread-safe, so they are never
+    shared across threads.
+    """
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = _thread_local.http = httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT)
+    return http
+
+
+def gmail_discovery_doc():
+    """The Gmail discovery document, read and parsed once per process."""
+    global _discovery_doc
+    if _discovery_doc is None:
+        import json
+        _discovery_doc = json.loads(get_static_doc("gmail", "v1"))
+    return _discovery_doc
+
+
+class PersistingCredentials(Credentials):
+    """OAuth credentials that write rotated tokens back to Supabase after each refresh."""
+
+    def __init__(self, *args, user_email=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._user_email = user_email
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self, request):
+        with self._refresh_lock:
+            old_token = self.token
+            super().refresh(request)
+            if self.token != old_token and self._user_email:
+                try:
+                    update_user_tokens(self._user_email, self.token, self.refresh_token)
+                except Exception as e:
+                    print(f"Failed to store refreshed token for {self._user_email}: {e}")
+
+
+def build_gmail_service(credentials):
+    """
+    Builds a Gmail service from the cached discovery document. Every request it creates
+    runs over the calling thread's shared keep-alive connection, authorized with
+    `credentials`, so one service can be used from several threads at once.
+    """
+    def request_builder(http, *args, **kwargs):
+        return HttpRequest(AuthorizedHttp(credentials, http=shared_http()), *args, **kwargs)
+
+    return build_from_document(
+        gmail_discovery_doc(),
+        http=AuthorizedHttp(credentials, http=shared_http()),
+        requestBuilder=request_builder,
+        client_options={"api_endpoint": GMAIL_API_ENDPOINT} if GMAIL_API_ENDPOINT else None
+    )
+
+
+def make_credentials(user_email, access_token, refresh_token, scopes=None):
+    return PersistingCredentials(
+        token=access_token,
+        refresh_token=refresh_token,
+        token_uri=TOKEN_URI,
+        client_id=os.getenv("GOOGLE_CLIENT_ID"),
+        client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
+        scopes=scopes,
+        user_email=user_email
+    )
+
+
+def acquire_gmail_client(user_email, scopes=None):
+    """
+    Returns the pooled {"user_data", "credentials", "service"} entry for a user,
+    loading credentials from Supabase and building the service only on a pool miss.
+    'service' is None when the user has no access token. Returns None for unknown users.
+
+    Credentials that are known to be expired are refreshed here; otherwise google-auth
+    refreshes them on the first 401. Either way the new token is saved to Supabase.
+    """
+    now = time.monotonic()
+    with _pool_lock:
+        entry = _pool.get(user_email)
+        if entry and entry["expires_at"] > now:
+            _pool.move_to_end(user_email)
+        else:
+            entry = None
+
+    if entry is None:
+        user_data = get_user_credentials(user_email)
+        if not user_data:
+            return None
+        credentials = service = None
+        if user_data.get("access_token"):
+            credentials = make_credentials(user_email, user_data["access_token"], user_data.get("refresh_token"), scopes)
+            service = build_gmail_service(credentials)
+        entry = {"user_data": user_data, "credentials": credentials, "service": service, "expires_at": now + GMAIL_POOL_TTL}
+        with _pool_lock:
+            _pool[user_email] = entry
+            _pool.move_to_end(user_email)
+            while len(_pool) > GMAIL_POOL_MAX_USERS:
+                _pool.popitem(last=False)
+
+    credentials = entry["credentials"]
+    if credentials is not None and credentials.expired and credentials.refresh_token:
+        credentials.refresh(HttplibRequest(shared_http()))
+    return entry
+
+
+def update_pooled_user(user_email, **fields):
+    """Keeps the pooled copy of a user's row in step with writes made through supabase_client."""
+    with _pool_lock:
+        entry = _pool.get(user_email)
+        if entry:
+            entry["user_data"].update(fields)
+
+
+def evict_user(user_email):
+    with _pool_lock:
+        _pool.pop(user_email, None)
@@ -1,10 +1,17 @@
 import os
-import openai
 import json
 from dotenv import load_dotenv
+from llm_cache import make_key, get_cached, set_cached
+from llm_gateway import chat_completion
+from metrics import span
+from prompt_encoding import compact_json, table
 
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+
+GROUPING_MODEL = "gpt-3.5-turbo"
+# Bump when the prompt below changes so cached digests are not reused
+GROUPING_PROMPT_VERSION = "group-v2"
+GROUPING_FIELDS = ("subject", "sender", "summary", "time", "suggested_reply")
 
 def group_emails_by_llm(emails):
     """
@@ -32,12 +39,58 @@ def group_emails_by_llm(emails):
     Ensure there is an extra blank line between each email for readability.
     Return only the final grouped summary text as plain Markdown with no introductory commentary.
     """
-    # Convert emails to JSON for the LLM
-    emails_json = json.dumps(emails, indent=2)
+    cache_key = grouping_cache_key(emails)
+    cached = get_cached("group", cache_key)
+    if cached is not None:
+        return cached
+
+    with span("llm.group"):
+        response = chat_completion(
+            model=GROUPING_MODEL,
+            messages=grouping_messages(emails),
+            temperature=0.5
+        )
     
+    grouped = response.choices[0].message["content"]
+    set_cached("group", cache_key, grouped)
+    return grouped
+
+def stream_group_emails_by_llm(emails):
+    """
+    Same as group_emails_by_llm, but yields the Markdown digest piece by piece as the
+    model produces it. A cached digest is yielded whole; a completed stream is cached.
+    """
+    cache_key = grouping_cache_key(emails)
+    cached = get_cached("group", cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    parts = []
+    # The span covers the whole stream, including time the consumer spends between tokens
+    with span("llm.group"):
+        response = chat_completion(
+            model=GROUPING_MODEL,
+            messages=grouping_messages(emails),
+            temperature=0.5,
+            stream=True
+        )
+        for chunk in response:
+            token = chunk.choices[0].delta.get("content")
+            if token:
+                parts.append(token)
+                yield token
+    set_cached("group", cache_key, "".join(parts))
+
+def grouping_cache_key(emails):
+    return make_key("group", GROUPING_PROMPT_VERSION, GROUPING_MODEL, emails)
+
+def grouping_messages(emails):
+    """Builds the chat messages asking the model to group and format the emails."""
     prompt = (
         "You are an intelligent email-organizing assistant. "
-        "You are given a JSON array of emails, where each email has the keys 'subject', 'sender', 'summary', 'time', and 'suggested_reply'. "
+        "You are given emails as a JSON array of rows: the first row names the columns 'subject', 'sender', 'summary', "
+        "'time' and 'suggested_reply', and every following row is one email. "
         "Your task is to group these emails by similarity of topic or relevance and output a final result in Markdown format. "
         "For each group, provide a heading that includes an appropriate emoji and a descriptive category name (for example, '📦 Job Applications & Opportunities'). "
         "Then list the emails in numbered order using the following format:\n\n"
@@ -50,15 +103,168 @@ def group_emails_by_llm(emails):
         "Return only the final grouped summary text in plain Markdown with no introductory commentary or extra text."
     )
     
-    user_message = f"Here are the important emails in JSON:\n{emails_json}\n\nGroup them as instructed."
-    
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": user_message}
-        ],
-        temperature=0.5
+    return [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": table(emails, GROUPING_FIELDS)}
+    ]
+
+# --- Local grouping engine -------------------------------------------------------
+# Emails are clustered on their summary embeddings and the Markdown is rendered here;
+# the LLM only names the groups, so its input and output stay small however many
+# emails there are.
+
+# Average-linkage cosine distance below which two groups are merged
+GROUPING_DISTANCE_THRESHOLD = float(os.getenv("GROUPING_DISTANCE_THRESHOLD", "0.55"))
+# Groups beyond this many (smallest first) are collapsed into OTHER_HEADING
+GROUPING_MAX_GROUPS = int(os.getenv("GROUPING_MAX_GROUPS", "12"))
+# Emails per group shown to the model when naming it
+GROUPING_SAMPLES_PER_GROUP = 3
+GROUP_NAMES_PROMPT_VERSION = "group-names-v2"
+OTHER_HEADING = "📬 Other Emails"
+
+_local_unavailable = None
+
+def grouping_input(entry):
+    """Converts an important_emails entry into the item format group_emails expects."""
+    summary_info = entry.get("summary_info", {})
+    return {
+        "subject": entry.get("subject", ""),
+        "sender": entry.get("sender", ""),
+        "summary": summary_info.get("summary", ""),
+        "time": entry.get("time", "Unknown"),
+        "suggested_reply": summary_info.get("suggested_reply", "")
+    }
+
+def grouping_text(email):
+    return f"{email.get('subject', '')}\n{email.get('summary', '')}"
+
+def cluster_emails(emails, threshold=None):
+    """
+    Agglomerative clustering (average linkage, cosine distance) of the emails' subject
+    and summary embeddings, stopping once the closest pair of groups is further apart
+    than `threshold`. Returns lists of email indexes, largest group first; ties keep
+    mailbox order, so the result is deterministic.
+    """
+    import numpy as np
+    from embeddings import encode_texts
+    threshold = GROUPING_DISTANCE_THRESHOLD if threshold is None else threshold
+    if len(emails) < 2:
+        return [[i] for i in range(len(emails))]
+
+    vectors = encode_texts(grouping_text(email) for email in emails)
+    distances = 1.0 - vectors @ vectors.T
+    np.fill_diagonal(distances, np.inf)
+    members = {i: [i] for i in range(len(emails))}
+    while len(members) > 1:
+        flat = int(np.argmin(distances))
+        i, j = divmod(flat, distances.shape[1])
+        if distances[i, j] > threshold:
+            break
+        i, j = min(i, j), max(i, j)
+        # Lance-Williams update for average linkage: merge j into i
+        size_i, size_j = len(members[i]), len(members[j])
+        merged = (size_i * distances[i] + size_j * distances[j]) / (size_i + size_j)
+        distances[i, :] = merged
+        distances[:, i] = merged
+        distances[i, i] = np.inf
+        distances[j, :] = np.inf
+        distances[:, j] = np.inf
+        members[i].extend(members.pop(j))
+
+    clusters = [sorted(indexes) for indexes in members.values()]
+    clusters.sort(key=lambda indexes: (-len(indexes), indexes[0]))
+    return clusters
+
+def name_clusters(emails, clusters):
+    """
+    Asks the model for a short emoji heading per group, in one small request built
+    from a few subjects and summaries of each. Returns headings in cluster order;
+    groups the model did not name get a generic heading.
+    """
+    samples = [
+        [
+            {"subject": emails[i].get("subject", ""), "summary": (emails[i].get("summary") or "")[:150]}
+            for i in indexes[:GROUPING_SAMPLES_PER_GROUP]
+        ]
+        for indexes in clusters
+    ]
+    cache_key = make_key("group_names", GROUP_NAMES_PROMPT_VERSION, GROUPING_MODEL, samples)
+    cached = get_cached("group_names", cache_key)
+    names = json.loads(cached) if cached is not None else None
+    if names is None:
+        prompt = (
+            "You name groups of related emails for an email-organizing assistant. "
+            "You are given a JSON object mapping a group number to a few example emails from that group. "
+            "For every group, write a short heading that starts with an appropriate emoji followed by a descriptive category name "
+            "(for example, '📦 Job Applications & Opportunities'). "
+            "Return only a JSON object mapping each group number to its heading, with no extra text."
+        )
+        with span("llm.group_names"):
+            response = chat_completion(
+                model=GROUPING_MODEL,
+                messages=[
+                    {"role": "system", "content": prompt},
+                    {"role": "user", "content": compact_json({str(n + 1): group for n, group in enumerate(samples)})}
+                ],
+                temperature=0.3,
+                max_tokens=20 * len(samples) + 20
+            )
+        try:
+            names = json.loads(response.choices[0].message["content"])
+            if not isinstance(names, dict):
+                raise ValueError(f"expected a JSON object, got {type(names).__name__}")
+        except Exception as e:
+            print(f"Failed to parse group names, using generic headings: {e}")
+            names = {}
+        else:
+            # Cache values are strings in every backend
+            set_cached("group_names", cache_key, json.dumps(names))
+    return [str(names.get(str(n + 1)) or f"📬 Group {n + 1}").strip() for n in range(len(clusters))]
+
+def render_email(number, email):
+    return (
+        f"{number}. **Subject:** {email.get('subject', '')}  \n"
+        f"   **Sender:** {email.get('sender', '')}  \n"
+        f"   **Time:** {email.get('time', 'Unknown')}  \n"
+        f"   **Summary:** {email.get('summary', '')}  \n"
+        f"   **Suggested Reply:** 💬 {email.get('suggested_reply', '')}  \n"
     )
-    
-    return response.choices[0].message["content"]
\ No newline at end of file
+
+def render_group(heading, items):
+    """Renders one group in the digest format group_emails_by_llm asks the model for."""
+    return f"## {heading}\n\n" + "\n".join(render_email(n + 1, email) for n, email in enumerate(items)) + "\n"
+
+def iter_grouped_sections(emails):
+    """
+    Yields the grouped Markdown digest one group at a time. Falls back to the single
+    group_emails_by_llm prompt (streamed) if the embedding model is unavailable.
+    """
+    global _local_unavailable
+    if not emails:
+        return
+    if not _local_unavailable:
+        try:
+            clusters = cluster_emails(emails)
+        except ImportError as e:
+            _local_unavailable = str(e)
+            print(f"Local grouping disabled, grouping with the LLM: {e}")
+    if _local_unavailable:
+        yield from stream_group_emails_by_llm(emails)
+        return
+
+    if len(clusters) > GROUPING_MAX_GROUPS:
+        rest = sorted(i for indexes in clusters[GROUPING_MAX_GROUPS - 1:] for i in indexes)
+        clusters = clusters[:GROUPING_MAX_GROUPS - 1]
+        headings = name_clusters(emails, clusters) + [OTHER_HEADING]
+        clusters.append(rest)
+    else:
+        headings = name_clusters(emails, clusters)
+    for heading, indexes in zip(headings, clusters):
+        yield render_group(heading, [emails[i] for i in indexes])
+
+def group_emails(emails):
+    """
+    Groups emails (same item format as group_emails_by_llm) into the Markdown digest,
+    clustering locally and using the LLM only to name the groups.
+    """
+    return "".join(iter_grouped_sections(emails))
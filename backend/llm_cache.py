@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Which backend to use: "memory" (default), "sqlite" or "supabase"
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+
+
+class MemoryCache:
+    """In-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, max_entries=LLM_CACHE_MAX_ENTRIES, ttl=LLM_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteCache:
+    """On-disk cache in a single SQLite table, shared by every worker on the host."""
+
+    def __init__(self, path=LLM_CACHE_PATH, ttl=LLM_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),))
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM llm_cache WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + self.ttl)
+            )
+            self._conn.commit()
+
+
+class SupabaseCache:
+    """
+    Cache rows in the Supabase `llm_cache` table, shared across hosts:
+      key text primary key, value text, expires_at double precision
+    """
+
+    def __init__(self, ttl=LLM_CACHE_TTL):
+        from supabase_client import get_supabase
+        self.ttl = ttl
+        self._table = lambda: get_supabase().table("llm_cache")
+
+    def get(self, key):
+        response = self._table().select("value").eq("key", key).gte("expires_at", time.time()).execute()
+        return response.data[0]["value"] if response.data else None
+
+    def set(self, key, value):
+        self._table().upsert({"key": key, "value": value, "expires_at": time.time() + self.ttl}).execute()
+
+
+BACKENDS = {"memory": MemoryCache, "sqlite": SQLiteCache, "supabase": SupabaseCache}
+
+_cache = BACKENDS[LLM_CACHE_BACKEND]()
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def set_backend(cache):
+    """Swap the cache backend, e.g. set_backend(SQLiteCache(':memory:'))."""
+    global _cache
+    _cache = cache
+
+
+def normalize_text(text):
+    """Collapses whitespace so re-wrapped copies of the same email share a cache key."""
+    return re.sub(r"\s+", " ", text or "").strip()
+
+
+def normalize_content(content):
+    if isinstance(content, str):
+        return normalize_text(content)
+    if isinstance(content, dict):
+        return {key: normalize_content(value) for key, value in content.items()}
+    if isinstance(content, (list, tuple)):
+        return [normalize_content(value) for value in content]
+    return content
+
+
+def make_key(namespace, prompt_version, model, content):
+    """
+    Content-addressed cache key: a hash of the prompt template version, the model and
+    the normalized email content. Bump the prompt version whenever a prompt changes.
+    """
+    content = json.dumps(normalize_content(content), sort_keys=True, separators=(",", ":"))
+    digest = hashlib.sha256(
+        "\x1f".join([namespace, prompt_version, model, content]).encode("utf-8")
+    ).hexdigest()
+    return f"{namespace}:{digest}"
+
+
+def _record(namespace, outcome):
+    with _stats_lock:
+        counts = _stats.setdefault(namespace, {"hits": 0, "misses": 0, "errors": 0})
+        counts[outcome] += 1
+
+
+def get_cached(namespace, key):
+    """Returns the cached string for `key`, or None. Backend errors count as misses."""
+    try:
+        value = _cache.get(key)
+    except Exception as e:
+        print(f"LLM cache read error ({namespace}): {e}")
+        _record(namespace, "errors")
+        value = None
+    _record(namespace, "hits" if value is not None else "misses")
+    return value
+
+
+def set_cached(namespace, key, value):
+    try:
+        _cache.set(key, value)
+    except Exception as e:
+        print(f"LLM cache write error ({namespace}): {e}")
+        _record(namespace, "errors")
+
+
+def cache_stats():
+    """Hit/miss counters per namespace since process start."""
+    with _stats_lock:
+        stats = {}
+        for namespace, counts in _stats.items():
+            lookups = counts["hits"] + counts["misses"]
+            stats[namespace] = dict(counts, hit_rate=round(counts["hits"] / lookups, 4) if lookups else 0.0)
+        return {"backend": type(_cache).__name__, "namespaces": stats}
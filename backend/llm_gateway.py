@@ -0,0 +1,305 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import openai
+import requests
+from dotenv import load_dotenv
+from components import register, get_component
+from tokens import count_tokens
+from metrics import count, propagate_trace
+from usage_ledger import check_budget, record_usage
+
+load_dotenv()
+openai.api_key = os.getenv("OPENAI_API_KEY")
+
+# "openai" (default) or "fake" (in-process stub replies, for tests and benchmarks)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+# Requests and tokens per minute allowed for this process; 0 disables the limit
+LLM_RPM = int(os.getenv("LLM_RPM", "0"))
+LLM_TPM = int(os.getenv("LLM_TPM", "0"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+# Send a duplicate request if the first has not answered after this many seconds
+# ("auto": the p95 of recent latencies; "0": never). Duplicates cost tokens.
+LLM_HEDGE_AFTER = os.getenv("LLM_HEDGE_AFTER", "0")
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "32"))
+# Completion tokens reserved from the TPM budget when a call sets no max_tokens
+DEFAULT_COMPLETION_TOKENS = 256
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    openai.error.APIConnectionError,
+)
+
+
+class TokenBucket:
+    """Refills `per_minute` units per minute, up to one minute's worth. A rate of 0 never blocks."""
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def acquire(self, amount):
+        """Blocks until `amount` units are available and takes them. Returns the seconds waited."""
+        if not self.per_minute:
+            return 0.0
+        amount = min(amount, self.per_minute)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) * 60 / self.per_minute
+            time.sleep(delay)
+            waited += delay
+
+    def adjust(self, amount):
+        """Returns (positive) or takes (negative) units after the real cost is known."""
+        if not self.per_minute:
+            return
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.per_minute, self.tokens + amount)
+
+
+class OpenAIBackend:
+    """Calls the OpenAI API over one pooled HTTP session shared by every thread."""
+
+    def __init__(self, pool_size=LLM_POOL_SIZE):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        openai.requestssession = session
+
+    def create(self, timeout=None, **request):
+        return openai.ChatCompletion.create(request_timeout=timeout, **request)
+
+
+class FakeBackend:
+    """
+    Answers in-process with stubs.fake_llm_reply (or `reply`), in the same response
+    shape as the API, after `latency` seconds. No network, no API key.
+    """
+
+    def __init__(self, reply=None, latency=0.0):
+        from stubs import fake_llm_reply
+        self.reply = reply or fake_llm_reply
+        self.latency = latency
+        self.calls = 0
+
+    def create(self, timeout=None, **request):
+        from openai.openai_object import OpenAIObject
+        from stubs import completion_payload, completion_chunks
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        content = self.reply(request["messages"])
+        if request.get("stream"):
+            return (OpenAIObject.construct_from(chunk) for chunk in completion_chunks(request, content))
+        return OpenAIObject.construct_from(completion_payload(request, content))
+
+
+def create_backend():
+    if LLM_BACKEND == "fake":
+        return FakeBackend()
+    return OpenAIBackend()
+
+
+register("llm_backend", create_backend)
+_backend_override = None
+_request_bucket = TokenBucket(LLM_RPM)
+_token_bucket = TokenBucket(LLM_TPM)
+_hedge_pool = ThreadPoolExecutor(max_workers=LLM_POOL_SIZE, thread_name_prefix="llm-hedge")
+_latencies = deque(maxlen=200)
+_stats = {"calls": 0, "attempts": 0, "retries": 0, "errors": 0, "hedges": 0, "hedge_wins": 0,
+          "rate_limit_wait_s": 0.0, "prompt_tokens": 0, "completion_tokens": 0}
+_stats_lock = threading.Lock()
+
+
+def set_backend(backend):
+    """Replaces the backend (e.g. with a FakeBackend); pass None to go back to LLM_BACKEND."""
+    global _backend_override
+    _backend_override = backend
+
+
+def get_backend():
+    return _backend_override or get_component("llm_backend")
+
+
+def set_rate_limits(rpm=0, tpm=0):
+    global _request_bucket, _token_bucket
+    _request_bucket = TokenBucket(rpm)
+    _token_bucket = TokenBucket(tpm)
+
+
+def _count(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def backoff_delay(attempt, error=None, base=1.0, cap=30.0):
+    """Full-jitter exponential backoff, or the server's Retry-After when it sent one."""
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("retry-after") if hasattr(headers, "get") else None
+    if retry_after:
+        try:
+            return min(cap, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    status = getattr(error, "http_status", None)
+    return isinstance(error, openai.error.APIError) and (status is None or status >= 500)
+
+
+def hedge_delay():
+    if LLM_HEDGE_AFTER == "auto":
+        with _stats_lock:
+            samples = sorted(_latencies)
+        if len(samples) < 20:
+            return None
+        return samples[int(len(samples) * 0.95)]
+    delay = float(LLM_HEDGE_AFTER or 0)
+    return delay or None
+
+
+def _meter(model, prompt_tokens, completion_tokens, reserved_tokens):
+    """Records one answered request's tokens: usage ledger, gateway stats, metrics and the TPM bucket."""
+    record_usage(model, prompt_tokens, completion_tokens)
+    with _stats_lock:
+        _stats["prompt_tokens"] += prompt_tokens
+        _stats["completion_tokens"] += completion_tokens
+    count("llm_tokens_total", prompt_tokens, model=model, kind="prompt")
+    count("llm_tokens_total", completion_tokens, model=model, kind="completion")
+    # Give back (or take) the difference between the reservation and the real cost
+    _token_bucket.adjust(reserved_tokens - prompt_tokens - completion_tokens)
+
+
+def _attempt(backend, request, timeout, reserved_tokens):
+    """
+    Sends one request. A non-streamed response is metered here rather than by the
+    caller, so the losing leg of a hedged call is paid for too, whenever it finishes.
+    """
+    _count("rate_limit_wait_s", _request_bucket.acquire(1) + _token_bucket.acquire(reserved_tokens))
+    _count("attempts")
+    count("upstream_calls_total", upstream="llm", operation="chat_completion")
+    started = time.perf_counter()
+    response = backend.create(timeout=timeout, **request)
+    if not request.get("stream"):
+        with _stats_lock:
+            _latencies.append(time.perf_counter() - started)
+        usage = response.get("usage")
+        if usage:
+            _meter(request["model"], usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), reserved_tokens)
+    return response
+
+
+def _hedged(call, delay):
+    """Runs `call`; if it is still running after `delay` seconds, races a second copy."""
+    first = _hedge_pool.submit(call)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+    _count("hedges")
+    second = _hedge_pool.submit(call)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is second:
+                    _count("hedge_wins")
+                return future.result()
+            error = error or future.exception()
+    raise error
+
+
+def chat_completion(messages, model="gpt-3.5-turbo", timeout=None, hedge=True, **kwargs):
+    """
+    The single entry point for chat completions. Takes the same arguments as
+    openai.ChatCompletion.create and returns the same response (or chunk iterator
+    when stream=True), adding:
+      - RPM/TPM token buckets (LLM_RPM, LLM_TPM) shared by every caller in the process
+      - a per-call timeout (LLM_TIMEOUT)
+      - jittered exponential backoff on 429s, 5xx and timeouts (LLM_MAX_RETRIES)
+      - hedging: a duplicate request when the first is slow (LLM_HEDGE_AFTER), not for streams
+      - per-user token accounting and daily budgets (usage_ledger); raises
+        TokenBudgetExceeded before sending a request the current user cannot afford
+    """
+    backend = get_backend()
+    request = dict(kwargs, model=model, messages=messages)
+    timeout = timeout or LLM_TIMEOUT
+    prompt_tokens = sum(count_tokens(m.get("content") or "", model) for m in messages)
+    reserved_tokens = prompt_tokens + (kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+    check_budget(reserved_tokens)
+    _count("calls")
+
+    @propagate_trace
+    def call():
+        return _attempt(backend, request, timeout, reserved_tokens)
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            delay = None if kwargs.get("stream") or not hedge else hedge_delay()
+            response = _hedged(call, delay) if delay else call()
+            break
+        except Exception as e:
+            count("upstream_errors_total", upstream="llm", operation="chat_completion")
+            if attempt >= LLM_MAX_RETRIES or not is_retryable(e):
+                _count("errors")
+                raise
+            _count("retries")
+            count("upstream_retries_total", upstream="llm")
+            time.sleep(backoff_delay(attempt, e))
+
+    if kwargs.get("stream"):
+        return _metered_stream(response, model, prompt_tokens, reserved_tokens)
+    return response
+
+
+def _metered_stream(chunks, model, prompt_tokens, reserved_tokens):
+    """
+    Yields the streamed chunks, then meters the call like a non-streamed one. Streams
+    report no usage, so the completion is counted from the content received, also
+    when the reader stops early.
+    """
+    parts = []
+    try:
+        for chunk in chunks:
+            parts.append(chunk.choices[0].delta.get("content") or "")
+            yield chunk
+    finally:
+        _meter(model, prompt_tokens, count_tokens("".join(parts), model), reserved_tokens)
+
+
+def gateway_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+        samples = sorted(_latencies)
+    stats["rate_limit_wait_s"] = round(stats["rate_limit_wait_s"], 3)
+    stats["backend"] = type(get_backend()).__name__ if _backend_override else LLM_BACKEND
+    if samples:
+        stats["latency_p50_s"] = round(samples[len(samples) // 2], 3)
+        stats["latency_p95_s"] = round(samples[int(len(samples) * 0.95)], 3)
+    return stats
@@ -0,0 +1,484 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+from datetime import datetime, timedelta
+from googleapiclient.errors import HttpError
+from supabase_client import (
+    save_history_id, get_processed_emails, get_processed_message_ids, get_important_emails_page,
+    save_processed_emails, delete_processed_emails, delete_digest, update_pending_message_ids
+)
+from pipeline import process_messages, run_blocking, run_in_background, new_fetch_stats
+from retrieval import index_emails
+from gmail_pool import update_pooled_user
+from metrics import span
+from single_flight import SingleFlight
+
+# Drafts, spam and trash never show up in messages().list without an explicit query,
+# so keep them out of the history delta too.
+SKIPPED_LABELS = {"DRAFT", "SPAM", "TRASH"}
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+
+# How long a finished refresh is reused by later requests for the same user (and a window it covers)
+IMPORTANT_EMAILS_MEMO_SECONDS = float(os.getenv("IMPORTANT_EMAILS_MEMO_SECONDS", "30"))
+# Most messages a refresh processes (newest first); older mail in the window is left
+# to important_emails_page, which walks the whole window
+SYNC_MAX_EMAILS = int(os.getenv("SYNC_MAX_EMAILS", "500"))
+# Messages listed and processed per step of important_emails_page
+SYNC_CHUNK_SIZE = int(os.getenv("SYNC_CHUNK_SIZE", "100"))
+# Longest window a request may ask for
+SYNC_MAX_WINDOW_DAYS = int(os.getenv("SYNC_MAX_WINDOW_DAYS", "31"))
+# Key for signing page cursors; every worker must use the same one. Falls back to
+# the Supabase service key, which only the server knows.
+CURSOR_SECRET = os.getenv("CURSOR_SECRET") or os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+WINDOW_UNITS = {"h": "hours", "d": "days", "w": "weeks"}
+
+# Per-user Gmail fetch totals since process start, plus the latest refresh
+_fetch_stats = {}
+_refreshes = SingleFlight(ttl=IMPORTANT_EMAILS_MEMO_SECONDS)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def parse_window(window):
+    """Parses a window such as "12h", "1d" or "7d" into a timedelta, up to SYNC_MAX_WINDOW_DAYS."""
+    match = re.fullmatch(r"(\d+)([hdw])", window.strip().lower())
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid window {window!r}; expected e.g. 12h, 1d or 7d")
+    delta = timedelta(**{WINDOW_UNITS[match.group(2)]: int(match.group(1))})
+    if delta > timedelta(days=SYNC_MAX_WINDOW_DAYS):
+        raise ValueError(f"Window {window!r} is longer than {SYNC_MAX_WINDOW_DAYS} days")
+    return delta
+
+
+def window_query(window_start):
+    """The messages().list query for mail received after `window_start` (a TIME_FORMAT string)."""
+    return f"after:{int(datetime.strptime(window_start, TIME_FORMAT).timestamp())}"
+
+
+def list_message_page(service, query, page_token=None, page_size=None):
+    """One messages().list page: (message ids newest first, next page token or None)."""
+    with span("gmail.messages.list", upstream="gmail"):
+        response = service.users().messages().list(
+            userId="me",
+            q=query,
+            pageToken=page_token,
+            maxResults=page_size or SYNC_CHUNK_SIZE
+        ).execute()
+    return [msg["id"] for msg in response.get("messages", [])], response.get("nextPageToken")
+
+
+def list_recent_message_ids(service, query="newer_than:1d", max_emails=None):
+    max_emails = max_emails or SYNC_MAX_EMAILS
+    messages = []
+    page_token = None
+    while True:
+        ids, page_token = list_message_page(service, query, page_token, min(SYNC_CHUNK_SIZE, max_emails - len(messages)))
+        messages.extend(ids)
+        if len(messages) >= max_emails:
+            if page_token:
+                print(f"Listing {query!r} stopped at {max_emails} messages (SYNC_MAX_EMAILS)")
+            return messages[:max_emails]
+        if not page_token:
+            return messages
+
+
+def list_history_changes(service, start_history_id):
+    """
+    Walks users().history().list from `start_history_id` and returns
+    (changed_ids, deleted_ids, latest_history_id), newest changes first.
+
+    A message counts as changed when it was added, or when its IMPORTANT label was
+    added or removed. Returns None when Gmail no longer has history that far back
+    (HTTP 404), in which case the caller must fall back to a full sync.
+    """
+    changed = {}
+    deleted = set()
+    history_id = start_history_id
+    page_token = None
+    while True:
+        try:
+            with span("gmail.history.list", upstream="gmail"):
+                response = service.users().history().list(
+                    userId="me",
+                    startHistoryId=start_history_id,
+                    historyTypes=HISTORY_TYPES,
+                    pageToken=page_token
+                ).execute()
+        except HttpError as e:
+            if e.resp.status == 404:
+                return None
+            raise
+        for record in response.get("history", []):
+            for added in record.get("messagesAdded", []):
+                message = added["message"]
+                if SKIPPED_LABELS.intersection(message.get("labelIds", [])):
+                    continue
+                changed[message["id"]] = True
+                deleted.discard(message["id"])
+            for key in ("labelsAdded", "labelsRemoved"):
+                for change in record.get(key, []):
+                    if "IMPORTANT" in change.get("labelIds", []):
+                        changed[change["message"]["id"]] = True
+            for removed in record.get("messagesDeleted", []):
+                deleted.add(removed["message"]["id"])
+                changed.pop(removed["message"]["id"], None)
+        history_id = response.get("historyId", history_id)
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+    return list(reversed(changed)), deleted, history_id
+
+
+def sync_mailbox(service, history_id=None, max_emails=None, window=timedelta(days=1)):
+    """
+    Works out which messages need processing since the last sync.
+
+    With a stored `history_id` this is a single history().list call in the common
+    case. Without one, or when the history has expired, it falls back to listing
+    `window`, recording the mailbox's current historyId first so nothing that
+    arrives during the listing is missed next time. Either way at most `max_emails`
+    (SYNC_MAX_EMAILS) of the newest messages are returned.
+
+    Returns {"full": bool, "changed": [ids], "deleted": {ids}, "history_id": str,
+    "complete": bool}, where "complete" says a full listing covered the whole window.
+    """
+    max_emails = max_emails or SYNC_MAX_EMAILS
+    if history_id:
+        delta = list_history_changes(service, history_id)
+        if delta is not None:
+            changed, deleted, latest_history_id = delta
+            if len(changed) > max_emails:
+                print(f"History delta has {len(changed)} changed messages; processing the newest {max_emails}")
+            return {"full": False, "changed": changed[:max_emails], "deleted": deleted, "history_id": latest_history_id,
+                    "complete": False}
+    with span("gmail.profile", upstream="gmail"):
+        profile = service.users().getProfile(userId="me").execute()
+    window_start = (datetime.now() - window).strftime(TIME_FORMAT)
+    changed = list_recent_message_ids(service, window_query(window_start), max_emails)
+    return {
+        "full": True,
+        "changed": changed,
+        "deleted": set(),
+        "history_id": profile["historyId"],
+        "complete": len(changed) < max_emails
+    }
+
+
+async def process_and_store(service, user_email, message_ids, on_summary=None, gmail_semaphore=None,
+                            llm_semaphore=None, retried_ids=()):
+    """
+    Runs `message_ids` through process_messages, saves a processed_emails row for
+    each message and queues them for the search index. A stored digest is dropped
+    once new important mail is saved, since it no longer lists all of it. Returns
+    the saved rows.
+
+    Messages Gmail would not return for transient reasons get no row; their IDs are
+    kept in the user's pending_message_ids for the next sync to retry, since neither
+    the history delta nor a listing that moved past them would see them again.
+    `retried_ids` are the pending IDs included in `message_ids`, dropped from the
+    list once they succeed.
+    """
+    message_store = {}
+    fetch_stats = new_fetch_stats()
+    failed_ids = set()
+    important_emails = await process_messages(
+        service, message_ids, message_store=message_store, on_summary=on_summary,
+        fetch_stats=fetch_stats, gmail_semaphore=gmail_semaphore, llm_semaphore=llm_semaphore, failed_ids=failed_ids
+    )
+    record_fetch_stats(user_email, fetch_stats)
+    important_by_id = {email["id"]: email for email in important_emails}
+    rows = [
+        {
+            "message_id": message_id,
+            "received_at": record["time"],
+            "important": message_id in important_by_id,
+            "email": important_by_id.get(message_id)
+        }
+        for message_id, record in message_store.items()
+    ]
+
+    # Embedding new mail into the user's search index is not needed for this response
+    if message_store:
+        run_in_background(index_emails, user_email, list(message_store.values()))
+
+    await run_blocking(save_processed_emails, user_email, rows)
+    if important_by_id:
+        await run_blocking(delete_digest, user_email)
+    if retried_ids or failed_ids:
+        pending = await run_blocking(update_pending_message_ids, user_email, retried_ids, failed_ids)
+        update_pooled_user(user_email, pending_message_ids=json.dumps(pending))
+    return rows
+
+
+async def sync_important_emails(service, user_email, history_id=None, window=timedelta(days=1), on_email=None,
+                                gmail_semaphore=None, llm_semaphore=None, synced_from=None, pending_ids=None):
+    """
+    Incrementally refreshes a user's important emails.
+
+    Only messages that are new or changed since the stored historyId go through
+    fetch/classify/summarize; everything else comes from the processed_emails store.
+    `synced_from` is the stored receive time from which on every message has been
+    processed: when `window` starts before it (e.g. the first 7d request after 1d
+    ones), the missing part of the window is listed and its unprocessed messages go
+    through the pipeline too. Results are persisted and the new historyId and
+    synced_from saved only after processing succeeds, so a failed refresh is simply
+    retried from the old position. `pending_ids` is the stored pending_message_ids
+    (a JSON list): messages an earlier sync could not fetch, which are retried here
+    (see process_and_store).
+
+    Returns {"emails": the important_emails entries received within `window`, newest
+    first, "window", "history_id", "synced_from"}. `on_email`, if given, is called
+    with each of those entries as soon as it is known: stored ones right after the
+    sync, new ones as their summaries finish. The semaphores are passed on to
+    process_messages.
+    """
+    window_start = (datetime.now() - window).strftime(TIME_FORMAT)
+    processed = await run_blocking(get_processed_emails, user_email, window_start)
+    sync = await run_blocking(sync_mailbox, service, history_id, window=window)
+
+    if sync["full"]:
+        listed = sync["changed"]
+        to_process = [message_id for message_id in listed if message_id not in processed]
+        complete = sync["complete"]
+    else:
+        to_process = list(sync["changed"])
+        listed = []
+        complete = True
+        if synced_from is None or window_start < synced_from:
+            # The delta only covers mail since the last sync; list the rest of the window
+            listed = await run_blocking(list_recent_message_ids, service, window_query(window_start))
+            queued = set(to_process)
+            to_process += [message_id for message_id in listed if message_id not in processed and message_id not in queued]
+            complete = len(listed) < SYNC_MAX_EMAILS
+    retried_ids = json.loads(pending_ids or "[]")
+    queued = set(to_process)
+    to_process += [message_id for message_id in retried_ids
+                   if message_id not in queued and message_id not in processed and message_id not in sync["deleted"]]
+
+    if on_email is not None:
+        reprocessed = set(to_process) | sync["deleted"]
+        for message_id, row in processed.items():
+            if message_id not in reprocessed and row["important"] and row["email"]:
+                on_email(row["email"])
+
+    def on_summary(email):
+        if email.get("time", "") >= window_start:
+            on_email(email)
+
+    rows = await process_and_store(service, user_email, to_process, on_summary if on_email else None,
+                                   gmail_semaphore, llm_semaphore, retried_ids)
+
+    merged = {message_id: row for message_id, row in processed.items() if message_id not in sync["deleted"]}
+    merged.update({row["message_id"]: row for row in rows})
+    if listed:
+        # Listings are newest first: a complete one covers the whole window, a truncated
+        # one everything from its oldest message on
+        received = [merged[message_id]["received_at"] for message_id in listed
+                    if message_id in merged and merged[message_id]["received_at"][:1].isdigit()]
+        covered_from = window_start if complete else min(received, default=None)
+        if covered_from is not None and (synced_from is None or covered_from < synced_from or sync["full"]):
+            synced_from = covered_from
+
+    await run_blocking(delete_processed_emails, user_email, sync["deleted"])
+    await run_blocking(save_history_id, user_email, sync["history_id"], synced_from)
+    update_pooled_user(user_email, history_id=str(sync["history_id"]), synced_from=synced_from)
+
+    current = [
+        row for row in merged.values()
+        if row["important"] and row["email"] and row["received_at"] >= window_start
+    ]
+    current.sort(key=lambda row: row["received_at"], reverse=True)
+    # A thread summarized again after a new reply keeps only its newest entry
+    threads = set()
+    emails = []
+    for row in current:
+        thread_id = row["email"].get("thread_id")
+        if thread_id in threads:
+            continue
+        if thread_id:
+            threads.add(thread_id)
+        emails.append(row["email"])
+    return {"emails": emails, "window": window, "history_id": str(sync["history_id"]), "synced_from": synced_from}
+
+
+async def refresh_important_emails(service, user_email, history_id=None, window=timedelta(days=1), on_email=None,
+                                   gmail_semaphore=None, llm_semaphore=None, synced_from=None, pending_ids=None):
+    """sync_important_emails, returning only the important_emails entries."""
+    result = await sync_important_emails(service, user_email, history_id, window, on_email, gmail_semaphore,
+                                         llm_semaphore, synced_from, pending_ids)
+    return result["emails"]
+
+
+async def shared_refresh_important_emails(service, user_email, history_id=None, window=timedelta(days=1),
+                                          gmail_semaphore=None, llm_semaphore=None, synced_from=None, on_email=None,
+                                          pending_ids=None):
+    """
+    refresh_important_emails, run at most once at a time per user: callers arriving
+    while a refresh is running share its result, as do callers within
+    IMPORTANT_EMAILS_MEMO_SECONDS after it finished. This is what keeps a page that
+    loads /emails/important_full and /emails/grouped_summary together, or a user
+    refreshing twice, from running the Gmail and LLM pipeline twice.
+
+    A shared result is cut down to the caller's window. If it covers less than that
+    window, the caller runs a refresh of its own afterwards, from the historyId the
+    shared one reached, so the same delta is never processed twice.
+
+    `on_email` is called as in sync_important_emails, once per entry in the caller's
+    window, including the ones the shared refresh reported before the caller joined.
+    """
+    window_start = (datetime.now() - window).strftime(TIME_FORMAT)
+    reported = set()
+
+    def on_item(email):
+        if email.get("time", "") >= window_start and email["id"] not in reported:
+            reported.add(email["id"])
+            on_email(email)
+
+    while True:
+        result = await _refreshes.run(
+            user_email,
+            lambda emit: sync_important_emails(service, user_email, history_id, window, emit,
+                                               gmail_semaphore=gmail_semaphore, llm_semaphore=llm_semaphore,
+                                               synced_from=synced_from, pending_ids=pending_ids),
+            on_item if on_email else None
+        )
+        if result["window"] >= window:
+            return [email for email in result["emails"] if email.get("time", "") >= window_start]
+        # The shared refresh already retried the pending messages
+        history_id, synced_from, pending_ids = result["history_id"], result["synced_from"], None
+        _refreshes.forget(lambda key: key == user_email)
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _cursor_signature(user_email, payload):
+    return hmac.new(CURSOR_SECRET.encode("utf-8"), user_email.encode("utf-8") + b"\n" + payload,
+                    hashlib.sha256).digest()[:16]
+
+
+def encode_cursor(state, user_email):
+    """Serializes the page walk's state, signed for `user_email` so clients cannot forge or edit it."""
+    payload = json.dumps(state, separators=(",", ":")).encode("utf-8")
+    return _b64encode(payload) + "." + _b64encode(_cursor_signature(user_email, payload))
+
+
+def decode_cursor(cursor, user_email):
+    try:
+        encoded_payload, _, encoded_signature = cursor.partition(".")
+        payload = _b64decode(encoded_payload)
+        if not hmac.compare_digest(_b64decode(encoded_signature), _cursor_signature(user_email, payload)):
+            raise ValueError("bad signature")
+        state = json.loads(payload)
+        datetime.strptime(state["window_start"], TIME_FORMAT)
+        if not (state["page_token"] is None or isinstance(state["page_token"], str)):
+            raise TypeError("page_token must be a string or null")
+        if state["frontier"] is not None:
+            datetime.strptime(state["frontier"], TIME_FORMAT)
+        if state["before"] is not None:
+            received_at, message_id = state["before"]
+            if not (isinstance(received_at, str) and isinstance(message_id, str)):
+                raise TypeError("before must be [received_at, message_id]")
+            state["before"] = (received_at, message_id)
+        return state
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {e}")
+
+
+async def important_emails_page(service, user_email, history_id=None, window=timedelta(days=1), page_size=20,
+                                cursor=None, gmail_semaphore=None, llm_semaphore=None, synced_from=None, pending_ids=None):
+    """
+    One page of a user's important emails received within `window`, newest first,
+    as (important_emails entries, next cursor or None on the last page). The cursor
+    is opaque to clients, signed (CURSOR_SECRET) and carries the window, so later
+    pages ignore `window`.
+
+    The window is walked newest first through messages().list, SYNC_CHUNK_SIZE
+    messages at a time: each listed chunk's unprocessed messages go through
+    process_and_store, and the walk stops as soon as the store holds a full page of
+    important mail newer than everything not yet listed. Later pages pick the walk up
+    where the cursor left it, so the first page costs the same whatever the size of
+    the mailbox, and memory is bounded by the chunk and page sizes. The first page
+    also applies the history delta (label changes, deletions) when there is one.
+
+    Raises InvalidCursor for a cursor this function did not produce.
+    """
+    if cursor:
+        state = decode_cursor(cursor, user_email)
+    else:
+        if history_id:
+            await shared_refresh_important_emails(service, user_email, history_id, gmail_semaphore=gmail_semaphore,
+                                                  llm_semaphore=llm_semaphore, synced_from=synced_from,
+                                                  pending_ids=pending_ids)
+        window_start = (datetime.now() - window).strftime(TIME_FORMAT)
+        # page_token is None before the first listing and "" once the listing is exhausted;
+        # frontier is the oldest received_at listed so far
+        state = {"window_start": window_start, "before": None, "page_token": None, "frontier": None}
+
+    query = window_query(state["window_start"])
+    while True:
+        listed_all = state["page_token"] == ""
+        if state["frontier"] is not None or listed_all:
+            since = state["window_start"] if listed_all else max(state["frontier"], state["window_start"])
+            # Messages received in the frontier's second may still be unlisted, so that second is excluded
+            rows = await run_blocking(get_important_emails_page, user_email, since, state["before"], page_size + 1,
+                                      listed_all)
+            if len(rows) > page_size or listed_all:
+                break
+        ids, next_token = await run_blocking(list_message_page, service, query, state["page_token"])
+        known = await run_blocking(get_processed_message_ids, user_email, ids)
+        new_ids = [message_id for message_id in ids if message_id not in known]
+        saved = await process_and_store(service, user_email, new_ids, gmail_semaphore=gmail_semaphore,
+                                        llm_semaphore=llm_semaphore) if new_ids else []
+        received = [received_at for received_at in list(known.values()) + [row["received_at"] for row in saved]
+                    if received_at and received_at[:1].isdigit()]
+        if received:
+            oldest = min(received)
+            state["frontier"] = oldest if state["frontier"] is None else min(state["frontier"], oldest)
+        state["page_token"] = next_token or ""
+
+    page = rows[:page_size]
+    next_cursor = None
+    if len(rows) > page_size:
+        state["before"] = [page[-1]["received_at"], page[-1]["message_id"]]
+        next_cursor = encode_cursor(state, user_email)
+    return [row["email"] for row in page if row["email"]], next_cursor
+
+
+def forget_important_emails(user_email):
+    """Drops the user's reused refresh results, so the next request syncs with Gmail again."""
+    _refreshes.forget(lambda key: key == user_email)
+
+
+def shared_refresh_stats():
+    return dict(_refreshes.stats)
+
+
+def record_fetch_stats(user_email, fetch_stats):
+    user_stats = _fetch_stats.setdefault(user_email, {"refreshes": 0, "totals": new_fetch_stats(), "last": None})
+    user_stats["refreshes"] += 1
+    user_stats["last"] = fetch_stats
+    for tier, values in fetch_stats.items():
+        for key, value in values.items():
+            user_stats["totals"][tier][key] = round(user_stats["totals"][tier][key] + value, 3)
+
+
+def gmail_fetch_stats(user_email=None):
+    """
+    Gmail requests, messages, response bytes and seconds per fetch tier ("metadata"
+    for classification, "full" for bodies), for one user or all users.
+    """
+    if user_email is not None:
+        return _fetch_stats.get(user_email, {"refreshes": 0, "totals": new_fetch_stats(), "last": None})
+    return _fetch_stats
@@ -1,23 +1,34 @@
 from fastapi import FastAPI, HTTPException, Request
-from starlette.responses import RedirectResponse, JSONResponse, PlainTextResponse
-from google_auth_oauthlib.flow import Flow
-from supabase_client import save_user, get_user_credentials
+from pydantic import BaseModel
+from starlette.responses import RedirectResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from supabase_client import save_user, update_user_tokens, update_summary_time, save_digest
 import os
 from dotenv import load_dotenv
 import jwt
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-import base64
 import json
-from classifier import classify_emails
-from summarizer import openai_summary_and_reply  # Use summarizer from summarizer.py
-from group_emails import group_emails_by_llm
-import openai
-import numpy as np
-import faiss
-from sentence_transformers import SentenceTransformer
+from group_emails import group_emails, iter_grouped_sections, grouping_input
+from pipeline import run_blocking, iterate_blocking, run_in_background
+from gmail_pool import acquire_gmail_client, evict_user, update_pooled_user
+from digest_scheduler import DigestScheduler, DIGEST_SCHEDULER_ENABLED, get_fresh_digest, TIME_FORMAT
+from mailbox_sync import shared_refresh_important_emails, forget_important_emails, \
+    shared_refresh_stats, gmail_fetch_stats, important_emails_page, parse_window, InvalidCursor
+from llm_cache import cache_stats
+from dedup import dedup_stats
+from embeddings import email_text, encode_texts, embedding_stats
+from retrieval import search_emails
+from preclassifier import preclassifier_stats
+from classifier import classify_batch_stats
+from llm_gateway import chat_completion, gateway_stats
+from usage_ledger import set_usage_scope, usage_summary, TokenBudgetExceeded
 from collections import defaultdict
 from fastapi.middleware.cors import CORSMiddleware
+from components import register, get_component, component_status, warm_up
+from metrics import start_trace, observe, span, server_timing, render_prometheus, METRICS_TIMING_HEADER
+import asyncio
+import re
+import time
 from datetime import datetime
 
 load_dotenv()
@@ -34,8 +45,34 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id", "Server-Timing"],
 )
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """
+    Gives every request a trace ID (the caller's X-Request-ID if it sent one), records
+    its latency per route and, when METRICS_TIMING_HEADER=1 or the request sends
+    X-Debug-Timing: 1, returns the per-stage breakdown in a Server-Timing header.
+    Streaming responses are measured up to their first byte.
+    """
+    trace = start_trace(request.headers.get("X-Request-ID"))
+    # LLM tokens spent handling the request are charged to its user and path; see usage_ledger
+    if request.query_params.get("user_email"):
+        set_usage_scope(request.query_params["user_email"], request.url.path)
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        route = request.scope.get("route")
+        observe("http_request_seconds", time.perf_counter() - trace["started"],
+                route=getattr(route, "path", "unmatched"), method=request.method, status=status)
+    response.headers["X-Trace-Id"] = trace["trace_id"]
+    if METRICS_TIMING_HEADER or request.headers.get("X-Debug-Timing") == "1":
+        response.headers["Server-Timing"] = server_timing(trace)
+    return response
+
 CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("REDIRECT_URI")
@@ -46,47 +83,63 @@ SCOPES = [
     "https://www.googleapis.com/auth/gmail.readonly"
 ]
 
-flow = Flow.from_client_config(
-    {
-        "web": {
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET,
-            "redirect_uris": [REDIRECT_URI],
-            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-            "token_uri": "https://oauth2.googleapis.com/token",
-        }
-    },
-    scopes=SCOPES,
-    redirect_uri=REDIRECT_URI
-)
+def create_oauth_flow():
+    from google_auth_oauthlib.flow import Flow
+    return Flow.from_client_config(
+        {
+            "web": {
+                "client_id": CLIENT_ID,
+                "client_secret": CLIENT_SECRET,
+                "redirect_uris": [REDIRECT_URI],
+                "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+                "token_uri": "https://oauth2.googleapis.com/token",
+            }
+        },
+        scopes=SCOPES,
+        redirect_uri=REDIRECT_URI
+    )
+
+# Heavy clients (OAuth flow, Supabase, embedding model) are built on first use;
+# WARMUP_COMPONENTS lists the ones to load in the background right after startup.
+register("oauth_flow", create_oauth_flow)
+WARMUP_COMPONENTS = [name for name in os.getenv("WARMUP_COMPONENTS", "oauth_flow,supabase,embedder").split(",") if name]
+warmup_task = None
+
+@app.on_event("startup")
+async def start_warm_up():
+    global warmup_task
+    warmup_task = asyncio.create_task(warm_up(WARMUP_COMPONENTS))
+
+# Grouped summaries are precomputed shortly before each user's summary_time; see digest_scheduler.py
+digest_scheduler = DigestScheduler()
 
-# Initialize the embedding model
-embedder = SentenceTransformer('all-MiniLM-L6-v2')
+@app.on_event("startup")
+async def start_digest_scheduler():
+    if DIGEST_SCHEDULER_ENABLED:
+        digest_scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_digest_scheduler():
+    await digest_scheduler.stop()
 
 def encode_email(email):
-    text = f"Subject: {email.get('subject', '')}\nSender: {email.get('sender', '')}\nBody: {email.get('body', '')}"
-    return embedder.encode(text, convert_to_numpy=True)
+    return encode_texts([email_text(email)])[0]
 
 def build_vector_index(emails):
-    embeddings = []
-    email_ids = []
-    for email in emails:
-        emb = encode_email(email)
-        embeddings.append(emb)
-        email_ids.append(email['id'])
-    embeddings = np.stack(embeddings)
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(np.array(embeddings, dtype=np.float32))
+    """Builds an in-memory cosine-similarity index over the emails with one batched encode call."""
+    email_ids = [email['id'] for email in emails]
+    embeddings = encode_texts(email_text(email) for email in emails)
+    import faiss
+    index = faiss.IndexFlatIP(embeddings.shape[1])
+    index.add(embeddings)
     return index, email_ids
 
 def retrieve_relevant_emails(query, index, emails, email_ids, top_k=5):
-    query_embedding = embedder.encode([query], convert_to_numpy=True)
-    query_embedding = np.array(query_embedding, dtype=np.float32)
+    query_embedding = encode_texts([query])
     distances, indices = index.search(query_embedding, top_k)
     retrieved = []
     for idx in indices[0]:
-        if idx < len(emails):
+        if 0 <= idx < len(emails):
             retrieved.append(emails[idx])
     return retrieved
 
@@ -104,19 +157,95 @@ def generate_reply_with_context(aggregated_context):
         "Based on these emails, please generate a professional summary and a suggested reply. "
         "Do not mention that these are aggregated emails. The reply should end with 'Best regards, <Your Name>'."
     )
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.5
-    )
+    with span("llm.contextual_reply"):
+        response = chat_completion(
+            model="gpt-3.5-turbo",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.5
+        )
     return response.choices[0].message['content']
 
 @app.get("/")
 def read_root():
     return {"message": "Welcome to Mailliam!"}
 
+@app.get("/ready")
+def readiness():
+    """
+    Reports which lazily-loaded components are built. Returns 503 until the startup
+    warm-up has finished, so load balancers can hold traffic off cold workers.
+    """
+    warming_up = warmup_task is not None and not warmup_task.done()
+    content = {"ready": not warming_up, "warming_up": warming_up, "components": component_status()}
+    return JSONResponse(status_code=503 if warming_up else 200, content=content)
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    return cache_stats()
+
+@app.get("/gmail/stats")
+def get_gmail_stats(user_email: str = None):
+    return gmail_fetch_stats(user_email)
+
+@app.get("/dedup/stats")
+def get_dedup_stats():
+    """Messages collapsed into their thread or a near-duplicate, and the classifications and summaries that saved."""
+    return dedup_stats()
+
+@app.get("/sync/stats")
+def get_sync_stats():
+    """How many important-email requests started a refresh, joined a running one or reused a result."""
+    return shared_refresh_stats()
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus scrape endpoint."""
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+@app.exception_handler(TokenBudgetExceeded)
+async def token_budget_exceeded(request: Request, exc: TokenBudgetExceeded):
+    return JSONResponse(status_code=429, content={"detail": str(exc)})
+
+@app.get("/llm/usage")
+def get_llm_usage(user_email: str = None, day: str = None):
+    """LLM calls and tokens per user, endpoint and model for `day` (YYYY-MM-DD, today by default)."""
+    return usage_summary(user_email, day)
+
+@app.get("/llm/stats")
+def get_llm_stats():
+    return gateway_stats()
+
+@app.get("/classifier/stats")
+def get_classifier_stats():
+    return {**preclassifier_stats(), "llm_batches": classify_batch_stats()}
+
+@app.get("/embeddings/stats")
+def get_embedding_stats():
+    """Embedding backend in use, and how many encode requests shared a model call."""
+    return embedding_stats()
+
+@app.get("/scheduler/stats")
+def get_scheduler_stats():
+    return digest_scheduler.stats()
+
+class SummaryTimeUpdate(BaseModel):
+    email: str
+    summary_time: str
+
+@app.post("/update-summary-time")
+async def set_summary_time(update: SummaryTimeUpdate):
+    if not re.fullmatch(r"([01]\d|2[0-3]):[0-5]\d", update.summary_time):
+        raise HTTPException(status_code=400, detail="summary_time must be HH:MM")
+    try:
+        await run_blocking(update_summary_time, update.email, update.summary_time)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to update summary time: {str(e)}")
+    update_pooled_user(update.email, summary_time=update.summary_time)
+    return {"email": update.email, "summary_time": update.summary_time}
+
 @app.get("/auth/login")
 def login():
+    flow = get_component("oauth_flow")
     auth_url, _ = flow.authorization_url(prompt="consent")
     return RedirectResponse(auth_url)
 
@@ -125,6 +254,7 @@ def auth_callback(request: Request):
     code = request.query_params.get("code")
     if not code:
         raise HTTPException(status_code=400, detail="Authorization code not found")
+    flow = get_component("oauth_flow")
     try:
         flow.fetch_token(code=code)
     except Exception as e:
@@ -148,164 +278,83 @@ def auth_callback(request: Request):
         )
     except Exception as e:
         if "duplicate key value violates unique constraint" in str(e):
-            pass
+            update_user_tokens(user_email, credentials.token, credentials.refresh_token)
         else:
             raise HTTPException(status_code=500, detail=f"Failed to save user: {str(e)}")
+    # Drop any pooled client still holding the old tokens
+    evict_user(user_email)
+    forget_important_emails(user_email)
     return RedirectResponse(url=f"http://localhost:3000/home?email={user_email}")
 
-@app.get("/emails/important_full")
-def fetch_important_full_emails(user_email: str):
-    user_data = get_user_credentials(user_email)
-    if not user_data:
+async def get_user_gmail_client(user_email: str):
+    """Returns (Gmail service, user row) for a user, raising the matching HTTPException otherwise."""
+    # Credentials and the Gmail service are pooled per user across requests; expired
+    # tokens are refreshed and written back to Supabase by gmail_pool
+    try:
+        client = await run_blocking(acquire_gmail_client, user_email, SCOPES)
+    except Exception as e:
+        raise HTTPException(status_code=401, detail=f"Failed to authorize Gmail access: {str(e)}")
+    if not client:
         raise HTTPException(status_code=404, detail="User not found")
-    access_token = user_data.get("access_token")
-    refresh_token = user_data.get("refresh_token")
-    if not access_token:
+    user_data = client["user_data"]
+    if not client["service"]:
         raise HTTPException(status_code=400, detail="Access token missing for user")
     
-    service = get_gmail_service(access_token, refresh_token)
-    messages = []
-    page_token = None
-    max_emails = 100
+    return client["service"], user_data
 
+@app.get("/emails/important_full")
+async def fetch_important_full_emails(user_email: str, window: str = "1d"):
     try:
-        while True:
-            response = service.users().messages().list(
-                userId="me",
-                q="newer_than:1d",  # fetch all emails from the last 24 hours
-                pageToken=page_token
-            ).execute()
-            msgs = response.get("messages", [])
-            messages.extend(msgs)
-            if len(messages) >= max_emails:
-                messages = messages[:max_emails]
-                break
-            page_token = response.get("nextPageToken")
-            if not page_token:
-                break
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to list emails: {str(e)}")
-
-    emails_data = []
-    gmail_important_ids = set()
-
-    for msg in messages:
-        try:
-            # Retrieve the full email instead of metadata so we get internalDate
-            msg_data = service.users().messages().get(
-                userId="me",
-                id=msg["id"],
-                format="full"
-            ).execute()
-        except Exception:
-            continue
-        headers = msg_data.get("payload", {}).get("headers", [])
-        subject = next((h["value"] for h in headers if h["name"].lower() == "subject"), "")
-        sender = next((h["value"] for h in headers if h["name"].lower() == "from"), "")
-        snippet = msg_data.get("snippet", "")
-        label_ids = msg_data.get("labelIds", [])
-        if "IMPORTANT" in label_ids:
-            gmail_important_ids.add(msg["id"])
-        body_preview = extract_plain_text_body(msg_data.get("payload", {}))
-        # Extract internalDate and convert it
-        internal_date = msg_data.get("internalDate")
-        if internal_date:
-            time_str = datetime.fromtimestamp(int(internal_date) / 1000).strftime("%Y-%m-%d %H:%M:%S")
-        else:
-            time_str = "Unknown"
-            
-        emails_data.append({
-            "id": msg["id"],
-            "subject": subject,
-            "sender": sender,
-            "snippet": snippet,
-            "body": body_preview,
-            "time": time_str
-        })
-
-    classifier_result = classify_emails(emails_data)
+        window_delta = parse_window(window)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    service, user_data = await get_user_gmail_client(user_email)
+    # Only new or changed mail since the stored historyId is fetched, classified and
+    # summarized, and concurrent requests for the same user share one refresh; see
+    # mailbox_sync.shared_refresh_important_emails. At most SYNC_MAX_EMAILS messages
+    # are processed per refresh; /emails/important pages through the whole window.
     try:
-        classifier_ids = set(json.loads(classifier_result))
+        important_emails = await shared_refresh_important_emails(
+            service, user_email, user_data.get("history_id"), window_delta, synced_from=user_data.get("synced_from"),
+            pending_ids=user_data.get("pending_message_ids")
+        )
+    except TokenBudgetExceeded:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to parse classification result: {str(e)}")
-    
-    important_ids = list(gmail_important_ids.union(classifier_ids))
-    important_emails = []
-    for email_id in important_ids:
-        meta = next((x for x in emails_data if x["id"] == email_id), None)
-        if not meta:
-            continue
-        try:
-            full_msg = service.users().messages().get(
-                userId="me",
-                id=email_id,
-                format="full"
-            ).execute()
-        except Exception:
-            continue
-        headers = full_msg.get("payload", {}).get("headers", [])
-        subject = next((h["value"] for h in headers if h["name"].lower() == "subject"), meta.get("subject"))
-        sender = next((h["value"] for h in headers if h["name"].lower() == "from"), meta.get("sender"))
-        full_body = extract_plain_text_body(full_msg.get("payload", {}))
-        if full_body and len(full_body) > 500:
-            full_body = full_body[:500] + "..."
-        
-        summarizer_input = {
-            "subject": subject,
-            "sender": sender,
-            "payload": {"body": {"data": full_body}}
-        }
-        summary_reply = openai_summary_and_reply(summarizer_input)
-        try:
-            summary_reply_parsed = json.loads(summary_reply)
-        except Exception:
-            summary_reply_parsed = {"summary": summary_reply, "suggested_reply": ""}
-        
-        important_emails.append({
-            "id": email_id,
-            "subject": subject,
-            "sender": sender,
-            "snippet": meta.get("snippet"),
-            "full_body": full_body,
-            "summary_info": summary_reply_parsed,
-            "time": meta.get("time", "Unknown")
-        })
+        raise HTTPException(status_code=500, detail=f"Failed to sync emails: {str(e)}")
     
     return JSONResponse(content={"important_emails": important_emails})
 
-def get_gmail_service(access_token: str, refresh_token: str):
-    creds = Credentials(
-        token=access_token,
-        refresh_token=refresh_token,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=CLIENT_ID,
-        client_secret=CLIENT_SECRET,
-        scopes=SCOPES
-    )
-    return build("gmail", "v1", credentials=creds)
-
-def extract_plain_text_body(payload):
-    parts = payload.get("parts")
-    if parts:
-        for part in parts:
-            mime_type = part.get("mimeType", "")
-            if mime_type == "text/plain":
-                body_data = part["body"].get("data", "")
-                return decode_base64(body_data)
-            else:
-                nested = extract_plain_text_body(part)
-                if nested:
-                    return nested
-    if payload.get("mimeType") == "text/plain":
-        body_data = payload.get("body", {}).get("data", "")
-        return decode_base64(body_data)
-    return None
-
-def decode_base64(data):
-    if not data:
-        return ""
-    decoded_bytes = base64.urlsafe_b64decode(data)
-    return decoded_bytes.decode("utf-8", errors="replace")
+@app.get("/emails/important")
+async def list_important_emails(user_email: str, window: str = "1d", page_size: int = 20, cursor: str = None):
+    """
+    Pages through the user's important emails received within `window` (e.g. 12h,
+    1d, 7d), newest first. Returns {"important_emails": [...], "next_cursor": ...};
+    pass next_cursor back as `cursor` for the next page, until it is null. Mail is
+    processed a chunk at a time as the pages are read, so the first page is as quick
+    for a huge mailbox as for a small one.
+    """
+    if not 1 <= page_size <= 100:
+        raise HTTPException(status_code=400, detail="page_size must be between 1 and 100")
+    try:
+        window_delta = parse_window(window)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    service, user_data = await get_user_gmail_client(user_email)
+    try:
+        important_emails, next_cursor = await important_emails_page(
+            service, user_email, user_data.get("history_id"), window_delta, page_size, cursor,
+            synced_from=user_data.get("synced_from"), pending_ids=user_data.get("pending_message_ids")
+        )
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except TokenBudgetExceeded:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to sync emails: {str(e)}")
+    return JSONResponse(content={"important_emails": important_emails, "next_cursor": next_cursor})
 
 def get_user_profile(access_token: str, refresh_token: str):
     creds = Credentials(
@@ -317,24 +366,38 @@ def get_user_profile(access_token: str, refresh_token: str):
         scopes=["https://www.googleapis.com/auth/userinfo.profile"]
     )
     people_service = build("people", "v1", credentials=creds)
-    profile = people_service.people().get(
-        resourceName="people/me",
-        personFields="names,emailAddresses"
-    ).execute()
+    with span("google.people.get", upstream="google"):
+        profile = people_service.people().get(
+            resourceName="people/me",
+            personFields="names,emailAddresses"
+        ).execute()
     display_name = None
     if "names" in profile and profile["names"]:
         display_name = profile["names"][0].get("displayName")
     return display_name
 
 @app.get("/emails/grouped_summary")
-def get_grouped_summary(user_email: str):
+async def get_grouped_summary(user_email: str, refresh: bool = False):
     """
+    Serves the stored digest when it was built for the user's current summary_time
+    slot and no important mail has arrived since, unless refresh=true. Otherwise:
     1. Retrieve the important emails using fetch_important_full_emails.
-    2. Convert them into the format required by group_emails_by_llm:
+    2. Convert them into the format required by group_emails:
        each item must have 'subject', 'sender', 'summary', 'time', and 'suggested_reply'.
-    3. Call group_emails_by_llm and return the result as plain text.
+    3. Group them (locally clustered, LLM-named), store the digest and return the
+       Markdown as plain text.
     """
-    response = fetch_important_full_emails(user_email)
+    if not refresh:
+        _, user_data = await get_user_gmail_client(user_email)
+        try:
+            stored = await run_blocking(get_fresh_digest, user_email, user_data.get("summary_time"))
+        except Exception as e:
+            print(f"Failed to load stored digest for {user_email}: {e}")
+            stored = None
+        if stored:
+            return PlainTextResponse(content=stored["digest"], headers={"X-Digest-Computed-At": stored["computed_at"]})
+
+    response = await fetch_important_full_emails(user_email)
     try:
         data_dict = json.loads(response.body.decode("utf-8"))
     except Exception as e:
@@ -344,16 +407,71 @@ def get_grouped_summary(user_email: str):
         raise HTTPException(status_code=500, detail="No important emails found.")
     
     raw_emails = data_dict["important_emails"]
-    important_emails_data = []
-    for item in raw_emails:
-        summary_info = item.get("summary_info", {})
-        important_emails_data.append({
-            "subject": item.get("subject", ""),
-            "sender": item.get("sender", ""),
-            "summary": summary_info.get("summary", ""),
-            "time": item.get("time", "Unknown"),
-            "suggested_reply": summary_info.get("suggested_reply", "")
-        })
+    important_emails_data = [grouping_input(item) for item in raw_emails]
     
-    grouped_output = group_emails_by_llm(important_emails_data)
-    return PlainTextResponse(content=grouped_output)
\ No newline at end of file
+    grouped_output = await run_blocking(group_emails, important_emails_data)
+    computed_at = datetime.now().strftime(TIME_FORMAT)
+    run_in_background(save_digest, user_email, grouped_output, len(raw_emails), computed_at)
+    return PlainTextResponse(content=grouped_output, headers={"X-Digest-Computed-At": computed_at})
+
+@app.get("/emails/grouped_summary/stream")
+async def stream_grouped_summary(user_email: str, format: str = "sse"):
+    """
+    Streaming variant of /emails/grouped_summary, as server-sent events (format=sse)
+    or newline-delimited JSON (format=ndjson). Events, in order:
+      - "email": one important_emails entry, sent as soon as its summary is ready
+      - "token": {"text": ...}, the grouped Markdown, one group at a time
+      - "done": {"count": number of important emails}
+    A failure after the stream has started is reported as an "error" event.
+    """
+    if format not in ("sse", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'sse' or 'ndjson'")
+    service, user_data = await get_user_gmail_client(user_email)
+
+    def encode(event, data):
+        if format == "ndjson":
+            return json.dumps({"event": event, "data": data}) + "\n"
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    async def events():
+        queue = asyncio.Queue()
+        # The refresh is shared with concurrent requests for the same user (see
+        # mailbox_sync.shared_refresh_important_emails) and keeps running if the client
+        # disconnects, so its results are still persisted for the next request.
+        refresh = asyncio.create_task(shared_refresh_important_emails(
+            service, user_email, user_data.get("history_id"), on_email=queue.put_nowait,
+            synced_from=user_data.get("synced_from"), pending_ids=user_data.get("pending_message_ids")
+        ))
+        refresh.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while (email := await queue.get()) is not None:
+                yield encode("email", email)
+            important_emails = refresh.result()
+            grouping_items = [grouping_input(item) for item in important_emails]
+            async for token in iterate_blocking(iter_grouped_sections(grouping_items)):
+                yield encode("token", {"text": token})
+            yield encode("done", {"count": len(important_emails)})
+        except Exception as e:
+            yield encode("error", {"detail": str(e)})
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/event-stream"
+    return StreamingResponse(events(), media_type=media_type, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/emails/search")
+async def search_user_emails(user_email: str, q: str, top_k: int = 5):
+    """Semantic search over every email indexed for the user, not just the last refresh."""
+    try:
+        results = await run_blocking(search_emails, user_email, q, top_k)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+    return JSONResponse(content={"results": results})
+
+@app.get("/emails/contextual_reply")
+async def get_contextual_reply(user_email: str, q: str, top_k: int = 5):
+    """Drafts a summary and reply for `q`, using the user's most relevant past emails as context."""
+    response = await search_user_emails(user_email, q, top_k)
+    results = json.loads(response.body.decode("utf-8"))["results"]
+    if not results:
+        raise HTTPException(status_code=404, detail="No indexed emails found for user")
+    reply = await run_blocking(generate_reply_with_context, prepare_context_from_emails(results))
+    return JSONResponse(content={"reply": reply, "context_email_ids": [email["id"] for email in results]})
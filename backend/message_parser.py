@@ -0,0 +1,35 @@
+from datetime import datetime
+from mime_body import extract_body
+
+def parse_message(msg_data):
+    """
+    Reduces a format=full Gmail message to the compact record the pipeline needs:
+    id, thread_id, subject, sender, snippet, body text (see mime_body.extract_body),
+    internalDate in milliseconds and formatted.
+    Headers are scanned once; the first occurrence of each header wins.
+    """
+    wanted = {"subject": "", "from": ""}
+    found = set()
+    for header in msg_data.get("payload", {}).get("headers", []):
+        name = header["name"].lower()
+        if name in wanted and name not in found:
+            wanted[name] = header["value"]
+            found.add(name)
+            if len(found) == len(wanted):
+                break
+    # Extract internalDate and convert it
+    internal_date = msg_data.get("internalDate")
+    if internal_date:
+        time_str = datetime.fromtimestamp(int(internal_date) / 1000).strftime("%Y-%m-%d %H:%M:%S")
+    else:
+        time_str = "Unknown"
+    return {
+        "id": msg_data["id"],
+        "thread_id": msg_data.get("threadId"),
+        "subject": wanted["subject"],
+        "sender": wanted["from"],
+        "snippet": msg_data.get("snippet", ""),
+        "body": extract_body(msg_data.get("payload", {})),
+        "time": time_str,
+        "internal_date": int(internal_date) if internal_date else 0
+    }
@@ -0,0 +1,169 @@
+import contextvars
+import functools
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Add a Server-Timing breakdown to every response, not only to requests sending X-Debug-Timing: 1
+METRICS_TIMING_HEADER = os.getenv("METRICS_TIMING_HEADER", "0") == "1"
+METRICS_PREFIX = "mailliam_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# name: (type, help text, label names)
+METRICS = {
+    "http_request_seconds": ("histogram", "HTTP request latency by route", ("route", "method", "status")),
+    "stage_seconds": ("histogram", "Time spent in each pipeline stage or upstream call", ("stage",)),
+    "upstream_calls_total": ("counter", "Requests sent to Gmail, the LLM and Supabase", ("upstream", "operation")),
+    "upstream_errors_total": ("counter", "Upstream requests that failed", ("upstream", "operation")),
+    "upstream_retries_total": ("counter", "Upstream requests retried after a retryable error", ("upstream",)),
+    "upstream_bytes_total": ("counter", "Response bytes received from an upstream", ("upstream",)),
+    "llm_tokens_total": ("counter", "LLM tokens used, as reported by the API", ("model", "kind")),
+}
+
+_values = {name: {} for name in METRICS}
+_lock = threading.Lock()
+_trace = contextvars.ContextVar("trace", default=None)
+# Context variables carried into other threads by propagate_trace
+_propagated = [_trace]
+
+
+def count(name, amount=1, **labels):
+    key = tuple(str(labels.get(label, "")) for label in METRICS[name][2])
+    with _lock:
+        _values[name][key] = _values[name].get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    key = tuple(str(labels.get(label, "")) for label in METRICS[name][2])
+    with _lock:
+        histogram = _values[name].get(key)
+        if histogram is None:
+            histogram = _values[name][key] = {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def start_trace(trace_id=None):
+    """
+    Starts a trace for the current request and returns it. Spans opened in this
+    context (and in blocking calls handed off with propagate_trace) are added to
+    its per-stage breakdown.
+    """
+    trace = {"trace_id": trace_id or uuid.uuid4().hex[:16], "started": time.perf_counter(), "stages": {},
+             "lock": threading.Lock()}
+    _trace.set(trace)
+    return trace
+
+
+def current_trace_id():
+    trace = _trace.get()
+    return trace["trace_id"] if trace else None
+
+
+def propagate_var(var):
+    """Registers a context variable (default None) for propagate_trace to carry along with the trace."""
+    _propagated.append(var)
+
+
+def propagate_trace(func):
+    """
+    Wraps `func` so it runs under the caller's trace (and the other variables
+    registered with propagate_var) when called from another thread. Thread pools do
+    not copy context variables, so anything submitted to one goes through this.
+    """
+    values = [(var, var.get()) for var in _propagated if var.get() is not None]
+    if not values:
+        return func
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        tokens = [(var, var.set(value)) for var, value in values]
+        try:
+            return func(*args, **kwargs)
+        finally:
+            for var, token in reversed(tokens):
+                var.reset(token)
+    return run
+
+
+@contextmanager
+def span(stage, upstream=None):
+    """
+    Times a block as `stage`: observed in the stage_seconds histogram and added to
+    the current trace's breakdown. With `upstream`, it also counts as one call to
+    that upstream, and as an error if the block raises.
+    """
+    if upstream:
+        count("upstream_calls_total", upstream=upstream, operation=stage)
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        if upstream:
+            count("upstream_errors_total", upstream=upstream, operation=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        observe("stage_seconds", elapsed, stage=stage)
+        trace = _trace.get()
+        if trace is not None:
+            with trace["lock"]:
+                totals = trace["stages"].setdefault(stage, [0, 0.0])
+                totals[0] += 1
+                totals[1] += elapsed
+
+
+def traced(stage, upstream=None):
+    """Decorator form of span()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage, upstream):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def server_timing(trace):
+    """The trace's breakdown as a Server-Timing header value, total first."""
+    total = (time.perf_counter() - trace["started"]) * 1000
+    with trace["lock"]:
+        stages = sorted(trace["stages"].items(), key=lambda item: -item[1][1])
+    entries = [f"total;dur={total:.1f}"]
+    entries += [f'{stage};dur={seconds * 1000:.1f};desc="{calls} calls"' for stage, (calls, seconds) in stages]
+    return ", ".join(entries)
+
+
+def _format_labels(names, key, extra=None):
+    pairs = [(name, value) for name, value in zip(names, key)] + (extra or [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def render_prometheus():
+    """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    with _lock:
+        snapshot = {name: {key: (dict(value, buckets=list(value["buckets"])) if isinstance(value, dict) else value)
+                           for key, value in values.items()} for name, values in _values.items()}
+    for name, (kind, help_text, label_names) in METRICS.items():
+        full_name = METRICS_PREFIX + name
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        for key, value in sorted(snapshot[name].items()):
+            if kind == "counter":
+                lines.append(f"{full_name}{_format_labels(label_names, key)} {value}")
+                continue
+            for bound, bucket_count in zip(LATENCY_BUCKETS, value["buckets"]):
+                lines.append(f"{full_name}_bucket{_format_labels(label_names, key, [('le', str(bound))])} {bucket_count}")
+            lines.append(f"{full_name}_bucket{_format_labels(label_names, key, [('le', '+Inf')])} {value['count']}")
+            lines.append(f"{full_name}_sum{_format_labels(label_names, key)} {value['sum']:.6f}")
+            lines.append(f"{full_name}_count{_format_labels(label_names, key)} {value['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,164 @@
+import base64
+import codecs
+import html
+import os
+import re
+
+# Only this much of a text part is decoded; the pipeline keeps a few hundred
+# characters, so there is no point decoding a megabyte newsletter to get them.
+BODY_MAX_BYTES = int(os.getenv("BODY_MAX_BYTES", "16384"))
+# HTML carries markup and inline CSS, so more of it is decoded to reach the text
+BODY_HTML_MAX_BYTES = int(os.getenv("BODY_HTML_MAX_BYTES", "65536"))
+BODY_PREVIEW_CHARS = 500
+
+_CHARSET = re.compile(r'charset="?([\w.:-]+)', re.IGNORECASE)
+_HIDDEN_HTML = re.compile(r"<(script|style|head|title)\b.*?(?:</\1\s*>|$)", re.IGNORECASE | re.DOTALL)
+_HTML_COMMENT = re.compile(r"<!--.*?(?:-->|$)", re.DOTALL)
+_HTML_QUOTE = re.compile(
+    r"<blockquote\b[^>]*\btype=\"?cite.*?(?:</blockquote\s*>|$)|<div\b[^>]*\bclass=\"?gmail_quote.*$",
+    re.IGNORECASE | re.DOTALL
+)
+_HTML_BREAK = re.compile(r"<(?:br|/p|/div|/tr|/h[1-6]|/li|/table)\b[^>]*>", re.IGNORECASE)
+_HTML_TAG = re.compile(r"<[^>]*(?:>|$)")
+_SPACES = re.compile(r"[ \t\r\f\v\xa0]+")
+_BLANK_LINES = re.compile(r"\n\s*\n+")
+
+# A line that starts a quoted reply chain; everything from it on is dropped
+_REPLY_HEADER = re.compile(
+    r"^(?:On .{1,200}wrote:?|-{2,} ?Original Message ?-{2,}|-{2,} ?Forwarded message ?-{2,}"
+    r"|_{10,}|From: .+|Le .{1,200}a écrit ?:|Am .{1,200}schrieb .{1,200}:)\s*$",
+    re.IGNORECASE
+)
+# A line that starts a signature block
+_SIGNATURE = re.compile(
+    r"^(?:-- ?|Sent from my \w+.*|Get Outlook for \w+.*|Sent from Mail for Windows.*)$", re.IGNORECASE
+)
+
+
+def iter_parts(payload):
+    """
+    Yields a Gmail message payload and all of its nested parts in document order,
+    using an explicit stack so arbitrarily deep multipart trees cannot hit the
+    recursion limit.
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        yield part
+        children = part.get("parts")
+        if children:
+            stack.extend(reversed(children))
+
+
+def part_header(part, name):
+    for header in part.get("headers") or ():
+        if header.get("name", "").lower() == name:
+            return header.get("value", "")
+    return ""
+
+
+def is_attachment(part):
+    return bool(part.get("filename")) or part_header(part, "content-disposition").lower().startswith("attachment")
+
+
+def part_charset(part):
+    match = _CHARSET.search(part_header(part, "content-type"))
+    if match:
+        try:
+            return codecs.lookup(match.group(1)).name
+        except LookupError:
+            pass
+    return "utf-8"
+
+
+def decode_base64_prefix(data, max_bytes, charset="utf-8"):
+    """
+    Decodes at most `max_bytes` bytes of a base64url body into text. Only the
+    base64 characters needed are sliced off, and a multi-byte character cut in
+    half at the cap is dropped rather than turned into a replacement character.
+    """
+    if not data:
+        return ""
+    length = (max_bytes + 2) // 3 * 4
+    chunk = data[:length]
+    chunk += "=" * (-len(chunk) % 4)
+    try:
+        raw = base64.urlsafe_b64decode(chunk)
+    except (ValueError, TypeError):
+        return ""
+    if len(raw) > max_bytes:
+        raw = raw[:max_bytes]
+    truncated = len(data) > length
+    decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+    return decoder.decode(raw, final=not truncated)
+
+
+def html_to_text(markup):
+    """Cheap HTML to text: drops scripts, styles, comments and quoted replies, keeps line breaks."""
+    markup = _HTML_COMMENT.sub("", markup)
+    markup = _HIDDEN_HTML.sub("", markup)
+    markup = _HTML_QUOTE.sub("", markup)
+    markup = _HTML_BREAK.sub("\n", markup)
+    text = html.unescape(_HTML_TAG.sub(" ", markup))
+    return normalize_whitespace(text)
+
+
+def normalize_whitespace(text):
+    text = _SPACES.sub(" ", text)
+    text = "\n".join(line.strip() for line in text.split("\n"))
+    return _BLANK_LINES.sub("\n\n", text).strip()
+
+
+def strip_quotes_and_signature(text):
+    """
+    Drops the quoted reply chain ("On ... wrote:", "-----Original Message-----",
+    "> " lines) and a trailing signature ("-- ", "Sent from my iPhone"), keeping the
+    new content of the message. Returns the text unchanged if that would leave nothing.
+    """
+    kept = []
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if kept and (_REPLY_HEADER.match(stripped) or _SIGNATURE.match(line.rstrip("\r"))):
+            break
+        if stripped.startswith(">"):
+            continue
+        kept.append(line)
+    result = "\n".join(kept).strip()
+    return result or text.strip()
+
+
+def extract_body(payload, max_bytes=None, html_max_bytes=None):
+    """
+    Returns the readable text of a Gmail message payload: the first text/plain part,
+    or the first text/html part converted to text when there is no usable plain part,
+    with quoted replies and signatures removed. Attachments are skipped without being
+    decoded and each part is decoded only up to its byte cap. Returns None when the
+    message has no text part (e.g. a metadata-only fetch).
+    """
+    max_bytes = max_bytes or BODY_MAX_BYTES
+    html_max_bytes = html_max_bytes or BODY_HTML_MAX_BYTES
+    html_part = None
+    for part in iter_parts(payload):
+        mime_type = part.get("mimeType", "").lower()
+        if mime_type not in ("text/plain", "text/html") or is_attachment(part):
+            continue
+        data = (part.get("body") or {}).get("data")
+        if not data:
+            continue
+        if mime_type == "text/plain":
+            text = normalize_whitespace(decode_base64_prefix(data, max_bytes, part_charset(part)))
+            if text:
+                return strip_quotes_and_signature(text)
+        elif html_part is None:
+            html_part = part
+    if html_part is not None:
+        markup = decode_base64_prefix(html_part["body"]["data"], html_max_bytes, part_charset(html_part))
+        return strip_quotes_and_signature(html_to_text(markup))
+    return None
+
+
+def preview(text, limit=BODY_PREVIEW_CHARS):
+    """The first `limit` characters of a body, with "..." appended when it was cut."""
+    if text and len(text) > limit:
+        return text[:limit] + "..."
+    return text
@@ -0,0 +1,317 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from google_auth_httplib2 import AuthorizedHttp
+from classifier import classify_item, prepare_classify_inputs, plan_classify_batches, classify_batch
+from summarizer import openai_summary_and_reply, prepare_batch_inputs, plan_summary_batches, summarize_batch
+from gmail_batch import fetch_messages_batched, GMAIL_BATCH_SIZE
+from message_parser import parse_message
+from mime_body import preview
+from preclassifier import preclassify
+from gmail_pool import shared_http
+from metrics import propagate_trace
+from dedup import Deduplicator, DEDUP_ENABLED, record_run
+
+# Bounded concurrency per upstream: Gmail batch requests and LLM completions
+GMAIL_CONCURRENCY = int(os.getenv("GMAIL_CONCURRENCY", "4"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+# Pack several emails into one summarization request (set to 0 for one call per email)
+SUMMARY_BATCHING = os.getenv("SUMMARY_BATCHING", "1") == "1"
+# "two_tier": classify from headers and snippet (format=metadata) and fetch full
+# bodies only for important emails; "full": fetch every message in full up front
+GMAIL_FETCH_MODE = os.getenv("GMAIL_FETCH_MODE", "two_tier")
+METADATA_HEADERS = ["Subject", "From"]
+METADATA_FIELDS = "id,threadId,labelIds,snippet,internalDate,payload/mimeType,payload/headers"
+FULL_FIELDS = "id,threadId,labelIds,snippet,internalDate,payload"
+
+# The Google and OpenAI clients are blocking, so they run on a dedicated pool sized
+# to the upstream limits rather than competing with FastAPI's shared threadpool.
+_executor = ThreadPoolExecutor(max_workers=GMAIL_CONCURRENCY + LLM_CONCURRENCY + 2, thread_name_prefix="pipeline")
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking call on the pipeline executor without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    func = propagate_trace(func)
+    return await loop.run_in_executor(_executor, lambda: func(*args, **kwargs))
+
+
+async def iterate_blocking(iterable):
+    """Iterates a blocking iterator (e.g. a streamed completion) on the pipeline executor."""
+    iterator = iter(iterable)
+    done = object()
+    while True:
+        item = await run_blocking(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+def run_in_background(func, *args, **kwargs):
+    """Submits a blocking call to the pipeline executor without waiting; failures are logged."""
+    @propagate_trace
+    def task():
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            print(f"Background task {func.__name__} failed: {e}")
+    return _executor.submit(task)
+
+
+def thread_http(service):
+    """
+    httplib2 connections are not thread-safe, so batches sent from an executor thread
+    go over that thread's shared keep-alive connection, authorized with the same
+    credentials as the service.
+    """
+    if isinstance(service._http, AuthorizedHttp):
+        return AuthorizedHttp(service._http.credentials, http=shared_http())
+    return shared_http()
+
+
+def truncated_body(record):
+    return preview(record["body"])
+
+
+def build_important_entry(record, summary_reply):
+    """Builds the important_emails entry for a stored record and its summarizer output."""
+    try:
+        summary_reply_parsed = json.loads(summary_reply)
+    except Exception:
+        summary_reply_parsed = {"summary": summary_reply, "suggested_reply": ""}
+
+    return {
+        "id": record["id"],
+        "subject": record["subject"],
+        "sender": record["sender"],
+        "snippet": record.get("snippet"),
+        "full_body": truncated_body(record),
+        "summary_info": summary_reply_parsed,
+        "time": record.get("time", "Unknown"),
+        "thread_id": record.get("thread_id")
+    }
+
+
+def summarize_email(record):
+    """Runs the single-email summarizer on a stored message record."""
+    summarizer_input = {
+        "subject": record["subject"],
+        "sender": record["sender"],
+        "payload": {"body": {"data": truncated_body(record)}},
+        "thread": record.get("thread")
+    }
+    return build_important_entry(record, openai_summary_and_reply(summarizer_input))
+
+
+def new_fetch_stats():
+    return {tier: {"requests": 0, "messages": 0, "bytes": 0, "seconds": 0.0} for tier in ("metadata", "full")}
+
+
+def add_fetch_stats(stats, tier, fetched):
+    stats[tier]["requests"] += fetched["round_trips"]
+    stats[tier]["messages"] += len(fetched["messages"])
+    stats[tier]["bytes"] += fetched["bytes"]
+    stats[tier]["seconds"] = round(stats[tier]["seconds"] + fetched["seconds"], 3)
+
+
+async def process_messages(service, message_ids, gmail_concurrency=None, llm_concurrency=None, message_store=None,
+                           on_summary=None, fetch_stats=None, gmail_semaphore=None, llm_semaphore=None, dedup=None,
+                           failed_ids=None):
+    """
+    Fetches, classifies and summarizes the given messages as an overlapping pipeline:
+    each Gmail batch is classified as soon as it arrives (locally where the
+    pre-classifier is confident, by the LLM otherwise), and emails are summarized
+    as soon as they are known to be important (Gmail's IMPORTANT label or the
+    classifier), packed into batched summarization requests unless SUMMARY_BATCHING=0.
+    Classification requests are packed up to CLASSIFY_TOKEN_BUDGET tokens each.
+    In the default two-tier fetch mode, messages are first fetched as metadata only
+    and full bodies are fetched just for the emails that are going to be summarized.
+    Every upstream has its own semaphore, so end-to-end latency tracks the slowest
+    stage instead of the sum of all calls.
+
+    Returns the important_emails list in mailbox order. Pass a dict as `message_store`
+    to also receive the parsed record of every message that was fetched, and a callable
+    as `on_summary` to receive each important_emails entry as soon as it is ready.
+    A dict from new_fetch_stats() passed as `fetch_stats` is filled with per-tier
+    Gmail request, message, byte and latency totals. A set passed as `failed_ids`
+    receives the messages that could not be fetched for transient reasons (see
+    fetch_messages_batched's 'retry_later'), so the caller can try them again later.
+
+    `gmail_semaphore` and `llm_semaphore` replace the per-call semaphores with any
+    async context manager, e.g. slots shared by several users processed at once.
+
+    Unless `dedup` (default DEDUP_ENABLED) is false, messages are collapsed by Gmail
+    thread and near-duplicate content as they are fetched (see dedup.Deduplicator):
+    only each group's representative is classified and summarized, with the rest of
+    its thread as context, and its entry lists the others in "collapsed_ids".
+    """
+    gmail_semaphore = gmail_semaphore or asyncio.Semaphore(gmail_concurrency or GMAIL_CONCURRENCY)
+    llm_semaphore = llm_semaphore or asyncio.Semaphore(llm_concurrency or LLM_CONCURRENCY)
+
+    message_store = {} if message_store is None else message_store
+    deduplicator = Deduplicator() if (DEDUP_ENABLED if dedup is None else dedup) else None
+    fetch_stats = new_fetch_stats() if fetch_stats is None else fetch_stats
+    two_tier = GMAIL_FETCH_MODE == "two_tier"
+    bodies_loaded = set()
+    summaries = {}
+    scheduled = set()
+    classify_tasks = []
+    summarize_tasks = []
+
+    def add_summary(email_id, entry):
+        summaries[email_id] = entry
+        if on_summary is not None:
+            on_summary(entry)
+
+    def with_thread_context(email_id):
+        """The record, plus the rest of its thread (as known so far) for the classifier and summarizer."""
+        record = message_store[email_id]
+        thread = deduplicator.thread_context(email_id) if deduplicator else None
+        return dict(record, thread=thread) if thread else record
+
+    async def summarize_one(email_id):
+        async with llm_semaphore:
+            add_summary(email_id, await run_blocking(summarize_email, with_thread_context(email_id)))
+
+    async def summarize_batch_task(batch):
+        async with llm_semaphore:
+            results = await run_blocking(summarize_batch, batch)
+        for email_id, summary_reply in results.items():
+            add_summary(email_id, build_important_entry(message_store[email_id], summary_reply))
+
+    async def summarize_group(email_ids):
+        cached, pending = await run_blocking(prepare_batch_inputs, [with_thread_context(email_id) for email_id in email_ids])
+        for email_id, summary_reply in cached.items():
+            add_summary(email_id, build_important_entry(message_store[email_id], summary_reply))
+        await asyncio.gather(*(summarize_batch_task(batch) for batch in plan_summary_batches(pending)))
+
+    async def load_bodies(email_ids):
+        """Replaces metadata-only records with full ones; failed fetches keep the snippet."""
+        missing = [email_id for email_id in email_ids if email_id not in bodies_loaded]
+        for i in range(0, len(missing), GMAIL_BATCH_SIZE):
+            chunk = missing[i:i + GMAIL_BATCH_SIZE]
+            async with gmail_semaphore:
+                fetched = await run_blocking(
+                    lambda: fetch_messages_batched(service, chunk, format="full", fields=FULL_FIELDS,
+                                                   http=thread_http(service))
+                )
+            add_fetch_stats(fetch_stats, "full", fetched)
+            if fetched["errors"]:
+                print(f"Failed to fetch {len(fetched['errors'])} email bodies: {fetched['errors']}")
+            for message_id, msg_data in fetched["messages"].items():
+                message_store[message_id] = parse_message(msg_data)
+                bodies_loaded.add(message_id)
+
+    async def summarize_ids(email_ids):
+        await load_bodies(email_ids)
+        if SUMMARY_BATCHING:
+            await summarize_group(email_ids)
+        else:
+            await asyncio.gather(*(summarize_one(email_id) for email_id in email_ids))
+
+    def schedule_summaries(email_ids):
+        new_ids = []
+        for email_id in email_ids:
+            if deduplicator is not None:
+                # The group's representative may have changed while the email was classified
+                email_id = deduplicator.representative_of(email_id)
+            if email_id in message_store and email_id not in scheduled:
+                scheduled.add(email_id)
+                new_ids.append(email_id)
+        if new_ids:
+            summarize_tasks.append(asyncio.create_task(summarize_ids(new_ids)))
+
+    async def classify(batch):
+        async with llm_semaphore:
+            classifier_ids = await run_blocking(classify_batch, batch)
+        schedule_summaries(classifier_ids)
+
+    async def fetch(chunk):
+        async with gmail_semaphore:
+            if two_tier:
+                fetched = await run_blocking(
+                    lambda: fetch_messages_batched(service, chunk, format="metadata", metadataHeaders=METADATA_HEADERS,
+                                                   fields=METADATA_FIELDS, http=thread_http(service))
+                )
+            else:
+                fetched = await run_blocking(
+                    lambda: fetch_messages_batched(service, chunk, format="full", http=thread_http(service))
+                )
+        add_fetch_stats(fetch_stats, "metadata" if two_tier else "full", fetched)
+        if not two_tier:
+            bodies_loaded.update(fetched["messages"])
+        if fetched["errors"]:
+            print(f"Failed to fetch {len(fetched['errors'])} emails: {fetched['errors']}")
+        if failed_ids is not None:
+            failed_ids.update(fetched["retry_later"])
+
+        records = []
+        gmail_important_ids = []
+        for message_id in chunk:
+            msg_data = fetched["messages"].get(message_id)
+            if msg_data is None:
+                continue
+            message_store[message_id] = parse_message(msg_data)
+            records.append(message_store[message_id])
+            if "IMPORTANT" in msg_data.get("labelIds", []):
+                gmail_important_ids.append(message_id)
+        fetched_records = records
+        labelled_ids = set(gmail_important_ids)
+        if deduplicator is not None:
+            # Only group representatives go further; a Gmail IMPORTANT label on any
+            # member marks its group's representative. A thread judged unimportant in
+            # an earlier chunk is judged again with the messages this chunk added to
+            # it, and a newer message replacing an important representative inherits
+            # its summary slot (the replaced entry is dropped below).
+            records, extended_ids, replaced = deduplicator.add(records)
+            gmail_important_ids += [new_id for new_id, old_id in replaced.items() if old_id in scheduled]
+            records += [message_store[email_id] for email_id in extended_ids if email_id in message_store]
+        schedule_summaries(gmail_important_ids)
+
+        # Emails Gmail already marked important need no classification. Of the rest,
+        # the local pre-classifier decides the confident cases and only the uncertain
+        # band is sent to the LLM classifier.
+        to_classify = [with_thread_context(record["id"]) for record in records if record["id"] not in scheduled]
+        local_important_ids, _, uncertain = await run_blocking(preclassify, to_classify)
+        schedule_summaries(local_important_ids)
+        cached_important_ids, pending = await run_blocking(prepare_classify_inputs, uncertain)
+        schedule_summaries(cached_important_ids)
+        for batch in plan_classify_batches(pending):
+            classify_tasks.append(asyncio.create_task(classify(batch)))
+        if deduplicator is not None:
+            # Without dedup, the members this chunk collapsed into the groups sent to
+            # the LLM would have been classified alongside the chunk's own representatives
+            pending_ids = {email["id"] for email in pending}
+            chunk_ids = set(chunk)
+            without_dedup = [email for email in pending if email["id"] in chunk_ids] + [
+                classify_item(record) for record in fetched_records
+                if record["id"] not in labelled_ids and record["id"] not in pending_ids
+                and deduplicator.representative_of(record["id"]) in pending_ids
+            ]
+            deduplicator.stats["classify_calls_avoided"] += (len(plan_classify_batches(without_dedup))
+                                                            - len(plan_classify_batches(pending)))
+
+    message_ids = list(dict.fromkeys(message_ids))
+    fetch_tasks = [
+        asyncio.create_task(fetch(message_ids[i:i + GMAIL_BATCH_SIZE]))
+        for i in range(0, len(message_ids), GMAIL_BATCH_SIZE)
+    ]
+    try:
+        # Later stages are scheduled by earlier ones, so each list is complete
+        # once the stage before it has finished.
+        await asyncio.gather(*fetch_tasks)
+        await asyncio.gather(*classify_tasks)
+        await asyncio.gather(*summarize_tasks)
+    except BaseException:
+        for task in fetch_tasks + classify_tasks + summarize_tasks:
+            task.cancel()
+        raise
+
+    if deduplicator is not None:
+        summaries = {email_id: entry for email_id, entry in summaries.items()
+                     if deduplicator.representative_of(email_id) == email_id}
+        for email_id, entry in summaries.items():
+            entry["collapsed_ids"] = deduplicator.collapsed_ids(email_id)
+        record_run(deduplicator, summaries)
+    return [summaries[message_id] for message_id in message_ids if message_id in summaries]
@@ -0,0 +1,144 @@
+import json
+import os
+import threading
+from embeddings import encode_texts
+from classifier import plan_classify_batches
+
+# Emails whose centroid margin (cosine to "important" minus cosine to "junk") is at
+# least this far from zero are decided locally; the rest go to the LLM classifier.
+PRECLASSIFIER_THRESHOLD = float(os.getenv("PRECLASSIFIER_THRESHOLD", "0.1"))
+# Off by default: emails it calls junk never reach the LLM, and neither the seed
+# examples nor the threshold have been measured. Enable it with a threshold chosen
+# from eval_preclassifier.py on your own labelled mail.
+PRECLASSIFIER_ENABLED = os.getenv("PRECLASSIFIER_ENABLED", "0") == "1"
+# Optional JSON file of extra labelled examples: [{"subject", "sender", "snippet", "label"}],
+# with label "important" or "junk"
+PRECLASSIFIER_EXAMPLES = os.getenv("PRECLASSIFIER_EXAMPLES")
+
+SEED_EXAMPLES = [
+    {"label": "important", "subject": "Can we move our 1:1 to Thursday?", "sender": "manager@company.com",
+     "snippet": "Hi, something came up on Wednesday. Would Thursday at 2pm work for you instead?"},
+    {"label": "important", "subject": "Contract review needed by Friday", "sender": "legal@company.com",
+     "snippet": "Please review the attached contract and send me your comments before Friday's signing."},
+    {"label": "important", "subject": "Interview invitation - Software Engineer", "sender": "recruiter@startup.io",
+     "snippet": "We'd like to invite you to an onsite interview. Please let us know your availability next week."},
+    {"label": "important", "subject": "Re: question about the deployment", "sender": "alex@company.com",
+     "snippet": "Did you get a chance to look at the failing deployment? I need your input before we roll back."},
+    {"label": "important", "subject": "Dinner on Saturday?", "sender": "friend@gmail.com",
+     "snippet": "Hey! Are you free for dinner this Saturday? Let me know and I'll book a table."},
+    {"label": "important", "subject": "Your offer letter", "sender": "hr@company.com",
+     "snippet": "Congratulations! Please review and sign your offer letter by the end of the week."},
+    {"label": "important", "subject": "Action required: approve expense report", "sender": "finance@company.com",
+     "snippet": "Your approval is needed for the team expense report submitted on Monday."},
+    {"label": "important", "subject": "Feedback on your draft", "sender": "professor@university.edu",
+     "snippet": "I read your draft and left comments. Can you address them and resend by Tuesday?"},
+    {"label": "junk", "subject": "50% off everything this weekend only", "sender": "deals@store.com",
+     "snippet": "Don't miss our biggest sale of the year. Shop now and save on all items."},
+    {"label": "junk", "subject": "Your weekly newsletter", "sender": "newsletter@media.com",
+     "snippet": "Here are this week's top stories, curated just for you. Unsubscribe at any time."},
+    {"label": "junk", "subject": "New jobs matching your profile", "sender": "jobs-noreply@jobboard.com",
+     "snippet": "10 new jobs match your saved search. Apply now to be one of the first applicants."},
+    {"label": "junk", "subject": "Your daily digest", "sender": "digest@community.com",
+     "snippet": "Top posts from your communities today. See what people are talking about."},
+    {"label": "junk", "subject": "Exclusive offer just for you", "sender": "promo@brand.com",
+     "snippet": "Unlock an exclusive discount on your next purchase with code SAVE20."},
+    {"label": "junk", "subject": "Your order has shipped", "sender": "no-reply@shop.com",
+     "snippet": "Good news! Your package is on its way. Track your shipment with the link below."},
+    {"label": "junk", "subject": "Security alert: new sign-in", "sender": "no-reply@accounts.example.com",
+     "snippet": "We noticed a new sign-in to your account from Chrome on Windows. If this was you, no action is needed."},
+    {"label": "junk", "subject": "Someone liked your post", "sender": "notifications@social.com",
+     "snippet": "You have new notifications. See who liked and commented on your recent post."},
+]
+
+_centroids = None
+_unavailable = None
+_centroids_lock = threading.Lock()
+_stats = {"emails": 0, "important": 0, "junk": 0, "sent_to_llm": 0, "llm_calls_avoided": 0}
+_stats_lock = threading.Lock()
+
+
+def classifier_text(email):
+    return f"Subject: {email.get('subject', '')}\nSender: {email.get('sender', '')}\nSnippet: {email.get('snippet', '')}"
+
+
+def load_examples(path=None):
+    examples = list(SEED_EXAMPLES)
+    path = path or PRECLASSIFIER_EXAMPLES
+    if path:
+        with open(path) as f:
+            examples.extend(json.load(f))
+    return examples
+
+
+def fit_centroids(examples):
+    """Returns {label: unit-length centroid} over the examples' embeddings."""
+    import numpy as np
+    embeddings = encode_texts(classifier_text(example) for example in examples)
+    centroids = {}
+    for label in ("important", "junk"):
+        rows = embeddings[[i for i, example in enumerate(examples) if example["label"] == label]]
+        centroid = rows.mean(axis=0)
+        centroids[label] = centroid / np.linalg.norm(centroid)
+    return centroids
+
+
+def get_centroids():
+    global _centroids
+    if _centroids is None:
+        with _centroids_lock:
+            if _centroids is None:
+                _centroids = fit_centroids(load_examples())
+    return _centroids
+
+
+def score_emails(emails, centroids=None):
+    """Centroid margin per email: > 0 leans important, < 0 leans junk."""
+    centroids = centroids or get_centroids()
+    embeddings = encode_texts(classifier_text(email) for email in emails)
+    return embeddings @ centroids["important"] - embeddings @ centroids["junk"]
+
+
+def preclassify(emails, threshold=None, centroids=None):
+    """
+    Splits emails into (important_ids, junk_ids, uncertain_emails) using the local
+    nearest-centroid model. Only the uncertain middle band needs the LLM.
+
+    If the embedding model cannot be loaded (e.g. sentence-transformers is not
+    installed) or PRECLASSIFIER_ENABLED is not 1, every email is returned as uncertain.
+    """
+    global _unavailable
+    threshold = PRECLASSIFIER_THRESHOLD if threshold is None else threshold
+    if not emails or not PRECLASSIFIER_ENABLED or _unavailable:
+        return [], [], list(emails)
+    try:
+        scores = score_emails(emails, centroids)
+    except ImportError as e:
+        _unavailable = str(e)
+        print(f"Pre-classifier disabled, sending all emails to the LLM: {e}")
+        return [], [], list(emails)
+    except Exception as e:
+        print(f"Pre-classifier failed, sending these emails to the LLM: {e}")
+        return [], [], list(emails)
+
+    important_ids, junk_ids, uncertain = [], [], []
+    for email, score in zip(emails, scores):
+        if score >= threshold:
+            important_ids.append(email["id"])
+        elif score <= -threshold:
+            junk_ids.append(email["id"])
+        else:
+            uncertain.append(email)
+
+    with _stats_lock:
+        _stats["emails"] += len(emails)
+        _stats["important"] += len(important_ids)
+        _stats["junk"] += len(junk_ids)
+        _stats["sent_to_llm"] += len(uncertain)
+        # Classifier requests are packed by token budget, so count the batches it would plan
+        _stats["llm_calls_avoided"] += len(plan_classify_batches(emails)) - len(plan_classify_batches(uncertain))
+    return important_ids, junk_ids, uncertain
+
+
+def preclassifier_stats():
+    with _stats_lock:
+        return dict(_stats, threshold=PRECLASSIFIER_THRESHOLD)
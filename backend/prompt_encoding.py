@@ -0,0 +1,34 @@
+import json
+
+
+def compact_json(value):
+    """JSON without whitespace and with non-ASCII text unescaped, which takes far fewer tokens than indented JSON."""
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def table(items, fields):
+    """
+    `items` as a compact JSON array of rows whose first row names the `fields`, so
+    key names are sent once per prompt instead of once per item.
+    """
+    return compact_json([list(fields)] + [[item.get(field) for field in fields] for item in items])
+
+
+def parse_table(text):
+    """The items encoded by table(), as dicts."""
+    rows = json.loads(text)
+    return [dict(zip(rows[0], row)) for row in rows[1:]]
+
+
+def row_numbers(values, count):
+    """
+    The valid 1-based row numbers in a model's answer, as 0-based indexes into a
+    table of `count` rows. Numbers sent back as strings are accepted too.
+    """
+    indexes = []
+    for value in values:
+        if isinstance(value, str) and value.strip().isdigit():
+            value = int(value)
+        if isinstance(value, int) and not isinstance(value, bool) and 1 <= value <= count:
+            indexes.append(value - 1)
+    return indexes
@@ -0,0 +1,208 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+# faiss and numpy are imported where used so importing this module stays cheap
+from embeddings import email_text, encode_texts
+
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "vector_indexes")
+# "flat" (exact), or "hnsw" / "ivf" for approximate search on large mailboxes
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "flat")
+# Mailboxes smaller than this stay on the exact flat index even if ANN is configured
+VECTOR_INDEX_ANN_MIN = int(os.getenv("VECTOR_INDEX_ANN_MIN", "20000"))
+# Only this much of each body is kept in the ID map for building reply context
+STORED_BODY_CHARS = 1000
+# Loaded indexes kept in memory; the least recently used are dropped beyond this
+VECTOR_INDEX_CACHE_USERS = int(os.getenv("VECTOR_INDEX_CACHE_USERS", "100"))
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _user_lock(user_email):
+    with _locks_guard:
+        return _locks.setdefault(user_email, threading.Lock())
+
+
+def _paths(user_email):
+    name = hashlib.sha256(user_email.lower().encode("utf-8")).hexdigest()[:32]
+    return os.path.join(VECTOR_INDEX_DIR, f"{name}.faiss"), os.path.join(VECTOR_INDEX_DIR, f"{name}.json")
+
+
+@contextmanager
+def _file_lock(user_email, exclusive=True):
+    """
+    Locks the user's index files against other processes (uvicorn workers, fan-out
+    workers), which keep their own in-memory copies: writers hold it exclusively from
+    reload to save so one process never overwrites rows another has just added.
+    """
+    index_path, _ = _paths(user_email)
+    os.makedirs(VECTOR_INDEX_DIR, exist_ok=True)
+    with open(index_path[:-len(".faiss")] + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _stamp(user_email):
+    """(mtime, size) of both index files, or None if the user has no saved index."""
+    try:
+        return tuple((stat.st_mtime_ns, stat.st_size) for stat in map(os.stat, _paths(user_email)))
+    except FileNotFoundError:
+        return None
+
+
+def new_index(dimension, index_type="flat", training_vectors=None):
+    """
+    Builds an inner-product index over unit vectors (cosine similarity), wrapped in an
+    ID map so rows keep stable int64 IDs as the mailbox grows.
+    """
+    import faiss
+    import numpy as np
+    if index_type == "hnsw":
+        base = faiss.IndexHNSWFlat(dimension, 32, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "ivf":
+        nlist = max(1, int(np.sqrt(len(training_vectors))))
+        quantizer = faiss.IndexFlatIP(dimension)
+        base = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        base.train(training_vectors)
+        base.nprobe = min(nlist, 16)
+    else:
+        base = faiss.IndexFlatIP(dimension)
+    return faiss.IndexIDMap2(base)
+
+
+class UserEmailIndex:
+    """
+    A user's persistent vector index: a faiss index file plus a JSON ID map from
+    faiss row IDs to message IDs and the email fields needed for reply context.
+    """
+
+    def __init__(self, user_email, index=None, id_map=None):
+        self.user_email = user_email
+        self.index = index
+        self.id_map = id_map or {"next_id": 0, "index_type": "flat", "message_ids": {}, "emails": {}}
+        # The files as they were when loaded or last saved, to notice another process's saves
+        self.stamp = None
+
+    @classmethod
+    def load(cls, user_email):
+        index_path, map_path = _paths(user_email)
+        stamp = _stamp(user_email)
+        if stamp is None:
+            return cls(user_email)
+        import faiss
+        with open(map_path) as f:
+            id_map = json.load(f)
+        index = cls(user_email, faiss.read_index(index_path), id_map)
+        index.stamp = stamp
+        return index
+
+    def save(self):
+        import faiss
+        index_path, map_path = _paths(self.user_email)
+        os.makedirs(VECTOR_INDEX_DIR, exist_ok=True)
+        # Write to temporary files first so a crash never leaves a torn index behind
+        faiss.write_index(self.index, index_path + ".tmp")
+        with open(map_path + ".tmp", "w") as f:
+            json.dump(self.id_map, f)
+        os.replace(index_path + ".tmp", index_path)
+        os.replace(map_path + ".tmp", map_path)
+        self.stamp = _stamp(self.user_email)
+
+    def __len__(self):
+        return len(self.id_map["message_ids"])
+
+    def add(self, emails):
+        """Embeds and adds emails that are not indexed yet. Returns how many were added."""
+        import numpy as np
+        new_emails = [email for email in emails if email["id"] not in self.id_map["message_ids"]]
+        new_emails = list({email["id"]: email for email in new_emails}.values())
+        if not new_emails:
+            return 0
+        vectors = encode_texts(email_text(email) for email in new_emails)
+        if self.index is None:
+            self.index = new_index(vectors.shape[1])
+        start = self.id_map["next_id"]
+        row_ids = np.arange(start, start + len(new_emails), dtype=np.int64)
+        self.index.add_with_ids(vectors, row_ids)
+        for row_id, email in zip(row_ids.tolist(), new_emails):
+            self.id_map["message_ids"][email["id"]] = row_id
+            self.id_map["emails"][str(row_id)] = {
+                "id": email["id"],
+                "subject": email.get("subject", ""),
+                "sender": email.get("sender", ""),
+                "body": (email.get("body") or "")[:STORED_BODY_CHARS],
+                "time": email.get("time", "Unknown")
+            }
+        self.id_map["next_id"] = start + len(new_emails)
+        self._maybe_upgrade()
+        return len(new_emails)
+
+    def _maybe_upgrade(self):
+        """Rebuilds the flat index as HNSW/IVF once the mailbox is large enough."""
+        if VECTOR_INDEX_TYPE == "flat" or self.id_map["index_type"] == VECTOR_INDEX_TYPE:
+            return
+        if len(self) < VECTOR_INDEX_ANN_MIN:
+            return
+        import numpy as np
+        row_ids = np.array(sorted(self.id_map["message_ids"].values()), dtype=np.int64)
+        vectors = np.vstack([self.index.reconstruct(int(row_id)) for row_id in row_ids]).astype(np.float32)
+        index = new_index(vectors.shape[1], VECTOR_INDEX_TYPE, training_vectors=vectors)
+        index.add_with_ids(vectors, row_ids)
+        self.index = index
+        self.id_map["index_type"] = VECTOR_INDEX_TYPE
+
+    def search(self, query, top_k=5):
+        """Returns up to top_k stored emails most similar to the query, with their cosine score."""
+        if self.index is None or not len(self):
+            return []
+        query_vector = encode_texts([query])
+        scores, row_ids = self.index.search(query_vector, min(top_k, len(self)))
+        results = []
+        for score, row_id in zip(scores[0], row_ids[0]):
+            if row_id < 0:
+                continue
+            email = self.id_map["emails"].get(str(int(row_id)))
+            if email:
+                results.append(dict(email, score=round(float(score), 4)))
+        return results
+
+
+def get_user_index(user_email):
+    """
+    Returns the user's index, loading it from disk on a cache miss or when another
+    process has saved it since this copy was loaded. Call with the file lock held.
+    """
+    with _indexes_lock:
+        index = _indexes.get(user_email)
+    if index is None or index.stamp != _stamp(user_email):
+        index = UserEmailIndex.load(user_email)
+    with _indexes_lock:
+        _indexes[user_email] = index
+        _indexes.move_to_end(user_email)
+        while len(_indexes) > VECTOR_INDEX_CACHE_USERS:
+            _indexes.popitem(last=False)
+    return index
+
+
+def index_emails(user_email, emails):
+    """Adds new emails to the user's persistent index and saves it. Returns how many were added."""
+    with _user_lock(user_email), _file_lock(user_email):
+        index = get_user_index(user_email)
+        added = index.add(emails)
+        if added:
+            index.save()
+        return added
+
+
+def search_emails(user_email, query, top_k=5):
+    with _user_lock(user_email), _file_lock(user_email, exclusive=False):
+        return get_user_index(user_email).search(query, top_k)
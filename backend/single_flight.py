@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls by key: while a call for a key is running, later
+    callers with the same key wait for its result instead of starting their own.
+    A successful result is also kept for `ttl` seconds and handed to callers that
+    arrive in that time; failures are never kept.
+
+    The call can also report items as it goes (e.g. rows as they are processed):
+    `factory` is given an `emit` function, and each caller's `on_item` receives every
+    item the shared call emitted, the ones from before it joined first.
+
+    State is per process, and a key's call runs on the event loop of its first caller.
+    """
+
+    def __init__(self, ttl=0.0):
+        self.ttl = ttl
+        self._running = {}
+        self._results = {}
+        # key -> (items emitted so far, on_item callbacks of the callers waiting)
+        self._items = {}
+        self.stats = {"calls": 0, "runs": 0, "joined": 0, "memo_hits": 0}
+
+    async def run(self, key, factory, on_item=None):
+        """Returns the result of `factory(emit)` (a coroutine function) for `key`, shared as above."""
+        self.stats["calls"] += 1
+        memo = self._results.get(key)
+        if memo is not None and memo[1] > time.monotonic():
+            self.stats["memo_hits"] += 1
+            if on_item is not None:
+                for item in memo[2]:
+                    on_item(item)
+            return memo[0]
+        task = self._running.get(key)
+        if task is None:
+            self.stats["runs"] += 1
+            items, callbacks = [], []
+
+            def emit(item):
+                items.append(item)
+                for callback in list(callbacks):
+                    callback(item)
+
+            task = self._running[key] = asyncio.ensure_future(factory(emit))
+            self._items[task] = (items, callbacks)
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            self.stats["joined"] += 1
+        items, callbacks = self._items[task]
+        if on_item is not None:
+            for item in items:
+                on_item(item)
+            callbacks.append(on_item)
+        try:
+            # A caller that goes away (e.g. the client disconnected) leaves the shared call running
+            return await asyncio.shield(task)
+        finally:
+            if on_item is not None and on_item in callbacks:
+                callbacks.remove(on_item)
+
+    def _finished(self, key, task):
+        if self._running.get(key) is task:
+            del self._running[key]
+        items, _ = self._items.pop(task)
+        now = time.monotonic()
+        for expired in [k for k, (_, expires_at, _) in self._results.items() if expires_at <= now]:
+            del self._results[expired]
+        # Reading the exception also marks it retrieved when every caller has gone away
+        if not task.cancelled() and task.exception() is None and self.ttl:
+            self._results[key] = (task.result(), now + self.ttl, items)
+
+    def forget(self, predicate):
+        """Drops the kept results whose key matches `predicate`, e.g. after a user's credentials change."""
+        for key in [key for key in self._results if predicate(key)]:
+            del self._results[key]
@@ -0,0 +1,634 @@
+"""
+Local stub servers used to exercise the backend without touching Google's APIs.
+
+Run `python stubs.py` to compare Gmail round-trips for sequential vs batched fetches.
+The helpers at the bottom (stub_env, serve_app, free_port, percentile) are shared by
+the bench_*.py scripts.
+"""
+import base64
+import json
+import os
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from prompt_encoding import parse_table
+
+
+def make_fake_message(index, important=False, body=None, attachment_bytes=0):
+    """
+    Builds a Gmail message resource shaped like a format=full response. With
+    `attachment_bytes`, an inline PDF part of that size is added, as Gmail does for
+    small attachments.
+    """
+    message_id = f"msg{index:05d}"
+    text = body if body is not None else f"Hello, this is test email number {index}. Can we meet tomorrow?"
+    message = {
+        "id": message_id,
+        "threadId": f"thread{index:05d}",
+        "labelIds": ["INBOX", "IMPORTANT"] if important else ["INBOX"],
+        "snippet": text[:100],
+        "internalDate": str(1743500000000 + index * 60000),
+        "payload": {
+            "mimeType": "multipart/alternative",
+            "headers": [
+                {"name": "Subject", "value": f"Test email {index}"},
+                {"name": "From", "value": f"sender{index}@example.com"},
+            ],
+            "parts": [
+                {
+                    "mimeType": "text/plain",
+                    "body": {"data": base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")},
+                }
+            ],
+        },
+    }
+    if attachment_bytes:
+        data = random.Random(index).randbytes(attachment_bytes)
+        message["payload"]["parts"].append({
+            "mimeType": "application/pdf",
+            "filename": f"attachment{index}.pdf",
+            "body": {"size": attachment_bytes, "data": base64.urlsafe_b64encode(data).decode("ascii")},
+        })
+    return message
+
+
+def apply_fields_mask(resource, fields):
+    """Applies a (top-level plus one nested level) Google API `fields` mask, e.g. "id,payload/headers"."""
+    masked = {}
+    for field in fields.split(","):
+        name, _, nested = field.strip().partition("/")
+        if name not in resource:
+            continue
+        if nested and isinstance(resource[name], dict):
+            masked.setdefault(name, {})
+            if nested in resource[name]:
+                masked[name][nested] = resource[name][nested]
+        else:
+            masked[name] = resource[name]
+    return masked
+
+
+def personalized(message, token):
+    """A copy of `message` whose Subject header and snippet start with `token`."""
+    headers = [
+        dict(header, value=f"[{token}] {header['value']}") if header["name"].lower() == "subject" else header
+        for header in message["payload"]["headers"]
+    ]
+    return dict(message, snippet=f"[{token}] {message['snippet']}", payload=dict(message["payload"], headers=headers))
+
+
+class StubServer:
+    """
+    Runs a ThreadingHTTPServer on a random local port in a background thread.
+    Subclasses implement `handle(method, path, query, headers, body)` and return
+    (status, headers, body), where body is bytes or an iterable of byte chunks to
+    stream with chunked transfer encoding.
+
+    `latency` adds a fixed delay to every request and `error_rate` makes that
+    fraction of requests fail with `error_status`, for latency/error injection.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=500, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self.round_trips = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _dispatch(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                parsed = urlparse(self.path)
+                with stub._lock:
+                    stub.round_trips += 1
+                    inject_error = stub._random.random() < stub.error_rate
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if inject_error:
+                    status, headers, payload = stub.error_response(stub.error_status)
+                else:
+                    status, headers, payload = stub.handle(
+                        self.command, parsed.path, parse_qs(parsed.query), self.headers, body
+                    )
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if isinstance(payload, bytes):
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+                # Any other payload is an iterable of byte chunks, streamed as they are produced
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for chunk in payload:
+                    if chunk:
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                        self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+            do_GET = do_POST = do_PATCH = do_DELETE = _dispatch
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def error_response(self, status):
+        return json_response(status, {"error": {"code": status, "message": "Injected error"}})
+
+    def handle(self, method, path, query, headers, body):
+        raise NotImplementedError
+
+
+def json_response(status, payload):
+    return status, {"Content-Type": "application/json"}, json.dumps(payload).encode("utf-8")
+
+
+class FakeGmailServer(StubServer):
+    """
+    Serves getProfile, history().list, messages().list, messages().get and the
+    /batch/gmail/v1 endpoint from an in-memory mailbox. `rate_limited_ids` fail with a 429 the first time they are
+    requested inside a batch, to exercise per-item retries. With `personalize`, the
+    subject and snippet of every message are prefixed with the caller's access token,
+    so users sharing the stub mailbox do not share LLM cache entries.
+    """
+
+    MESSAGE_PATH = re.compile(r"^/gmail/v1/users/[^/]+/messages/([^/]+)$")
+
+    def __init__(self, messages, rate_limited_ids=(), personalize=False, **kwargs):
+        super().__init__(**kwargs)
+        self.messages = {m["id"]: m for m in messages}
+        self.personalize = personalize
+        self.rate_limited_ids = set(rate_limited_ids)
+        self.message_gets = 0
+        self.history_id = 1000
+        self.history = []
+
+    def add_message(self, message):
+        """Delivers a new message, recording it in the mailbox history."""
+        with self._lock:
+            self.messages[message["id"]] = message
+            self.history_id += 1
+            self.history.append({
+                "id": str(self.history_id),
+                "messagesAdded": [{"message": {k: message[k] for k in ("id", "threadId", "labelIds")}}],
+            })
+
+    def list_ids(self, q=""):
+        """Message ids newest first, as messages().list returns them, honouring after:<epoch> and newer_than:<n>d."""
+        after_ms = 0
+        match = re.search(r"after:(\d+)", q)
+        if match:
+            after_ms = int(match.group(1)) * 1000
+        match = re.search(r"newer_than:(\d+)d", q)
+        if match:
+            after_ms = max(after_ms, int((time.time() - int(match.group(1)) * 86400) * 1000))
+        with self._lock:
+            dated = [(int(m.get("internalDate", "0")), mid) for mid, m in self.messages.items()]
+        return [mid for date, mid in sorted(dated, key=lambda item: (-item[0], item[1])) if date > after_ms]
+
+    @property
+    def batch_uri(self):
+        return self.base_url + "batch/gmail/v1"
+
+    def build_service(self):
+        import httplib2
+        from googleapiclient.discovery import build
+        return build(
+            "gmail", "v1",
+            http=httplib2.Http(),
+            client_options={"api_endpoint": self.base_url},
+            static_discovery=True,
+        )
+
+    def handle(self, method, path, query, headers, body):
+        token = (headers.get("Authorization") or "").partition("Bearer ")[2] if self.personalize else ""
+        if path == "/batch/gmail/v1":
+            return self.handle_batch(headers, body, token)
+        return self.handle_single(method, path, query, in_batch=False, token=token)
+
+    def handle_single(self, method, path, query, in_batch, token=""):
+        if path.endswith("/profile"):
+            return json_response(200, {"emailAddress": "me@example.com", "historyId": str(self.history_id)})
+        if path.endswith("/history"):
+            start = int(query["startHistoryId"][0])
+            if self.history and start < int(self.history[0]["id"]) - 1:
+                return json_response(404, {"error": {"code": 404, "message": "Requested entity was not found."}})
+            records = [record for record in self.history if int(record["id"]) > start]
+            return json_response(200, {"history": records, "historyId": str(self.history_id)})
+        if path.endswith("/messages") and method == "GET":
+            ids = self.list_ids(query.get("q", [""])[0])
+            start = int(query.get("pageToken", ["0"])[0])
+            page_size = int(query.get("maxResults", ["100"])[0])
+            page = ids[start:start + page_size]
+            payload = {"messages": [{"id": mid, "threadId": self.messages[mid]["threadId"]} for mid in page]}
+            if start + page_size < len(ids):
+                payload["nextPageToken"] = str(start + page_size)
+            return json_response(200, payload)
+        match = self.MESSAGE_PATH.match(path)
+        if match:
+            message_id = match.group(1)
+            with self._lock:
+                self.message_gets += 1
+                throttled = in_batch and message_id in self.rate_limited_ids
+                self.rate_limited_ids.discard(message_id)
+            if throttled:
+                return json_response(429, {"error": {
+                    "code": 429, "message": "Too many concurrent requests for user",
+                    "errors": [{"reason": "rateLimitExceeded"}],
+                }})
+            if message_id not in self.messages:
+                return json_response(404, {"error": {"code": 404, "message": "Requested entity was not found."}})
+            message = self.messages[message_id]
+            if token:
+                message = personalized(message, token)
+            if query.get("format", ["full"])[0] == "metadata":
+                wanted = {name.lower() for name in query.get("metadataHeaders", [])}
+                headers = [h for h in message["payload"]["headers"] if not wanted or h["name"].lower() in wanted]
+                message = dict(message, payload={"mimeType": message["payload"]["mimeType"], "headers": headers})
+            if "fields" in query:
+                message = apply_fields_mask(message, query["fields"][0])
+            return json_response(200, message)
+        return json_response(404, {"error": {"code": 404, "message": f"Unknown path {path}"}})
+
+    def handle_batch(self, headers, body, token=""):
+        envelope = b"Content-Type: " + headers["Content-Type"].encode("ascii") + b"\r\n\r\n" + body
+        request = BytesParser().parsebytes(envelope)
+        boundary = "batch_" + uuid.uuid4().hex
+        chunks = []
+        for part in request.get_payload():
+            inner = part.get_payload(decode=False)
+            request_line = inner.split("\n", 1)[0].strip()
+            method, uri = request_line.split(" ")[:2]
+            parsed = urlparse(uri)
+            status, _, payload = self.handle_single(method, parsed.path, parse_qs(parsed.query), in_batch=True, token=token)
+            content_id = part["Content-ID"].strip()
+            chunks.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id[1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{payload.decode('utf-8')}\r\n"
+            )
+        chunks.append(f"--{boundary}--\r\n")
+        return 200, {"Content-Type": f"multipart/mixed; boundary={boundary}"}, "".join(chunks).encode("utf-8")
+
+
+def fake_llm_reply(messages):
+    """
+    Deterministic stand-in for the chat model, keyed off the prompts the backend sends:
+    the classifier gets back every email whose snippet (or thread) asks a question, the summarizer
+    gets a JSON summary (or an array of them for batched requests), and anything else
+    gets a short Markdown digest.
+    """
+    system = " ".join(m["content"] for m in messages if m["role"] == "system")
+    user = " ".join(m["content"] for m in messages if m["role"] == "user")
+    if "email filter" in system:
+        emails = parse_table(user[user.index("["):])
+        return json.dumps([e["n"] for e in emails if "?" in (e.get("snippet") or "") + (e.get("thread") or "")])
+    if "[n, summary, suggested_reply]" in system:
+        return json.dumps([
+            [e["n"], f"Summary of {e['subject']}.", "Sounds good, see you then."] for e in parse_table(user)
+        ])
+    if "You name groups" in system:
+        return json.dumps({number: f"📁 Topic {number}" for number in json.loads(user)})
+    if "email-organizing" in system:
+        return "## 📬 Updates\n\n1. **Subject:** Test email  \n   **Summary:** Stub digest"
+    subject = re.search(r"Subject: (.*)", user)
+    return json.dumps({
+        "summary": f"Summary of {subject.group(1) if subject else 'email'}.",
+        "suggested_reply": "Sounds good, see you then.",
+    })
+
+
+def completion_payload(request, content):
+    """A chat.completion response body for `request`, with token usage estimated from its size."""
+    prompt_tokens = sum(len(m["content"]) for m in request["messages"]) // 4
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "gpt-3.5-turbo"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": prompt_tokens + len(content) // 4,
+        },
+    }
+
+
+def completion_chunks(request, content, token_latency=0.0):
+    """Yields chat.completion.chunk bodies streaming `content` one word at a time."""
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+    def chunk(delta, finish_reason=None):
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-3.5-turbo"),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    yield chunk({"role": "assistant"})
+    for token in re.findall(r"\S+\s*|\s+", content):
+        if token_latency:
+            time.sleep(token_latency)
+        yield chunk({"content": token})
+    yield chunk({}, finish_reason="stop")
+
+
+class FakeOpenAIServer(StubServer):
+    """
+    Serves /v1/chat/completions in the legacy OpenAI response shape. Point the client
+    at it with `openai.api_base = server.api_base`. `reply` maps the request messages
+    to the assistant's content (defaults to fake_llm_reply).
+
+    Requests with "stream": true get the reply back as server-sent delta chunks, one
+    word at a time, with `token_latency` seconds between them.
+    """
+
+    def __init__(self, reply=fake_llm_reply, token_latency=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.reply = reply
+        self.token_latency = token_latency
+        self.completions = 0
+
+    @property
+    def api_base(self):
+        return self.base_url + "v1"
+
+    def handle(self, method, path, query, headers, body):
+        if path != "/v1/chat/completions":
+            return json_response(404, {"error": {"message": f"Unknown path {path}"}})
+        request = json.loads(body)
+        content = self.reply(request["messages"])
+        with self._lock:
+            self.completions += 1
+        if request.get("stream"):
+            return 200, {"Content-Type": "text/event-stream"}, self.stream_events(request, content)
+        return json_response(200, completion_payload(request, content))
+
+    def stream_events(self, request, content):
+        for chunk in completion_chunks(request, content, self.token_latency):
+            yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+        yield b"data: [DONE]\n\n"
+
+
+class FakeSupabaseServer(StubServer):
+    """
+    An in-memory PostgREST stand-in for the tables the backend uses. Supports select,
+    insert, upsert (on_conflict), update and delete with eq/neq/gt/gte/lt/lte/in/is
+    filters, plus order, limit and plain column lists in select, which covers every
+    query in supabase_client.py. Point the client at it
+    with SUPABASE_URL=server.url (the service key only has to be JWT-shaped).
+
+    Inserting a row whose primary key already exists fails the way Postgres does, so
+    duplicate-user handling can be exercised too.
+    """
+
+    PRIMARY_KEYS = {
+        "users": ("email",),
+        "processed_emails": ("user_email", "message_id"),
+        "digests": ("user_email",),
+    }
+    OPERATORS = {
+        "eq": lambda a, b: a == b,
+        "neq": lambda a, b: a != b,
+        "gt": lambda a, b: a is not None and a > b,
+        "gte": lambda a, b: a is not None and a >= b,
+        "lt": lambda a, b: a is not None and a < b,
+        "lte": lambda a, b: a is not None and a <= b,
+    }
+
+    def __init__(self, tables=None, **kwargs):
+        super().__init__(**kwargs)
+        self.tables = {name: list(rows) for name, rows in (tables or {}).items()}
+        self.requests = 0
+
+    @property
+    def url(self):
+        return self.base_url.rstrip("/")
+
+    @staticmethod
+    def _text(value):
+        if value is None:
+            return None
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        return value if isinstance(value, str) else json.dumps(value)
+
+    def _matches(self, row, filters):
+        for column, condition in filters:
+            operator, _, expected = condition.partition(".")
+            actual = self._text(row.get(column))
+            if operator == "in":
+                values = [v.strip().strip('"') for v in expected.strip("()").split(",") if v.strip()]
+                if actual not in values:
+                    return False
+            elif operator == "is":
+                if (actual is None) != (expected == "null"):
+                    return False
+            elif not self.OPERATORS[operator](actual, expected):
+                return False
+        return True
+
+    def _select(self, rows, filters, query):
+        selected = [row for row in rows if self._matches(row, filters)]
+        # Sort by the last order column first, so earlier columns take precedence
+        for term in reversed(query.get("order", [""])[0].split(",")):
+            if term:
+                column, _, direction = term.partition(".")
+                selected.sort(key=lambda row: (row.get(column) is not None, row.get(column) or ""),
+                              reverse=direction.startswith("desc"))
+        if "limit" in query:
+            selected = selected[:int(query["limit"][0])]
+        columns = query.get("select", ["*"])[0]
+        if columns != "*":
+            selected = [{column: row.get(column) for column in columns.split(",")} for row in selected]
+        return selected
+
+    def _key(self, table, row, columns=None):
+        return tuple(row.get(column) for column in (columns or self.PRIMARY_KEYS.get(table, ("id",))))
+
+    def handle(self, method, path, query, headers, body):
+        if not path.startswith("/rest/v1/"):
+            return json_response(404, {"message": f"Unknown path {path}"})
+        table = path[len("/rest/v1/"):]
+        filters = [
+            (column, value) for column, values in query.items() for value in values
+            if column not in ("select", "on_conflict", "order", "limit", "columns")
+        ]
+        with self._lock:
+            self.requests += 1
+            rows = self.tables.setdefault(table, [])
+            if method == "GET":
+                return json_response(200, self._select(rows, filters, query))
+            if method == "DELETE":
+                removed = [row for row in rows if self._matches(row, filters)]
+                self.tables[table] = [row for row in rows if not self._matches(row, filters)]
+                return json_response(200, removed)
+            payload = json.loads(body or b"null")
+            if method == "PATCH":
+                updated = [row for row in rows if self._matches(row, filters)]
+                for row in updated:
+                    row.update(payload)
+                return json_response(200, updated)
+            # POST: insert, or upsert when merge-duplicates is requested
+            new_rows = payload if isinstance(payload, list) else [payload]
+            upsert = "merge-duplicates" in headers.get("Prefer", "")
+            conflict_columns = query["on_conflict"][0].split(",") if "on_conflict" in query else None
+            by_key = {self._key(table, row, conflict_columns): row for row in rows}
+            for new_row in new_rows:
+                existing = by_key.get(self._key(table, new_row, conflict_columns))
+                if existing is not None and not upsert:
+                    return json_response(409, {
+                        "code": "23505",
+                        "message": f'duplicate key value violates unique constraint "{table}_pkey"',
+                    })
+                if existing is not None:
+                    existing.update(new_row)
+                else:
+                    row = dict(new_row)
+                    rows.append(row)
+                    by_key[self._key(table, row, conflict_columns)] = row
+            return json_response(201, new_rows)
+
+
+# A JWT-shaped service-role key; the Supabase stub does not check the signature
+STUB_SERVICE_ROLE_KEY = "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.c3R1Yg"
+
+
+def stub_env(gmail=None, llm=None, supabase=None, **overrides):
+    """
+    Environment variables pointing the backend at the given stub servers, with warm-up
+    and the digest scheduler turned off. Backend modules read their configuration at
+    import time, so apply these (os.environ.update or a child's env) before importing
+    them. Keyword arguments are added as extra variables.
+    """
+    env = {
+        "WARMUP_COMPONENTS": "",
+        "DIGEST_SCHEDULER_ENABLED": "0",
+        "OPENAI_API_KEY": "sk-stub",
+        "SUPABASE_SERVICE_ROLE_KEY": os.environ.get("SUPABASE_SERVICE_ROLE_KEY", STUB_SERVICE_ROLE_KEY),
+    }
+    if gmail is not None:
+        env.update({"GMAIL_API_ENDPOINT": gmail.base_url, "GMAIL_BATCH_URI": gmail.batch_uri})
+    if llm is not None:
+        env["OPENAI_API_BASE"] = llm.api_base
+    if supabase is not None:
+        env["SUPABASE_URL"] = supabase.url
+    env.update({name: str(value) for name, value in overrides.items()})
+    return env
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve_app(app):
+    """Serves `app` with uvicorn on a free local port in a daemon thread; returns (server, port) once it is up."""
+    import uvicorn
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, port
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+if __name__ == "__main__":
+    import math
+    import sys
+    from gmail_batch import fetch_messages_batched
+
+    n = 100
+    rate_limited = ["msg00003", "msg00042"]
+    inbox = [make_fake_message(i) for i in range(n)]
+    failures = []
+    with FakeGmailServer(inbox, rate_limited_ids=rate_limited) as gmail:
+        service = gmail.build_service()
+        gmail.round_trips = 0
+        for message in inbox:
+            service.users().messages().get(userId="me", id=message["id"], format="full").execute()
+        print(f"sequential: {n} messages, {gmail.round_trips} round-trips")
+        for batch_size in (10, 25, 50):
+            gmail.round_trips = 0
+            gmail.rate_limited_ids = set(rate_limited)
+            result = fetch_messages_batched(
+                service, [m["id"] for m in inbox], batch_size=batch_size, batch_uri=gmail.batch_uri
+            )
+            print(
+                f"batch_size={batch_size}: {len(result['messages'])} messages, "
+                f"{len(result['errors'])} errors, {gmail.round_trips} round-trips"
+            )
+            # One round-trip per full batch, plus the batches that retry the throttled messages
+            limit = math.ceil(n / batch_size) + math.ceil(len(rate_limited) / batch_size)
+            if gmail.round_trips > limit:
+                failures.append(f"batch_size={batch_size}: {gmail.round_trips} round-trips, expected at most {limit}")
+            if len(result["messages"]) != n or result["errors"]:
+                failures.append(f"batch_size={batch_size}: {len(result['messages'])} of {n} messages fetched")
+        # Without retries, throttled messages are reported for a later retry; missing ones are not
+        gmail.rate_limited_ids = set(rate_limited)
+        result = fetch_messages_batched(service, [m["id"] for m in inbox] + ["missing"], max_retries=0,
+                                        batch_uri=gmail.batch_uri)
+        print(f"max_retries=0: {len(result['errors'])} errors, retry_later={result['retry_later']}")
+        if result["retry_later"] != sorted(rate_limited) or "missing" not in result["errors"]:
+            failures.append(f"max_retries=0: retry_later={result['retry_later']}, expected {sorted(rate_limited)}")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
@@ -1,11 +1,66 @@
 import os
-import openai
 from dotenv import load_dotenv
 import json
 import re
+from llm_cache import make_key, get_cached, set_cached
+from llm_gateway import chat_completion
+from tokens import count_tokens
+from mime_body import preview
+from metrics import span
+from prompt_encoding import compact_json, table
+from usage_ledger import TokenBudgetExceeded
 
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+
+SUMMARY_MODEL = "gpt-3.5-turbo"
+# Bump when the prompt below changes so cached summaries are not reused
+SUMMARY_PROMPT_VERSION = "summary-v4"
+
+# Batched summarization: emails are packed into one request until the estimated
+# prompt size reaches the token budget or the batch reaches the size limit.
+SUMMARY_BATCH_TOKEN_BUDGET = int(os.getenv("SUMMARY_BATCH_TOKEN_BUDGET", "3000"))
+SUMMARY_BATCH_MAX_EMAILS = int(os.getenv("SUMMARY_BATCH_MAX_EMAILS", "8"))
+# Rough allowance for each email's summary and reply in the completion
+SUMMARY_OUTPUT_TOKENS_PER_EMAIL = 160
+
+# Sent as the system message, identical for every call, so only the email itself varies
+SUMMARY_PROMPT = (
+    "Summarize the email in less than 120 words. "
+    "Return only a valid JSON object with exactly two keys: 'summary' and 'suggested_reply'."
+)
+BATCH_SUMMARY_PROMPT = (
+    "You are given emails as a JSON array of rows: the first row names the columns 'n', 'subject', 'sender', 'body' "
+    "and 'thread' (earlier messages of the email's thread, or null), and every following row is one email. "
+    "For every email, generate a concise summary in less than 120 words, using the thread only as context, "
+    "and a suggested reply only if the email "
+    "clearly demands a reply (for example, if it asks a question or requests a response); otherwise use an empty string. "
+    "Return only a valid JSON array with one row per email: [n, summary, suggested_reply]. Do not add any commentary."
+)
+SUMMARY_FIELDS = ("n", "subject", "sender", "body", "thread")
+
+def summary_cache_key(subject, sender, body, thread=None):
+    content = {"subject": subject, "sender": sender, "body": body, "thread": thread}
+    return make_key("summary", SUMMARY_PROMPT_VERSION, SUMMARY_MODEL, content)
+
+def estimate_tokens(text):
+    return count_tokens(text, SUMMARY_MODEL)
+
+def split_suggested_reply(result):
+    """
+    If the model embedded the suggested reply in the summary (after "Suggested reply:"),
+    move it into the 'suggested_reply' field and clean up the summary.
+    """
+    # Look for "Suggested reply:" (case-insensitive)
+    summary_text = result.get("summary", "")
+    if not result.get("suggested_reply"):
+        match = re.search(r"Suggested reply:\s*(.+)", summary_text, re.IGNORECASE | re.DOTALL)
+        if match:
+            reply = match.group(1).strip()
+            # Remove the suggested reply part from summary
+            summary_clean = re.sub(r"Suggested reply:\s*.+", "", summary_text, flags=re.IGNORECASE | re.DOTALL).strip()
+            result["summary"] = summary_clean
+            result["suggested_reply"] = reply
+    return result
 
 def openai_summary_and_reply(email_content):
     """
@@ -17,28 +72,34 @@ def openai_summary_and_reply(email_content):
     The function returns the LLM's response as a JSON string with exactly two keys: 'summary' and 'suggested_reply'.
     If the model embeds the suggested reply within the summary (after "Suggested reply:"), this function extracts that part 
     using regex and assigns it to the 'suggested_reply' field, cleaning up the summary.
+
+    Parsed results are cached by (prompt version, model, email content), so an email
+    seen again later in the day is not sent to the LLM a second time.
     """
     subject = email_content.get("subject", "")
     sender = email_content.get("sender", "")
     body = email_content.get("payload", {}).get("body", {}).get("data", "")
+    # Earlier messages of the email's thread, when the pipeline collapsed it (see dedup.py)
+    thread = email_content.get("thread")
     
-    # Truncate the body if it exceeds 500 characters
-    if body and len(body) > 500:
-        body = body[:500] + "..."
+    body = preview(body)
+
+    cache_key = summary_cache_key(subject, sender, body, thread)
+    cached = get_cached("summary", cache_key)
+    if cached is not None:
+        return cached
     
-    prompt = (
-        f"Subject: {subject}\n"
-        f"Sender: {sender}\n"
-        f"Body: {body}\n\n"
-        "Generate a concise summary of the email in less than 120 words. "
-        "Return your result as a valid JSON object with exactly two keys: 'summary' and 'suggested_reply'."
-    )
+    prompt = f"Subject: {subject}\nSender: {sender}\nBody: {body}"
+    if thread:
+        # Only emails collapsed with their thread pay for this instruction
+        prompt += f"\nEarlier in the thread (use only as context):\n{thread}"
     
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.5
-    )
+    with span("llm.summarize"):
+        response = chat_completion(
+            model=SUMMARY_MODEL,
+            messages=[{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": prompt}],
+            temperature=0.5
+        )
     
     raw_output = response.choices[0].message['content']
     
@@ -48,16 +109,116 @@ def openai_summary_and_reply(email_content):
         # If output isn't valid JSON, return it as is
         return raw_output
     
-    # Use regex to extract suggested reply if it's embedded in summary.
-    # Look for "Suggested reply:" (case-insensitive)
-    summary_text = result.get("summary", "")
-    if not result.get("suggested_reply"):
-        match = re.search(r"Suggested reply:\s*(.+)", summary_text, re.IGNORECASE | re.DOTALL)
-        if match:
-            reply = match.group(1).strip()
-            # Remove the suggested reply part from summary
-            summary_clean = re.sub(r"Suggested reply:\s*.+", "", summary_text, flags=re.IGNORECASE | re.DOTALL).strip()
-            result["summary"] = summary_clean
-            result["suggested_reply"] = reply
+    output = json.dumps(split_suggested_reply(result))
+    set_cached("summary", cache_key, output)
+    return output
+
+def plan_summary_batches(emails, token_budget=None, max_emails=None):
+    """
+    Splits emails (dicts with 'id', 'subject', 'sender', 'body') into batches whose
+    estimated prompt plus completion size stays within `token_budget`. An email that
+    is larger than the budget on its own still gets a batch of one.
+    """
+    token_budget = token_budget or SUMMARY_BATCH_TOKEN_BUDGET
+    max_emails = max_emails or SUMMARY_BATCH_MAX_EMAILS
+    budget = token_budget - estimate_tokens(BATCH_SUMMARY_PROMPT + table([], SUMMARY_FIELDS))
+    batches = []
+    current = []
+    current_tokens = 0
+    for email in emails:
+        cost = estimate_tokens(compact_json([0] + [email.get(field) for field in SUMMARY_FIELDS[1:]]))
+        cost += SUMMARY_OUTPUT_TOKENS_PER_EMAIL
+        if current and (current_tokens + cost > budget or len(current) >= max_emails):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(email)
+        current_tokens += cost
+    if current:
+        batches.append(current)
+    return batches
 
-    return json.dumps(result)
\ No newline at end of file
+def summarize_batch(emails):
+    """
+    Summarizes a planned batch with a single chat completion and returns
+    {id: JSON string}, in the same format as openai_summary_and_reply.
+
+    Emails whose entry is missing or malformed in the model's answer (or the whole
+    batch, if the answer is not a JSON array) fall back to one call each.
+    """
+    results = {}
+    parsed = {}
+    try:
+        with span("llm.summarize_batch"):
+            response = chat_completion(
+                model=SUMMARY_MODEL,
+                messages=[
+                    {"role": "system", "content": BATCH_SUMMARY_PROMPT},
+                    {"role": "user", "content": table([dict(email, n=n + 1) for n, email in enumerate(emails)],
+                                                      SUMMARY_FIELDS)}
+                ],
+                temperature=0.5
+            )
+        content = response.choices[0].message['content'].strip()
+        # Remove markdown code fences if present
+        if content.startswith("```"):
+            content = content.strip("`").strip("json").strip()
+        rows = json.loads(content)
+        if isinstance(rows, list):
+            parsed = {
+                str(row[0]): {"summary": row[1], "suggested_reply": row[2] if len(row) > 2 else ""} for row in rows
+                if isinstance(row, list) and len(row) >= 2 and isinstance(row[1], str)
+            }
+    except TokenBudgetExceeded:
+        raise
+    except Exception as e:
+        print(f"Batch summary of {len(emails)} emails failed, falling back to single calls: {e}")
+
+    for n, email in enumerate(emails):
+        item = parsed.get(str(n + 1))
+        if item is None:
+            results[email["id"]] = openai_summary_and_reply({
+                "subject": email["subject"],
+                "sender": email["sender"],
+                "payload": {"body": {"data": email["body"]}},
+                "thread": email.get("thread")
+            })
+            continue
+        result = split_suggested_reply({
+            "summary": item["summary"],
+            "suggested_reply": item.get("suggested_reply") or ""
+        })
+        output = json.dumps(result)
+        set_cached("summary", summary_cache_key(email["subject"], email["sender"], email["body"], email.get("thread")),
+                   output)
+        results[email["id"]] = output
+    return results
+
+def prepare_batch_inputs(emails):
+    """
+    Truncates bodies like openai_summary_and_reply does and resolves cached summaries.
+    Returns ({id: cached JSON string}, [emails still to summarize]).
+    """
+    cached_results = {}
+    pending = []
+    for email in emails:
+        body = preview(email.get("body") or "")
+        item = {"id": email["id"], "subject": email.get("subject", ""), "sender": email.get("sender", ""), "body": body,
+                "thread": email.get("thread")}
+        cached = get_cached("summary", summary_cache_key(item["subject"], item["sender"], item["body"], item["thread"]))
+        if cached is not None:
+            cached_results[item["id"]] = cached
+        else:
+            pending.append(item)
+    return cached_results, pending
+
+def summarize_emails_batch(emails, token_budget=None, max_emails=None):
+    """
+    Batched counterpart of openai_summary_and_reply. Takes dicts with 'id', 'subject',
+    'sender', 'body' and optionally 'thread', packs them into as few chat completions as the token budget
+    allows, and returns {id: JSON string with 'summary' and 'suggested_reply'}.
+    """
+    results, pending = prepare_batch_inputs(emails)
+    for batch in plan_summary_batches(pending, token_budget, max_emails):
+        results.update(summarize_batch(batch))
+    return results
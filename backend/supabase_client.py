@@ -1,6 +1,8 @@
+import json
 import os
-from supabase import create_client
 from dotenv import load_dotenv
+from components import register, get_component
+from metrics import traced
 
 # Load environment variables from the .env file
 load_dotenv()
@@ -9,9 +11,17 @@ load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
-# Create Supabase Client
-supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+def create_supabase_client():
+    from supabase import create_client
+    return create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 
+# The Supabase client is created on first use; see components.py
+register("supabase", create_supabase_client)
+
+def get_supabase():
+    return get_component("supabase")
+
+@traced("supabase.save_user", upstream="supabase")
 def save_user(email, access_token, refresh_token, summary_time="08:00"):
     """Save user credentials in Supabase."""
     data = {
@@ -20,13 +30,177 @@ def save_user(email, access_token, refresh_token, summary_time="08:00"):
         "refresh_token": refresh_token,
         "summary_time": summary_time
     }
-    response = supabase.table("users").insert(data).execute()
+    response = get_supabase().table("users").insert(data).execute()
     return response
 
+@traced("supabase.get_user_credentials", upstream="supabase")
 def get_user_credentials(email: str):
     """Fetch user credentials from Supabase by email."""
-    response = supabase.table("users").select("*").eq("email", email).execute()
+    response = get_supabase().table("users").select("*").eq("email", email).execute()
     # Assuming response.data contains the results.
     if response.data:
         return response.data[0]
-    return None
\ No newline at end of file
+    return None
+
+@traced("supabase.update_user_tokens", upstream="supabase")
+def update_user_tokens(email: str, access_token: str, refresh_token: str = None):
+    """Store a refreshed access token (and the refresh token, if Google rotated it)."""
+    data = {"access_token": access_token}
+    if refresh_token:
+        data["refresh_token"] = refresh_token
+    response = get_supabase().table("users").update(data).eq("email", email).execute()
+    return response
+
+@traced("supabase.update_summary_time", upstream="supabase")
+def update_summary_time(email: str, summary_time: str):
+    response = get_supabase().table("users").update({"summary_time": summary_time}).eq("email", email).execute()
+    return response
+
+@traced("supabase.get_digest_schedule", upstream="supabase")
+def get_digest_schedule():
+    """Fetch every user's email and daily summary_time, for the digest scheduler."""
+    response = get_supabase().table("users").select("email,summary_time").execute()
+    return response.data or []
+
+@traced("supabase.save_digest", upstream="supabase")
+def save_digest(email: str, digest: str, important_count: int, computed_at: str, slot: str = None):
+    """
+    Store a user's precomputed grouped summary. Rows live in the `digests` table:
+      user_email text primary key, digest text, important_count integer,
+      computed_at text ("%Y-%m-%d %H:%M:%S"), slot text (the summary_time it was built for)
+    """
+    data = {
+        "user_email": email,
+        "digest": digest,
+        "important_count": important_count,
+        "computed_at": computed_at,
+        "slot": slot
+    }
+    response = get_supabase().table("digests").upsert(data, on_conflict="user_email").execute()
+    return response
+
+@traced("supabase.get_digest", upstream="supabase")
+def get_digest(email: str):
+    response = get_supabase().table("digests").select("*").eq("user_email", email).execute()
+    if response.data:
+        return response.data[0]
+    return None
+
+@traced("supabase.delete_digest", upstream="supabase")
+def delete_digest(email: str):
+    """Drop a user's stored digest, e.g. once it no longer lists all of their important mail."""
+    response = get_supabase().table("digests").delete().eq("user_email", email).execute()
+    return response
+
+@traced("supabase.save_history_id", upstream="supabase")
+def save_history_id(email: str, history_id, synced_from: str = None):
+    """
+    Store the Gmail historyId the user's mailbox was last synced at and, if given,
+    the receive time ("%Y-%m-%d %H:%M:%S") from which on every message has been processed.
+    Requires nullable text columns `history_id` and `synced_from` on the users table.
+    """
+    fields = {"history_id": str(history_id)}
+    if synced_from is not None:
+        fields["synced_from"] = synced_from
+    response = get_supabase().table("users").update(fields).eq("email", email).execute()
+    return response
+
+@traced("supabase.update_pending_message_ids", upstream="supabase")
+def update_pending_message_ids(email: str, resolved=(), failed=()):
+    """
+    Keep the IDs of messages whose fetch failed for transient reasons, so the next
+    sync retries them, in the nullable text column `pending_message_ids` on the users
+    table (a JSON list). `resolved` IDs are removed and `failed` ones added; the row
+    is only written when the list changes. Returns the new list.
+    """
+    response = get_supabase().table("users").select("pending_message_ids").eq("email", email).execute()
+    stored = response.data[0].get("pending_message_ids") if response.data else None
+    pending = set(json.loads(stored)) if stored else set()
+    updated = (pending - set(resolved)) | set(failed)
+    if updated != pending:
+        get_supabase().table("users").update({"pending_message_ids": json.dumps(sorted(updated))}).eq("email", email).execute()
+    return sorted(updated)
+
+@traced("supabase.get_processed_emails", upstream="supabase")
+def get_processed_emails(email: str, since: str = None):
+    """
+    Fetch the messages already processed for a user, keyed by message ID.
+
+    Rows live in the `processed_emails` table:
+      user_email text, message_id text, received_at text ("%Y-%m-%d %H:%M:%S"),
+      important boolean, email jsonb (the important_emails entry, or null),
+      primary key (user_email, message_id)
+    """
+    query = get_supabase().table("processed_emails").select("*").eq("user_email", email)
+    if since:
+        query = query.gte("received_at", since)
+    response = query.execute()
+    return {row["message_id"]: row for row in (response.data or [])}
+
+@traced("supabase.get_processed_message_ids", upstream="supabase")
+def get_processed_message_ids(email: str, message_ids):
+    """Of `message_ids`, the ones already processed for a user, as {message_id: received_at}."""
+    if not message_ids:
+        return {}
+    response = (
+        get_supabase().table("processed_emails")
+        .select("message_id,received_at")
+        .eq("user_email", email)
+        .in_("message_id", list(message_ids))
+        .execute()
+    )
+    return {row["message_id"]: row["received_at"] for row in (response.data or [])}
+
+@traced("supabase.get_important_emails_page", upstream="supabase")
+def get_important_emails_page(email: str, since: str, before=None, limit: int = 20, include_since: bool = True):
+    """
+    Up to `limit` important processed rows for a user, newest first (ties broken by
+    message_id, descending), received at or after `since` (strictly after unless
+    `include_since`) and strictly before `before`, a (received_at, message_id) pair
+    from the last row of the previous page.
+    """
+    def important():
+        query = (
+            get_supabase().table("processed_emails").select("*")
+            .eq("user_email", email).eq("important", "true")
+        )
+        return query.gte("received_at", since) if include_since else query.gt("received_at", since)
+
+    rows = []
+    if before:
+        received_at, message_id = before
+        same_second = (
+            important().eq("received_at", received_at).lt("message_id", message_id)
+            .order("message_id", desc=True).limit(limit).execute()
+        )
+        rows = same_second.data or []
+        older = important().lt("received_at", received_at)
+    else:
+        older = important()
+    response = older.order("received_at", desc=True).order("message_id", desc=True).limit(limit).execute()
+    rows += response.data or []
+    rows.sort(key=lambda row: (row["received_at"], row["message_id"]), reverse=True)
+    return rows[:limit]
+
+@traced("supabase.save_processed_emails", upstream="supabase")
+def save_processed_emails(email: str, rows):
+    """Upsert processed message rows (see get_processed_emails) for a user."""
+    if not rows:
+        return None
+    data = [dict(row, user_email=email) for row in rows]
+    response = get_supabase().table("processed_emails").upsert(data, on_conflict="user_email,message_id").execute()
+    return response
+
+@traced("supabase.delete_processed_emails", upstream="supabase")
+def delete_processed_emails(email: str, message_ids):
+    """Drop processed rows for messages that were deleted from the mailbox."""
+    if not message_ids:
+        return None
+    response = (
+        get_supabase().table("processed_emails")
+        .delete()
+        .eq("user_email", email)
+        .in_("message_id", list(message_ids))
+        .execute()
+    )
+    return response
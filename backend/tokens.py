@@ -0,0 +1,28 @@
+import threading
+
+# tiktoken is optional: with it token counts are exact for OpenAI models, without it
+# they fall back to ~4 characters per token, which is close enough for batching.
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def _encoding(model):
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                import tiktoken
+                try:
+                    _encodings[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    _encodings[model] = tiktoken.get_encoding("cl100k_base")
+            except ImportError:
+                _encodings[model] = None
+        return _encodings[model]
+
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    """Number of tokens `text` takes for `model`, estimated when tiktoken is not installed."""
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
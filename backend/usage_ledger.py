@@ -0,0 +1,164 @@
+import contextvars
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from metrics import propagate_var
+
+# SQLite file holding the per-day token totals, shared by every worker on the host
+LLM_USAGE_PATH = os.getenv("LLM_USAGE_PATH", "llm_usage.sqlite3")
+# Prompt plus completion tokens a user may spend per day; 0 disables the budget
+LLM_USER_DAILY_TOKENS = int(os.getenv("LLM_USER_DAILY_TOKENS", "0"))
+
+# (user_email, endpoint) that LLM calls made in this context are charged to
+_scope = contextvars.ContextVar("llm_usage_scope", default=None)
+propagate_var(_scope)
+
+
+class TokenBudgetExceeded(Exception):
+    def __init__(self, user_email, spent, budget):
+        super().__init__(f"Daily LLM token budget of {budget} exhausted for {user_email} ({spent} used)")
+        self.user_email = user_email
+        self.spent = spent
+        self.budget = budget
+
+
+def set_usage_scope(user_email, endpoint):
+    """Charges LLM calls made from now on in this context (e.g. one request) to `user_email` and `endpoint`."""
+    _scope.set((user_email, endpoint))
+
+
+@contextmanager
+def usage_scope(user_email, endpoint):
+    """set_usage_scope for a block."""
+    token = _scope.set((user_email, endpoint))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def current_usage_scope():
+    return _scope.get()
+
+
+def today():
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+class UsageLedger:
+    """
+    Per-day prompt and completion token totals by user, endpoint and model, in one
+    SQLite table. Budgets are checked against the table, so every process writing
+    to the same file shares them.
+    """
+
+    def __init__(self, path=LLM_USAGE_PATH, daily_budget=LLM_USER_DAILY_TOKENS):
+        self.daily_budget = daily_budget
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_usage ("
+            " day TEXT NOT NULL, user_email TEXT NOT NULL, endpoint TEXT NOT NULL, model TEXT NOT NULL,"
+            " calls INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL,"
+            " PRIMARY KEY (day, user_email, endpoint, model))"
+        )
+        self._conn.commit()
+
+    def spent(self, user_email, day=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM llm_usage WHERE day = ? AND user_email = ?",
+                (day or today(), user_email)
+            ).fetchone()
+        return row[0]
+
+    def check(self, user_email, tokens):
+        """Raises TokenBudgetExceeded if spending `tokens` more today would take the user over budget."""
+        if not self.daily_budget or not user_email:
+            return
+        spent = self.spent(user_email)
+        if spent + tokens > self.daily_budget:
+            raise TokenBudgetExceeded(user_email, spent, self.daily_budget)
+
+    def record(self, user_email, endpoint, model, prompt_tokens, completion_tokens):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO llm_usage VALUES (?, ?, ?, ?, 1, ?, ?)"
+                " ON CONFLICT (day, user_email, endpoint, model) DO UPDATE SET calls = calls + 1,"
+                " prompt_tokens = prompt_tokens + excluded.prompt_tokens,"
+                " completion_tokens = completion_tokens + excluded.completion_tokens",
+                (today(), user_email or "", endpoint or "", model, prompt_tokens, completion_tokens)
+            )
+            self._conn.commit()
+
+    def usage(self, user_email=None, day=None):
+        """Rows of {day, user_email, endpoint, model, calls, prompt_tokens, completion_tokens}, newest day first."""
+        query = "SELECT day, user_email, endpoint, model, calls, prompt_tokens, completion_tokens FROM llm_usage"
+        conditions, params = [], []
+        if user_email is not None:
+            conditions.append("user_email = ?")
+            params.append(user_email)
+        if day is not None:
+            conditions.append("day = ?")
+            params.append(day)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY day DESC, user_email, endpoint, model"
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        columns = ("day", "user_email", "endpoint", "model", "calls", "prompt_tokens", "completion_tokens")
+        return [dict(zip(columns, row)) for row in rows]
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UsageLedger()
+        return _ledger
+
+
+def set_ledger(ledger):
+    """Swaps the ledger, e.g. set_ledger(UsageLedger(':memory:', daily_budget=10000))."""
+    global _ledger
+    with _ledger_lock:
+        _ledger = ledger
+
+
+def check_budget(tokens):
+    """Raises TokenBudgetExceeded if the current scope's user cannot spend `tokens` more today."""
+    scope = _scope.get()
+    if scope is not None:
+        get_ledger().check(scope[0], tokens)
+
+
+def record_usage(model, prompt_tokens, completion_tokens):
+    """Adds one call's tokens to the current scope's user and endpoint (unattributed outside any scope)."""
+    user_email, endpoint = _scope.get() or (None, None)
+    try:
+        get_ledger().record(user_email, endpoint, model, prompt_tokens, completion_tokens)
+    except sqlite3.Error as e:
+        print(f"Failed to record LLM usage for {user_email}: {e}")
+
+
+def usage_summary(user_email=None, day=None):
+    """Ledger rows plus per-user totals and remaining budget for `day` (today by default)."""
+    day = day or today()
+    ledger = get_ledger()
+    rows = ledger.usage(user_email, day)
+    users = {}
+    for row in rows:
+        totals = users.setdefault(row["user_email"], {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        for key in totals:
+            totals[key] += row[key]
+    for totals in users.values():
+        spent = totals["prompt_tokens"] + totals["completion_tokens"]
+        totals["remaining"] = max(0, ledger.daily_budget - spent) if ledger.daily_budget else None
+    return {"day": day, "daily_budget": ledger.daily_budget or None, "users": users, "rows": rows}